@@ -0,0 +1,331 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""asyncio versions of the collectors, MQTT client and dispatcher.
+
+Enabled with ``asyncio: true`` in the config. The collector, the MQTT
+network traffic and the config file watch all run on a single event
+loop, instead of the paho network thread and the watchdog observer
+thread used by the default mode. Packet handling is shared with
+engine.Dispatcher, so both modes publish exactly the same thing.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+
+import paho.mqtt.client as paho
+
+from arwn import engine, handlers
+from arwn.vendor.RFXtrx import lowlevel as ll
+from arwn.vendor.RFXtrx.pyserial import AsyncPySerialTransport
+
+logger = logging.getLogger(__name__)
+
+# How often to run paho's housekeeping (keepalive pings, retries)
+MISC_INTERVAL = 1.0
+# How long to wait between reconnect attempts
+RECONNECT_INTERVAL = 5.0
+
+
+class LoopSender(object):
+    """Hands the sends of handlers on worker threads back to the loop"""
+
+    def __init__(self, client, loop):
+        self._client = client
+        self._loop = loop
+
+    def send(self, topic, payload, retain=False, **extra):
+        self._loop.call_soon_threadsafe(
+            functools.partial(self._client.send, topic, payload, retain, **extra)
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class AsyncMQTT(engine.MQTT):
+    """MQTT client whose socket is serviced by the running event loop
+
+    Instead of paho's loop_start() thread the socket is registered with
+    add_reader / add_writer, and keepalives and reconnects are run from a
+    task.
+    """
+
+    def _start(self):
+        self._loop = asyncio.get_running_loop()
+        self._connecting = False
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+        # connected from _misc_loop, spooling or dropping until then
+        self.client.connect_async(self.server, self.port)
+        self._misc = self._loop.create_task(self._misc_loop())
+
+    async def _connect(self):
+        """(Re)connect without blocking the loop
+
+        paho's connect waits on the socket connect, for up to its
+        connect timeout when the broker is unreachable, so it's run on
+        a worker thread. Its socket callbacks are ignored until then,
+        and the socket is handed to the loop once it's back.
+        """
+        sock = self.client.socket()
+        if sock is not None:
+            self._on_socket_close(self.client, None, sock)
+        self._connecting = True
+        try:
+            await self._loop.run_in_executor(None, self.client.reconnect)
+        finally:
+            self._connecting = False
+        sock = self.client.socket()
+        self._loop.add_reader(sock, self.client.loop_read)
+        if self.client.want_write():
+            self._loop.add_writer(sock, self.client.loop_write)
+
+    def _on_socket_open(self, client, userdata, sock):
+        if not self._connecting:
+            self._loop.add_reader(sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        if not self._connecting:
+            self._loop.remove_reader(sock)
+            self._loop.remove_writer(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        if not self._connecting:
+            self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        if not self._connecting:
+            self._loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        while True:
+            try:
+                await self._connect()
+            except Exception:
+                logger.exception("Failed to connect to %s", self.server)
+            else:
+                while self.client.loop_misc() != paho.MQTT_ERR_NO_CONN:
+                    await asyncio.sleep(MISC_INTERVAL)
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    def _get_handler_pool(self, config):
+        # Inline handlers would run on the loop, where a slow one holds
+        # up everything else, so there is always a pool.
+        pool = super(AsyncMQTT, self)._get_handler_pool(config)
+        if pool is None:
+            pool = handlers.HandlerPool()
+        return pool
+
+    def _run_handlers(self, topic, payload):
+        # the pool's threads mustn't touch the socket, which the loop owns
+        client = LoopSender(self.handler_client, self._loop)
+        self.handler_pool.submit(client, topic, payload)
+
+    def _start_flusher(self):
+        # publishing has to happen on the loop, which owns the socket
+        self._flusher = self._loop.create_task(self._flush_forever())
+
+    async def _flush_forever(self):
+        while True:
+            delay = self.coalescer.interval
+            deadline = self.coalescer.next_deadline()
+            if deadline is not None:
+                delay = min(delay, max(0, deadline - self.coalescer.clock()))
+            await asyncio.sleep(delay)
+            self.flush()
+
+    def _start_replay(self):
+        # like publishing, replay has to happen on the loop
+        if self._replayer is None or self._replayer.done():
+            self._replayer = self._loop.create_task(self._replay())
+
+    async def _replay(self):
+        logger.info("Replaying %d spooled messages", len(self.spool))
+        while self.connected:
+            batch = self.spool.peek()
+            if not batch:
+                break
+            for message in batch:
+                info = self._replay_publish(message)
+                if info is None:
+                    continue
+                deadline = self._loop.time() + engine.REPLAY_TIMEOUT
+                while (
+                    info.rc == paho.MQTT_ERR_SUCCESS
+                    and not info.is_published()
+                    and self._loop.time() < deadline
+                ):
+                    await asyncio.sleep(0.01)
+                if not info.is_published():
+                    logger.warning("Replay interrupted, %d left", len(self.spool))
+                    return
+                self.spool.remove(message.id)
+                await asyncio.sleep(1.0 / self.spool_rate)
+
+    def stop(self):
+        self._misc.cancel()
+        if self.coalescer:
+            self._flusher.cancel()
+            self.flush(everything=True)
+        self.client.disconnect()
+        self._stop_handlers()
+
+
+class AsyncRFXCOMCollector(object):
+    def __init__(self, device):
+        self.transport = AsyncPySerialTransport(device)
+        self.unparsable = 0
+
+    async def start(self):
+        self.transport.start()
+        await self.transport.reset()
+
+    def stop(self):
+        self.transport.stop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        frame = await self.transport.receive_frame()
+        try:
+            pkt = ll.parse_sensor(frame)
+        except Exception:
+            logger.exception("Got an unparsable frame: %s", frame.hex())
+            self.unparsable += 1
+            return None
+        if pkt is None:
+            return None
+        packet = engine.SensorPacket()
+        packet.from_packet(pkt)
+        return packet
+
+
+class AsyncRTL433Collector(engine.RTL433Collector):
+    def _spawn(self):
+        # started from start() once we are on the event loop
+        return None
+
+    async def start(self):
+        logger.info("starting cmd: %s" % self.cmd)
+        self.rtl = await asyncio.create_subprocess_exec(
+            *self.cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE,
+        )
+
+    def stop(self):
+        if self.rtl is not None and self.rtl.returncode is None:
+            self.rtl.terminate()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.pending:
+            chunk = await self.rtl.stdout.read(engine.CHUNK_SIZE)
+            if not chunk:
+                logger.error("rtl_433 exited with %s", await self.rtl.wait())
+                raise StopAsyncIteration
+            self.pending.extend(self.lines.feed(chunk))
+        return self._packet(self.pending.popleft())
+
+
+class AsyncDispatcher(engine.Dispatcher):
+    """Dispatcher for the asyncio mode, must be created on a running loop"""
+
+    def _get_mqtt(self, config):
+        return engine.make_mqtt(config, AsyncMQTT)
+
+    def _get_collector(self, config):
+        col = config.get("collector")
+        if col:
+            ctype = col.get("type")
+            if ctype == "rtl433":
+                self.collector = AsyncRTL433Collector(
+                    col.get("devices", None),
+                    col.get("json"),
+                    config["names"],
+                    col.get("prefilter", True),
+                )
+            elif ctype == "rfxcom":
+                self.collector = AsyncRFXCOMCollector(col["device"])
+        else:
+            self.collector = AsyncRFXCOMCollector(config["device"])
+
+    async def loopforever(self):
+        await self.collector.start()
+        try:
+            async for packet in self.collector:
+                if packet is None:
+                    continue
+                self.dispatch(packet)
+        finally:
+            self.collector.stop()
+
+
+class AsyncConfigWatcher(object):
+    """Reload the config when the file changes, by polling from a task
+
+    This replaces the watchdog observer thread. Editors that save with an
+    atomic rename change the inode rather than the mtime, so both are
+    checked.
+    """
+
+    def __init__(self, config_path, dispatcher, interval=5.0):
+        self._config_path = os.path.abspath(config_path)
+        self._dispatcher = dispatcher
+        self._interval = interval
+        self._task = None
+        self._stat = self._get_stat()
+
+    def _get_stat(self):
+        try:
+            st = os.stat(self._config_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._watch())
+        logger.info("Watching %s for changes", self._config_path)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            stat = self._get_stat()
+            if stat is not None and stat != self._stat:
+                self._stat = stat
+                engine.reload_config(self._config_path, self._dispatcher)
+
+
+async def run(config, config_path):
+    """Run the whole collector on the current event loop"""
+    dispatcher = AsyncDispatcher(config)
+    watcher = AsyncConfigWatcher(config_path, dispatcher)
+    try:
+        watcher.start()
+        await dispatcher.loopforever()
+    finally:
+        watcher.stop()
+        dispatcher.mqtt.stop()
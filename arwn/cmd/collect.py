@@ -15,6 +15,7 @@
 # under the License.
 
 import argparse
+import asyncio
 import logging
 import os
 import sys
@@ -23,7 +24,7 @@ import daemon
 import pid
 import yaml
 
-from arwn import engine
+from arwn import aio, engine
 
 
 def parse_args():
@@ -55,6 +56,10 @@ def setup_logger(logfile=None):
 
 
 def event_loop(config, config_path):
+    if config.get("asyncio"):
+        asyncio.run(aio.run(config, config_path))
+        return
+
     dispatcher = engine.Dispatcher(config)
     watcher = engine.ConfigWatcher(config_path, dispatcher)
     try:
@@ -62,6 +67,7 @@ def event_loop(config, config_path):
         dispatcher.loopforever()
     finally:
         watcher.stop()
+        dispatcher.mqtt.stop()
 
 
 def main():
@@ -0,0 +1,107 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Latest-value-wins publish coalescing.
+
+Sensors repeat every reading several times in a burst, and some report
+far more often than anyone needs. With coalescing turned on MQTT.send
+holds messages back per topic and only the newest one goes out once
+the topic has been quiet for a moment.
+"""
+
+import threading
+import time
+
+
+class Coalescer(object):
+    """Hold back publishes so only the newest payload per topic goes out
+
+    A topic is flushed once it has been quiet for interval seconds, so
+    the repeats of a sensor burst collapse into one message, but never
+    later than max_delay seconds after its oldest held payload.
+
+    Each flushed message is marked duplicate when it matches the last
+    one flushed on the topic, ignoring the timestamp.
+    """
+
+    def __init__(self, interval=1.0, max_delay=5.0, clock=time.monotonic):
+        self.interval = interval
+        self.max_delay = max_delay
+        self.clock = clock
+        self.cond = threading.Condition()
+        # topic => [payload, retain, extra, first, last]
+        self.pending = {}
+        # topic => fingerprint of the last flushed payload
+        self.last = {}
+        self.coalesced = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def fingerprint(payload, extra):
+        extra = {k: v for k, v in extra.items() if k != "timestamp"}
+        if not isinstance(payload, dict):
+            # a SensorPacket
+            return (payload.values(), extra)
+        payload = {k: v for k, v in payload.items() if k != "timestamp"}
+        payload.update(extra)
+        return payload
+
+    def add(self, topic, payload, retain, extra):
+        now = self.clock()
+        with self.cond:
+            entry = self.pending.get(topic)
+            if entry is None:
+                self.pending[topic] = [payload, retain, extra, now, now]
+                self.cond.notify()
+            else:
+                entry[0:3] = payload, retain, extra
+                entry[4] = now
+                self.coalesced += 1
+
+    def _deadline(self, entry):
+        return min(entry[4] + self.interval, entry[3] + self.max_delay)
+
+    def next_deadline(self):
+        with self.cond:
+            if not self.pending:
+                return None
+            return min(self._deadline(e) for e in self.pending.values())
+
+    def due(self, everything=False):
+        """Take the messages that are ready to go out
+
+        Returns a list of (topic, payload, retain, extra, duplicate).
+        """
+        now = self.clock()
+        ready = []
+        with self.cond:
+            for topic, entry in list(self.pending.items()):
+                if everything or self._deadline(entry) <= now:
+                    del self.pending[topic]
+                    payload, retain, extra = entry[0:3]
+                    fingerprint = self.fingerprint(payload, extra)
+                    duplicate = self.last.get(topic) == fingerprint
+                    self.last[topic] = fingerprint
+                    if duplicate:
+                        self.duplicates += 1
+                    ready.append((topic, payload, retain, extra, duplicate))
+        return ready
+
+    def wait(self, timeout):
+        """Sleep until the next deadline, a new topic, or timeout"""
+        deadline = self.next_deadline()
+        if deadline is not None:
+            timeout = min(timeout, max(0, deadline - self.clock()))
+        with self.cond:
+            self.cond.wait(timeout)
@@ -0,0 +1,66 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Local calendar days for timestamps, without a datetime per message."""
+
+import datetime
+import time
+import zoneinfo
+
+
+class DayTracker(object):
+    """Which local day a unix timestamp falls on
+
+    Days are numbered by ``date.toordinal()``, so they compare across
+    the new year. The start and end (the next midnight) of the last day
+    looked up are kept, and a timestamp inside it is answered with two
+    compares. Only a timestamp outside it, normally once a day when
+    midnight passes, works the day out again.
+
+    ``tz`` is an IANA zone name, or None for the system's local time.
+    Midnights are found from the zone's rules, so days either side of
+    a DST change are 23 or 25 hours long. ``clock`` gives the time when
+    no timestamp is passed in, it can be swapped out in tests.
+    """
+
+    def __init__(self, tz=None, clock=time.time):
+        if tz is not None:
+            tz = zoneinfo.ZoneInfo(tz)
+        self.tz = tz
+        self.clock = clock
+        self.start = 0
+        self.next_midnight = 0
+        self.today = None
+
+    def day(self, ts=None):
+        """The day number ts, or now, falls on"""
+        if ts is None:
+            ts = self.clock()
+        if not self.start <= ts < self.next_midnight:
+            date = datetime.datetime.fromtimestamp(ts, self.tz).date()
+            self.today = date.toordinal()
+            self.start = self.midnight(date)
+            self.next_midnight = self.midnight(date + datetime.timedelta(days=1))
+        return self.today
+
+    def is_sameday(self, ts1, ts2):
+        return self.day(ts1) == self.day(ts2)
+
+    def midnight(self, date):
+        """The epoch time the local day date starts at"""
+        if self.tz is None:
+            # mktime works out whether DST is in effect at midnight
+            return time.mktime((date.year, date.month, date.day, 0, 0, 0, 0, 0, -1))
+        start = datetime.datetime(date.year, date.month, date.day, tzinfo=self.tz)
+        return start.timestamp()
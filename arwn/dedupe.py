@@ -0,0 +1,56 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Dropping the repeats of sensor transmission bursts.
+
+Turned on with `dedupe:`, the dispatcher checks every packet against
+the last one accepted from its sensor before publishing it.
+"""
+
+import collections
+import time
+
+
+class BurstFilter(object):
+    """Drop the repeats of a sensor's transmission burst
+
+    Oregon and Acurite sensors send every reading several times in a
+    row. A packet is a repeat if it has the same contents as the last
+    packet accepted from its sensor (model and sensor_id), less than
+    window seconds ago. The last accepted fingerprint is kept for up to
+    size sensors.
+    """
+
+    def __init__(self, window=2.0, size=1024, clock=time.monotonic):
+        self.window = window
+        self.size = size
+        self.clock = clock
+        # (model, sensor_id) => (fingerprint, when it was accepted)
+        self.recent = collections.OrderedDict()
+        self.suppressed = 0
+
+    def is_duplicate(self, packet):
+        now = self.clock()
+        fingerprint = (packet.stype, packet.values())
+        sensor = (packet.model, packet.sensor_id)
+        last = self.recent.get(sensor)
+        if last is not None:
+            if last[0] == fingerprint and now - last[1] < self.window:
+                self.suppressed += 1
+                return True
+            self.recent.move_to_end(sensor)
+        self.recent[sensor] = (fingerprint, now)
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+        return False
@@ -0,0 +1,92 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Skipping our own messages when the broker sends them back.
+
+The subscribed client hands what it publishes to the handlers itself,
+so the copy the broker sends back has to be recognised and skipped.
+"""
+
+import collections
+import threading
+import time
+
+
+class EchoFilter(object):
+    """Recognises our own publishes when the broker sends them back
+
+    Messages handed to the handlers locally are added as they are
+    published, and the first copy of each that comes back from the
+    broker is an echo. However many are waiting to come back, none are
+    forgotten until window seconds after they were published, so a
+    burst can't push out copies that are still on their way. A publish
+    that never comes back (the broker doesn't echo, or a QoS 0 message
+    was lost) is forgotten after that. The window starts again on
+    reconnect for everything still waiting, as paho resends the QoS 1
+    and 2 messages that weren't acknowledged.
+    """
+
+    def __init__(self, window=60.0, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        # (topic, data) => [copies still to come back, when last added],
+        # oldest first
+        self.sent = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def add(self, topic, data):
+        key = (topic, data)
+        now = self.clock()
+        with self.lock:
+            entry = self.sent.get(key)
+            if entry is None:
+                self.sent[key] = [1, now]
+            else:
+                entry[0] += 1
+                entry[1] = now
+                self.sent.move_to_end(key)
+            self._expire(now)
+
+    def _expire(self, now):
+        sent = self.sent
+        while sent:
+            key = next(iter(sent))
+            if now - sent[key][1] < self.window:
+                break
+            del sent[key]
+
+    def reconnected(self):
+        """Give whatever paho will resend a new window"""
+        now = self.clock()
+        with self.lock:
+            for entry in self.sent.values():
+                entry[1] = now
+
+    def discard(self, topic, data):
+        self.is_echo(topic, data, count=False)
+
+    def is_echo(self, topic, data, count=True):
+        key = (topic, data)
+        with self.lock:
+            entry = self.sent.get(key)
+            if entry is None:
+                return False
+            if entry[0] == 1:
+                del self.sent[key]
+            else:
+                entry[0] -= 1
+            if count:
+                self.skipped += 1
+        return True
@@ -0,0 +1,175 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Payload encodings for published messages.
+
+JSON is the default. The encoding can be changed for everything, or
+per topic prefix, in the mqtt section of the config::
+
+    mqtt:
+      encoding:
+        default: json
+        topics:
+          temperature: msgpack
+          wind: cbor
+        schema: true
+
+With schema set, a retained <root>/schema message (always JSON)
+describes which encoding each topic uses.
+"""
+
+import abc
+import importlib
+import json
+
+from arwn.topics import PrefixMap
+
+# Bump when the layout of the schema message changes
+SCHEMA_VERSION = 1
+
+
+class Encoder(abc.ABC):
+    """Turns a payload into bytes on the wire and back
+
+    payload is a dict, or a SensorPacket, and extra is a dict of fields
+    to add to it.
+    """
+
+    name = None
+    content_type = None
+
+    @abc.abstractmethod
+    def encode(self, payload, extra):
+        """payload with extra added, as bytes"""
+
+    @abc.abstractmethod
+    def decode(self, data):
+        """The dict data was encoded from"""
+
+    @staticmethod
+    def as_dict(payload, extra):
+        if isinstance(payload, dict):
+            if extra:
+                return dict(payload, **extra)
+            return payload
+        return payload.as_json(**extra)
+
+
+class JSONEncoder(Encoder):
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, payload, extra):
+        if isinstance(payload, dict):
+            if extra:
+                payload = dict(payload, **extra)
+            return json.dumps(payload).encode("utf-8")
+        return payload.payload(**extra)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class CompactJSONEncoder(JSONEncoder):
+    """JSON without the whitespace after separators"""
+
+    name = "json-compact"
+
+    def encode(self, payload, extra):
+        data = json.dumps(self.as_dict(payload, extra), separators=(",", ":"))
+        return data.encode("utf-8")
+
+
+class MsgPackEncoder(Encoder):
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def __init__(self):
+        self.msgpack = importlib.import_module("msgpack")
+
+    def encode(self, payload, extra):
+        return self.msgpack.packb(self.as_dict(payload, extra))
+
+    def decode(self, data):
+        return self.msgpack.unpackb(data)
+
+
+class CBOREncoder(Encoder):
+    name = "cbor"
+    content_type = "application/cbor"
+
+    def __init__(self):
+        self.cbor2 = importlib.import_module("cbor2")
+
+    def encode(self, payload, extra):
+        return self.cbor2.dumps(self.as_dict(payload, extra))
+
+    def decode(self, data):
+        return self.cbor2.loads(data)
+
+
+ENCODERS = {
+    cls.name: cls
+    for cls in (JSONEncoder, CompactJSONEncoder, MsgPackEncoder, CBOREncoder)
+}
+
+
+class EncoderMap(object):
+    """Picks the encoder for a topic by its longest configured prefix"""
+
+    def __init__(self, root, config=None):
+        config = config or {}
+        self.root = root
+        self._encoders = {}
+        self.default = self._get(config.get("default", "json"))
+        self.prefixes = PrefixMap(self.default)
+        for prefix, name in (config.get("topics") or {}).items():
+            prefix = "%s/%s" % (root, prefix.strip("/"))
+            self.prefixes[prefix] = self._get(name)
+        # these have to be readable without knowing the schema
+        for topic in ("status", "schema"):
+            self.prefixes["%s/%s" % (root, topic)] = self._get("json")
+        self.publish_schema = bool(config.get("schema", False))
+
+    def _get(self, name):
+        if name not in self._encoders:
+            try:
+                cls = ENCODERS[name]
+            except KeyError:
+                raise ValueError(
+                    "Unknown encoding %s, expected one of %s"
+                    % (name, ", ".join(ENCODERS))
+                )
+            self._encoders[name] = cls()
+        return self._encoders[name]
+
+    def for_topic(self, topic):
+        """The encoder for a full topic, including the root"""
+        return self.prefixes.get(topic)
+
+    def schema(self, fields=()):
+        """The description published on <root>/schema"""
+        return {
+            "version": SCHEMA_VERSION,
+            "default": self.default.name,
+            "topics": {
+                prefix[len(self.root) + 1 :]: encoder.name
+                for prefix, encoder in self.prefixes.items()
+            },
+            "encodings": {
+                name: {"content_type": encoder.content_type}
+                for name, encoder in self._encoders.items()
+            },
+            "fields": list(fields),
+        }
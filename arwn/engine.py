@@ -12,19 +12,32 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import functools
+import importlib
 import json
 import logging
+import operator
 import os
+import re
 import subprocess
 import threading
 import time
+import types
 
 import paho.mqtt.client as paho
 import yaml
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
-from arwn import handlers, temperature
+from arwn import encoders, handlers, mqtt5, temperature
+from arwn.coalesce import Coalescer
+from arwn.dedupe import BurstFilter
+from arwn.echoes import EchoFilter
+from arwn.fanout import Fanout, broker_configs
+from arwn.spool import Spool
+from arwn.stats import PublishStats
+from arwn.topics import PrefixMap
 from arwn.vendor.RFXtrx import lowlevel as ll
 from arwn.vendor.RFXtrx.pyserial import PySerialTransport
 
@@ -52,9 +65,106 @@ MAX_TEMP = 150
 MIN_TEMP = -40
 
 
+@functools.lru_cache(maxsize=256)
+def model_type(model):
+    """Sensor type bits for an rtl_433 model name"""
+    stype = IS_NONE
+    if model.startswith("Oregon-"):
+        model = model[7:]
+
+    if model in TH_SENSORS:
+        stype |= IS_TEMP
+        stype |= IS_HUMID
+    if model in BARO_SENSORS:
+        stype |= IS_BARO
+    if model in RAIN_SENSORS:
+        stype |= IS_RAIN
+    if model in WIND_SENSORS:
+        stype |= IS_WIND
+    if model in MOIST_SENSORS:
+        stype |= IS_TEMP
+        stype |= IS_MOIST
+    return stype
+
+
+# The reading fields a SensorPacket can carry, in the order they are
+# written to the payload. Fields that a sensor doesn't report stay None
+# and are left out.
+FIELDS = (
+    "temp",
+    "dewpoint",
+    "humid",
+    "moisture",
+    "pressure",
+    "total",
+    "rate",
+    "direction",
+    "speed",
+    "gust",
+    "units",
+)
+
+
+_PAYLOAD_NAMES = ("bat", "sensor_id") + FIELDS
+_payload_values = operator.attrgetter(*_PAYLOAD_NAMES)
+
+
+@functools.lru_cache(maxsize=1024)
+def _json_str(value):
+    return json.dumps(value)
+
+
+@functools.lru_cache(maxsize=256)
+def _payload_format(classes, extra):
+    """Build the payload format for a combination of value types
+
+    classes are the types of the packet values followed by the extra
+    values, extra the names of the extra values. The keys are written in
+    the order as_json() has them: an extra value replacing one the
+    packet has takes its place, the others go at the end. Ints and
+    floats are written with %r, which is how json writes them. Returns
+    an itemgetter picking the values that are written, the format
+    string, and the positions of the floats and of the values that need
+    json encoding.
+    """
+    names = _PAYLOAD_NAMES + extra
+    count = len(_PAYLOAD_NAMES)
+    picked = []
+    parts = []
+    floats = []
+    encode = []
+    for i, name in enumerate(names):
+        if i < count:
+            # bat and sensor_id are always written, even if None
+            if classes[i] is type(None) and i >= 2:
+                continue
+            if name in extra:
+                i = count + extra.index(name)
+        elif name in _PAYLOAD_NAMES:
+            packet = _PAYLOAD_NAMES.index(name)
+            if packet < 2 or classes[packet] is not type(None):
+                # already written in the packet's place
+                continue
+        cls = classes[i]
+        if cls is int:
+            spec = "%r"
+        elif cls is float:
+            spec = "%r"
+            floats.append(len(picked))
+        else:
+            spec = "%s"
+            encode.append(len(picked))
+        picked.append(i)
+        parts.append("%s: %s" % (_json_str(name).replace("%", "%%"), spec))
+    fmt = "{%s}" % ", ".join(parts)
+    return operator.itemgetter(*picked), fmt, tuple(floats), tuple(encode)
+
+
 class SensorPacket(object):
     """Convert RFXtrx packet to native packet for ARWN"""
 
+    __slots__ = ("stype", "model", "bat", "sensor_id") + FIELDS
+
     def _set_type(self, packet):
         logger.debug("Type: %d", self.stype)
 
@@ -62,22 +172,7 @@ class SensorPacket(object):
             return
 
         if isinstance(packet, dict):
-            model = packet.get("model", "")
-            if model.startswith("Oregon-"):
-                model = model[7:]
-
-            if model in TH_SENSORS:
-                self.stype |= IS_TEMP
-                self.stype |= IS_HUMID
-            if model in BARO_SENSORS:
-                self.stype |= IS_BARO
-            if model in RAIN_SENSORS:
-                self.stype |= IS_RAIN
-            if model in WIND_SENSORS:
-                self.stype |= IS_WIND
-            if model in MOIST_SENSORS:
-                self.stype |= IS_TEMP
-                self.stype |= IS_MOIST
+            self.stype |= model_type(packet.get("model", ""))
 
         # if this is an RFXCOM packet
         if isinstance(packet, ll.TempHumid):
@@ -112,16 +207,21 @@ class SensorPacket(object):
     def is_moist(self):
         return self.stype & IS_MOIST
 
-    def __init__(self, stype=IS_NONE, bat=0, sensor_id=0, **kwargs):
+    def __init__(self, stype=IS_NONE, bat=0, sensor_id=0, model=None, **kwargs):
         self.stype = stype
-        self.bat = (bat,)
+        # which kind of sensor, for telling apart two that share an id
+        self.model = model
+        self.bat = bat
         self.sensor_id = sensor_id
-        self.data = {}
-        self.data.update(kwargs)
+        for name in FIELDS:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError("Unknown SensorPacket fields: %s" % ", ".join(kwargs))
 
     def from_json(self, data):
         logger.debug("Packet json; %s", data)
         self._set_type(data)
+        self.model = data.get("model")
         self.bat = data.get("battery_ok", 0)
 
         if "id" in data:
@@ -129,58 +229,74 @@ class SensorPacket(object):
         elif "sid" in data:
             self.sensor_id = "%2.2x:%2.2x" % (data["sid"], data.get("channel", 0))
         if self.stype & IS_TEMP:
-            temp = temperature.Temperature("%sC" % data["temperature_C"]).as_F()
-            self.data["temp"] = round(temp.to_F(), 1)
-            self.data["units"] = "F"
+            temp = float(data["temperature_C"])
+            self.temp = round(temperature.c_to_f(temp), 1)
+            self.units = "F"
         # note, we always assume HUMID sensors are temp sensors
         if self.stype & IS_HUMID:
-            self.data["dewpoint"] = round(temp.dewpoint(data["humidity"]), 1)
-            self.data["humid"] = round(data["humidity"], 1)
+            dewpoint = temperature.dewpoint_c(temp, data["humidity"])
+            self.dewpoint = round(temperature.c_to_f(dewpoint), 1)
+            self.humid = round(data["humidity"], 1)
         if self.stype & IS_MOIST:
-            self.data["moisture"] = data["moisture"]
+            self.moisture = data["moisture"]
         if self.stype & IS_BARO:
-            self.data["pressure"] = data["pressure_hPa"]
+            self.pressure = data["pressure_hPa"]
         if self.stype & IS_RAIN:
             # rtl_433 already converts to non metric here
             if "rain_mm" in data:
-                self.data["total"] = round(data["rain_mm"] * MM2IN, 3)
+                self.total = round(data["rain_mm"] * MM2IN, 3)
             else:
-                self.data["total"] = round(data["rain_in"], 2)
-                self.data["rate"] = round(data["rain_rate_in_h"], 2)
-            self.data["units"] = "in"
+                self.total = round(data["rain_in"], 2)
+                self.rate = round(data["rain_rate_in_h"], 2)
+            self.units = "in"
         if self.stype & IS_WIND:
             mps2mph = 2.23694
             speed = round(float(data["wind_avg_m_s"]) * mps2mph, 1)
             gust = round(float(data["wind_max_m_s"]) * mps2mph, 1)
-            self.data["direction"] = data["wind_dir_deg"]
-            self.data["speed"] = speed
-            self.data["gust"] = gust
-            self.data["units"] = "mph"
+            self.direction = data["wind_dir_deg"]
+            self.speed = speed
+            self.gust = gust
+            self.units = "mph"
 
     def from_packet(self, packet):
         self._set_type(packet)
+        self.model = type(packet).__name__
         self.bat = getattr(packet, "battery", -1)
         self.sensor_id = packet.id_string
         if self.stype & IS_TEMP:
-            temp = temperature.Temperature("%sC" % packet.temp).as_F()
-            self.data["temp"] = round(temp.to_F(), 1)
-            self.data["dewpoint"] = round(temp.dewpoint(packet.humidity), 1)
-            self.data["humid"] = round(packet.humidity, 1)
-            self.data["units"] = "F"
+            self.temp = round(temperature.c_to_f(packet.temp), 1)
+            dewpoint = temperature.dewpoint_c(packet.temp, packet.humidity)
+            self.dewpoint = round(temperature.c_to_f(dewpoint), 1)
+            self.humid = round(packet.humidity, 1)
+            self.units = "F"
         if self.stype & IS_BARO:
-            self.data["pressure"] = packet.baro
+            self.pressure = packet.baro
         if self.stype & IS_RAIN:
-            self.data["total"] = round(packet.raintotal / 25.4, 2)
-            self.data["rate"] = round(packet.rainrate / 25.4, 2)
-            self.data["units"] = "in"
+            self.total = round(packet.raintotal / 25.4, 2)
+            self.rate = round(packet.rainrate / 25.4, 2)
+            self.units = "in"
         if self.stype & IS_WIND:
             mps2mph = 2.23694
             speed = round(float(packet.average_speed) * mps2mph, 1)
             gust = round(float(packet.gust) * mps2mph, 1)
-            self.data["direction"] = packet.direction
-            self.data["speed"] = speed
-            self.data["gust"] = gust
-            self.data["units"] = "mph"
+            self.direction = packet.direction
+            self.speed = speed
+            self.gust = gust
+            self.units = "mph"
+
+    @property
+    def data(self):
+        """The readings that are set, as a dict"""
+        data = {}
+        for name in FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+    def values(self):
+        """bat, sensor_id and every reading, set or not, as a tuple"""
+        return _payload_values(self)
 
     def as_json(self, **kwargs):
         data = dict(bat=self.bat, sensor_id=self.sensor_id)
@@ -188,11 +304,55 @@ class SensorPacket(object):
         data.update(kwargs)
         return data
 
+    def payload(self, **extra):
+        """The MQTT payload for this packet, as json bytes
+
+        Gives the same bytes as json.dumps(self.as_json(**extra)), but is
+        written straight from the fields with a format cached per
+        combination of fields.
+        """
+        values = _payload_values(self)
+        keys = ()
+        if extra:
+            keys = tuple(extra)
+            values += tuple(extra.values())
+        pick, fmt, floats, encode = _payload_format(tuple(map(type, values)), keys)
+        values = list(pick(values))
+        for i in floats:
+            if values[i] - values[i]:
+                # NaN or infinity, which only json knows how to spell
+                return json.dumps(self.as_json(**extra)).encode("utf-8")
+        for i in encode:
+            value = values[i]
+            if value.__class__ is str:
+                values[i] = _json_str(value)
+            else:
+                values[i] = json.dumps(value)
+        return (fmt % tuple(values)).encode("utf-8")
+
+
+# How long to wait for the broker to acknowledge a replayed message
+REPLAY_TIMEOUT = 10.0
+
+# How many local deliveries are held back until we are subscribed
+HELD_MESSAGES = 1000
+
 
 class MQTT(object):
     def __init__(self, server, config, port=1883):
-        client = paho.Client()
-        handlers.setup()
+        # MQTT v5 options, see config.yml.sample
+        self.version = config["mqtt"].get("version", 3)
+        if self.version not in (3, 5):
+            raise ValueError("Unknown MQTT version %s, expected 3 or 5" % self.version)
+        self.message_expiry = config["mqtt"].get("message_expiry")
+        self.max_aliases = config["mqtt"].get("topic_aliases", 16)
+        # the aliases of the current connection, None while disconnected
+        self.aliases = None
+        self._alias_lock = threading.Lock()
+        if self.version == 5:
+            client = paho.Client(protocol=paho.MQTTv5)
+        else:
+            client = paho.Client()
         self.server = server
         self.port = port
         self.config = config
@@ -203,15 +363,108 @@ class MQTT(object):
         if self.user and self.passwd:
             client.username_pw_set(self.user, self.passwd)
 
-        def on_connect(client, userdata, flags, rc):
+        self.encoders = encoders.EncoderMap(self.root, config["mqtt"].get("encoding"))
+        self.schema_topic = "%s/schema" % self.root
+        # Only one broker of a fan out subscribes and runs the handlers,
+        # which publish through handler_client.
+        self.subscribe = config["mqtt"].get("subscribe", True)
+        if self.subscribe:
+            # once, the other brokers of a fan out are set up after this
+            # one is connected and the handlers have state to lose
+            handlers.setup(config.get("state"), config.get("timezone"))
+        self.handler_client = self
+        self.handler_pool = None
+        # What we publish goes to the handlers straight away, and the
+        # copy the broker sends back is skipped. Not without a pool, the
+        # handlers would then run on whichever thread published as well
+        # as the network thread, at the same time.
+        self.echoes = None
+        if self.subscribe:
+            self.handler_pool = self._get_handler_pool(config)
+            local = config["mqtt"].get("local_handlers", True)
+            if local and self.handler_pool is not None:
+                self.echoes = EchoFilter()
+        # Local deliveries wait for the SUBACK after every connect, so
+        # the handlers see the retained messages the broker sends on
+        # subscribe, like totals/rain, before anything we publish. None
+        # once released.
+        self._held = collections.deque(maxlen=HELD_MESSAGES)
+        self._held_lock = threading.Lock()
+        self._subscribe_mid = None
+
+        self.stats = PublishStats()
+        # per topic prefix publish options, retain None means as sent
+        self.qos = PrefixMap(0)
+        self.retain = PrefixMap(None)
+        for prefix, options in (config["mqtt"].get("topics") or {}).items():
+            prefix = "%s/%s" % (self.root, prefix.strip("/"))
+            if "qos" in options:
+                self.qos[prefix] = options["qos"]
+            if "retain" in options:
+                self.retain[prefix] = options["retain"]
+        if "max_inflight" in config["mqtt"]:
+            client.max_inflight_messages_set(config["mqtt"]["max_inflight"])
+        if "max_queued" in config["mqtt"]:
+            client.max_queued_messages_set(config["mqtt"]["max_queued"])
+
+        self.connected = False
+        self.disconnects = 0
+        self.spool = None
+        # Held while deciding whether to spool and while the replayer
+        # decides it's done, so nothing is spooled just as it stops.
+        self._spool_lock = threading.Lock()
+        # spooled messages dropped for being older than message_expiry
+        self.expired = 0
+        spool_config = config["mqtt"].get("spool")
+        if spool_config:
+            self.spool = Spool(
+                spool_config["path"], spool_config.get("max_messages", 100000)
+            )
+            self.spool_rate = spool_config.get("rate", 10)
+
+        def on_connect(client, userdata, flags, rc, properties=None):
+            self.connected = True
+            if self.echoes is not None:
+                self.echoes.reconnected()
+            if self.version == 5:
+                maximum = min(
+                    self.max_aliases, getattr(properties, "TopicAliasMaximum", 0)
+                )
+                with self._alias_lock:
+                    self.aliases = mqtt5.TopicAliases(maximum) if maximum else None
             status = {"status": "alive", "timestamp": int(time.time())}
-            client.subscribe("%s/#" % self.root)
-            client.publish(self.status_topic, json.dumps(status), qos=2, retain=True)
+            if self.subscribe:
+                _, self._subscribe_mid = client.subscribe("%s/#" % self.root)
+            self._publish_raw(self.status_topic, json.dumps(status), 2, True)
             client.will_set(self.status_topic, json.dumps(status_dead), retain=True)
+            if self.encoders.publish_schema:
+                schema = self.encoders.schema(_PAYLOAD_NAMES + ("timestamp",))
+                self._publish_raw(self.schema_topic, json.dumps(schema), 1, True)
+            if self.spool is not None and len(self.spool):
+                self._start_replay()
+
+        def on_disconnect(client, userdata, rc, properties=None):
+            self.connected = False
+            self.disconnects += 1
+            self.stats.disconnected()
+            with self._alias_lock:
+                self.aliases = None
+            with self._held_lock:
+                if self._held is None:
+                    self._held = collections.deque(maxlen=HELD_MESSAGES)
+
+        def on_subscribe(client, userdata, mid, granted_qos, properties=None):
+            if mid == self._subscribe_mid:
+                self._release_held()
+
+        def on_publish(client, userdata, mid):
+            self.stats.ack(mid)
 
         def on_message(client, userdata, msg):
-            payload = json.loads(msg.payload.decode("utf-8"))
-            handlers.run(self, msg.topic, payload)
+            if self.echoes is not None and self.echoes.is_echo(msg.topic, msg.payload):
+                return True
+            payload = self.encoders.for_topic(msg.topic).decode(msg.payload)
+            self._run_handlers(msg.topic, payload)
             return True
 
         if config["mqtt"].get("username") and config["mqtt"].get("password"):
@@ -222,19 +475,253 @@ class MQTT(object):
         status_dead = {"status": "dead"}
         client.will_set(self.status_topic, json.dumps(status_dead), qos=2, retain=True)
         client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        client.on_publish = on_publish
+        client.on_subscribe = on_subscribe
         client.on_message = on_message
-        client.connect(self.server, self.port)
-        client.loop_start()
         self.client = client
+        self.coalescer = None
+        coalesce = config["mqtt"].get("coalesce")
+        if coalesce:
+            if coalesce is True:
+                coalesce = {}
+            self.coalescer = Coalescer(
+                coalesce.get("interval", 1.0), coalesce.get("max_delay", 5.0)
+            )
+        self._replayer = None
+        self._start()
+        if self.coalescer:
+            self._start_flusher()
+
+    def _start(self):
+        if self.spool is not None or not self.subscribe:
+            # with a spool there's no need to wait for the broker, keep
+            # trying in the background and spool until it's there. A
+            # secondary broker shouldn't hold up startup either.
+            self.client.connect_async(self.server, self.port)
+        else:
+            self.client.connect(self.server, self.port)
+        self.client.loop_start()
 
     def reconnect(self):
         self.client.disconnect()
         self.client.connect(self.server, self.port)
 
-    def send(self, topic, payload, retain=False):
+    def stop(self):
+        """Send what's held back and disconnect"""
+        if self.coalescer:
+            self.flush(everything=True)
+        self.client.disconnect()
+        self.client.loop_stop()
+        self._stop_handlers()
+
+    def _stop_handlers(self):
+        if self.subscribe:
+            # finish what's queued, then save what the handlers held back
+            if self.handler_pool is not None:
+                self.handler_pool.stop()
+            handlers.flush_state()
+
+    def _get_handler_pool(self, config):
+        options = config.get("handlers", True)
+        if not options:
+            return None
+        if options is True:
+            options = {}
+        return handlers.HandlerPool(
+            options.get("queue_size", 1000), options.get("overflow", "drop_oldest")
+        )
+
+    def _run_handlers(self, topic, payload):
+        if self.handler_pool is None:
+            handlers.run(self.handler_client, topic, payload)
+        else:
+            self.handler_pool.submit(self.handler_client, topic, payload)
+
+    def health(self):
+        """Connection state and publish stats for this broker"""
+        health = {
+            "server": self.server,
+            "port": self.port,
+            "connected": self.connected,
+            "disconnects": self.disconnects,
+        }
+        if self.echoes is not None:
+            health["echoes_skipped"] = self.echoes.skipped
+        health.update(self.stats.snapshot())
+        return health
+
+    def _start_flusher(self):
+        flusher = threading.Thread(target=self._flush_forever, daemon=True)
+        flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            self.coalescer.wait(self.coalescer.interval)
+            self.flush()
+
+    def flush(self, everything=False):
+        """Publish the coalesced messages that are due"""
+        for topic, payload, retain, extra, duplicate in self.coalescer.due(everything):
+            extra["duplicate"] = duplicate
+            self._publish(topic, payload, retain, extra)
+
+    def send(self, topic, payload, retain=False, **extra):
+        """Publish payload to topic under the root
+
+        payload is either a dict or a SensorPacket, extra fields (e.g. a
+        timestamp) are added to it. With coalescing turned on the
+        message is held back, and replaced by any newer one for the same
+        topic, until it is flushed.
+        """
         topic = "%s/%s" % (self.root, topic)
-        logger.debug("Sending %s => %s", topic, payload)
-        self.client.publish(topic, json.dumps(payload), retain=retain)
+        if self.coalescer:
+            self.coalescer.add(topic, payload, retain, extra)
+        else:
+            self._publish(topic, payload, retain, extra)
+
+    def _publish_raw(self, topic, data, qos, retain, properties=None):
+        info = self.client.publish(
+            topic, data, qos=qos, retain=retain, properties=properties
+        )
+        self.stats.sent(info)
+        return info
+
+    def _publish_v5(self, topic, data, qos, retain, sensor_id):
+        # Only QoS 0 is aliased, paho resends QoS 1 and 2 messages as
+        # they were on a new connection, which has no aliases yet.
+        with self._alias_lock:
+            alias = None
+            if qos == 0 and self.aliases is not None:
+                topic, alias = self.aliases.get(topic)
+            properties = mqtt5.cached_publish_properties(
+                alias, sensor_id, self.message_expiry
+            )
+            return self._publish_raw(topic, data, qos, retain, properties)
+
+    def _publish(self, topic, payload, retain, extra):
+        data = self.encoders.for_topic(topic).encode(payload, extra)
+        logger.debug("Sending %s => %s", topic, data)
+        qos = self.qos.get(topic)
+        retain_override = self.retain.get(topic)
+        if retain_override is not None:
+            retain = retain_override
+        sensor_id = getattr(payload, "sensor_id", None)
+        publish = self._publish_raw
+        if self.version == 5:
+            publish = functools.partial(self._publish_v5, sensor_id=sensor_id)
+        echoes = self.echoes
+        if echoes is not None:
+            # before publishing, the echo can be back before publish returns
+            echoes.add(topic, data)
+        if self.spool is None:
+            publish(topic, data, qos, retain)
+        else:
+            with self._spool_lock:
+                # anything already spooled has to go out first
+                if self.connected and not len(self.spool):
+                    info = publish(topic, data, qos, retain)
+                    if info.rc == paho.MQTT_ERR_NO_CONN:
+                        self._spool(topic, data, retain, sensor_id)
+                else:
+                    self._spool(topic, data, retain, sensor_id)
+        if echoes is not None:
+            if isinstance(payload, dict):
+                payload = dict(payload, **extra)
+            else:
+                payload = payload.as_json(**extra)
+            self._deliver(topic, payload)
+
+    def _deliver(self, topic, payload):
+        """Hand something we published to the handlers, or hold it back"""
+        with self._held_lock:
+            if self._held is not None:
+                # the oldest go first if the broker is away for long
+                self._held.append((topic, payload))
+            else:
+                self._run_handlers(topic, payload)
+
+    def _release_held(self):
+        with self._held_lock:
+            held, self._held = self._held, None
+            for topic, payload in held or ():
+                self._run_handlers(topic, payload)
+
+    def _spool(self, topic, data, retain, sensor_id):
+        if self.echoes is not None:
+            # it'll come back once replayed, see _replay_publish
+            self.echoes.discard(topic, data)
+        self.spool.put(topic, data, retain, sensor_id)
+        if self.connected:
+            # in case the replayer gave up, it's restarted on reconnect
+            # otherwise
+            self._start_replay()
+
+    def _replay_publish(self, message):
+        """Publish a spooled message, None if it had expired instead
+
+        A message expires message_expiry seconds after it was spooled,
+        whichever MQTT version is used, only v5 tells the broker.
+        """
+        expiry = None
+        if self.message_expiry:
+            expiry = self.message_expiry - (time.time() - message.created)
+            if expiry < 1:
+                self.spool.remove(message.id)
+                self.expired += 1
+                return None
+        properties = None
+        if self.version == 5:
+            properties = mqtt5.publish_properties(None, message.sensor_id, expiry)
+        if self.echoes is not None:
+            # the handlers had it when it was spooled, maybe before a restart
+            self.echoes.add(message.topic, message.payload)
+        return self._publish_raw(
+            message.topic, message.payload, 1, message.retain, properties
+        )
+
+    def _start_replay(self):
+        if self._replayer is None or not self._replayer.is_alive():
+            self._replayer = threading.Thread(target=self._replay, daemon=True)
+            self._replayer.start()
+
+    def _replay(self):
+        """Send everything in the spool, oldest first, at a limited rate
+
+        Spooled messages go out at QoS 1 and are only removed once the
+        broker has acknowledged them, so nothing is lost if the
+        connection drops again part way through.
+        """
+        logger.info("Replaying %d spooled messages", len(self.spool))
+        while self.connected:
+            with self._spool_lock:
+                batch = self.spool.peek()
+                if not batch:
+                    self._replayer = None
+                    break
+            for message in batch:
+                info = self._replay_publish(message)
+                if info is None:
+                    continue
+                if info.rc == paho.MQTT_ERR_SUCCESS:
+                    info.wait_for_publish(REPLAY_TIMEOUT)
+                if not info.is_published():
+                    logger.warning("Replay interrupted, %d left", len(self.spool))
+                    return
+                self.spool.remove(message.id)
+                time.sleep(1.0 / self.spool_rate)
+
+
+def make_mqtt(config, cls=None):
+    """An MQTT client, or a Fanout when mqtt: brokers: lists more"""
+    cls = cls or MQTT
+    brokers = [
+        cls(server, broker_config, port=port)
+        for server, port, broker_config in broker_configs(config)
+    ]
+    if len(brokers) == 1:
+        return brokers[0]
+    return Fanout(brokers)
 
 
 class RFXCOMCollector(object):
@@ -248,47 +735,179 @@ class RFXCOMCollector(object):
         return self
 
     def __next__(self):
+        # the transport resyncs on corrupt length bytes itself, so a bad
+        # frame here only costs us that frame.
+        frame = self.transport.receive_frame()
         try:
-            event = self.transport.receive_blocking()
-            self.unparsable = 0
+            pkt = ll.parse_sensor(frame)
         except Exception:
-            logger.exception("Got an unparsable byte")
+            logger.exception("Got an unparsable frame: %s", frame.hex())
             self.unparsable += 1
-            if self.unparsable > 10:
-                raise
             return None
-        logger.debug(event)
+        if pkt is None:
+            return None
         # general case, temp, rain, wind
         packet = SensorPacket()
-        packet.from_packet(event.device.pkt)
+        packet.from_packet(pkt)
         return packet
 
 
+def rtl433_command(devices=None):
+    """Build the rtl_433 command line, optionally limited to devices"""
+    cmd = ["rtl_433", "-F", "json"]
+    if type(devices) is list:
+        for d in devices:
+            cmd.append("-R")
+            cmd.append("%s" % d)
+    return cmd
+
+
+# JSON libraries to decode rtl_433 output with, fastest first
+JSON_BACKENDS = ("orjson", "ujson", "json")
+
+# How much to read from the rtl_433 pipe at once
+CHUNK_SIZE = 65536
+
+
+def json_loader(name=None):
+    """Return a loads function for the named, or fastest installed, backend
+
+    The returned function accepts bytes or a memoryview.
+    """
+    names = (name,) if name else JSON_BACKENDS
+    for backend in names:
+        try:
+            module = importlib.import_module(backend)
+        except ImportError:
+            if name:
+                raise
+            continue
+        logger.info("Decoding rtl_433 json with %s", backend)
+        if backend == "orjson":
+            # orjson reads straight out of a memoryview
+            return module.loads
+        loads = module.loads
+        return lambda line: loads(bytes(line))
+
+
+class LineSplitter(object):
+    """Split newline delimited records out of large reads
+
+    Complete lines are returned as memoryview slices of the chunk that
+    was read, only a line straddling two reads gets copied.
+    """
+
+    def __init__(self):
+        self.partial = bytearray()
+
+    def feed(self, chunk):
+        """Return the complete lines in chunk, keeping any trailing partial"""
+        lines = []
+        end = chunk.find(b"\n")
+        if end < 0:
+            self.partial += chunk
+            return lines
+        view = memoryview(chunk)
+        if self.partial:
+            self.partial += view[:end]
+            lines.append(bytes(self.partial))
+            self.partial = bytearray()
+        elif end:
+            lines.append(view[:end])
+        start = end + 1
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                break
+            if end > start:
+                lines.append(view[start:end])
+            start = end + 1
+        if start < len(chunk):
+            self.partial += view[start:]
+        return lines
+
+
+_MODEL_RE = re.compile(rb'"model"\s*:\s*"([^"\\]*)"')
+_ID_RE = re.compile(rb'"s?id"\s*:\s*(\d+)\s*[,}]')
+_CHANNEL_RE = re.compile(rb'"channel"\s*:\s*([^,}]*)')
+
+
 class RTL433Collector(object):
-    def __init__(self, devices=None):
-        global RAIN_SENSORS
-        cmd = ["rtl_433", "-F", "json"]
-        logger.error(devices)
-        logger.error(type(devices))
-        if type(devices) is list:
-            for d in devices:
-                cmd.append("-R")
-                cmd.append("%s" % d)
-        logger.info("starting cmd: %s" % cmd)
-        self.rtl = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+    def __init__(self, devices=None, json_backend=None, names=None, prefilter=True):
+        self.cmd = rtl433_command(devices)
+        self.loads = json_loader(json_backend)
+        self.lines = LineSplitter()
+        self.pending = collections.deque()
+        self.names = names or {}
+        self.prefilter = prefilter
+        # models dropped by the prefilter, and how many lines of each
+        self.dropped = collections.Counter()
+        self.rtl = self._spawn()
+
+    def _spawn(self):
+        logger.info("starting cmd: %s" % self.cmd)
+        return subprocess.Popen(
+            self.cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, bufsize=0
+        )
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        line = self.rtl.stdout.readline()
-        data = json.loads(line.decode("utf-8"))
-        self.log_data(data)
+        while not self.pending:
+            chunk = os.read(self.rtl.stdout.fileno(), CHUNK_SIZE)
+            if not chunk:
+                logger.error("rtl_433 exited with %s", self.rtl.wait())
+                raise StopIteration
+            self.pending.extend(self.lines.feed(chunk))
+        return self._packet(self.pending.popleft())
+
+    def wanted(self, line):
+        """Cheaply check if a line is a sensor we know or have named
+
+        Only pulls model, id and channel out of the raw line. Anything we
+        can't work out is let through to the full decode.
+        """
+        m = _MODEL_RE.search(line)
+        if m is None:
+            return True
+        model = m.group(1).decode("utf-8", "replace")
+        if model_type(model) != IS_NONE:
+            return True
+        m = _ID_RE.search(line)
+        if m is None:
+            return True
+        channel = 0
+        c = _CHANNEL_RE.search(line)
+        if c is not None:
+            try:
+                channel = int(c.group(1))
+            except ValueError:
+                return True
+        if "%2.2x:%2.2x" % (int(m.group(1)), channel) in self.names:
+            return True
+
+        if model not in self.dropped:
+            logger.info("Ignoring rtl_433 model %s", model)
+        self.dropped[model] += 1
+        return False
+
+    def _packet(self, line):
+        if self.prefilter and not self.wanted(line):
+            return None
+        try:
+            data = self.loads(line)
+        except ValueError:
+            logger.warning("Unparsable rtl_433 output: %r", bytes(line))
+            return None
+        if logger.isEnabledFor(logging.DEBUG):
+            self.log_data(data)
         packet = SensorPacket()
         packet.from_json(data)
         return packet
 
-    def log_data(self, data):
+    @staticmethod
+    def log_data(data):
         fields = [
             ("model", "(%(model)s)"),
             ("id", "%(id)d:%(channel)d"),
@@ -321,21 +940,64 @@ class RTL433Collector(object):
             pass
 
 
+# Where a sensor's readings go, and the limits they have to be in
+Route = collections.namedtuple(
+    "Route", ["name", "temperature", "moisture", "min_temp", "max_temp", "max_moist"]
+)
+
+
+def named_route(name):
+    return Route(
+        name, "temperature/%s" % name, "moisture/%s" % name, MIN_TEMP, MAX_TEMP, 10
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def unknown_route(sensor_id):
+    return Route(None, "unknown/%s" % sensor_id, None, MIN_TEMP, MAX_TEMP, 10)
+
+
+def build_routes(names):
+    """Build the frozen sensor_id => Route table for the named sensors
+
+    A sensor listed without a name is left out, and so published as
+    unknown like one that isn't listed at all.
+    """
+    return types.MappingProxyType(
+        {sensor_id: named_route(name) for sensor_id, name in names.items() if name}
+    )
+
+
 class Dispatcher(object):
     def __init__(self, config):
-        self._names_lock = threading.Lock()
+        self.burst_filter = self._get_burst_filter(config)
         self._get_collector(config)
         self.names = config["names"]
-        server = config["mqtt"]["server"]
-        self.mqtt = MQTT(server, config)
+        self.routes = build_routes(self.names)
+        self.mqtt = self._get_mqtt(config)
         self.config = config
         logger.debug("Config => %s", self.config)
 
     def reload(self, config):
-        with self._names_lock:
-            self.names = config["names"]
-        count = len(self.names)
-        logger.info("Config reloaded: %d sensor names loaded", count)
+        # The routes are never modified, only replaced, so dispatch can
+        # read them without a lock.
+        names = config["names"]
+        self.routes = build_routes(names)
+        self.names = names
+        if isinstance(self.collector, RTL433Collector):
+            self.collector.names = names
+        logger.info("Config reloaded: %d sensor names loaded", len(names))
+
+    def _get_mqtt(self, config):
+        return make_mqtt(config)
+
+    def _get_burst_filter(self, config):
+        dedupe = config.get("dedupe", False)
+        if not dedupe:
+            return None
+        if dedupe is True:
+            dedupe = {}
+        return BurstFilter(dedupe.get("window", 2.0), dedupe.get("size", 1024))
 
     def _get_collector(self, config):
         col = config.get("collector")
@@ -344,7 +1006,12 @@ class Dispatcher(object):
             if ctype == "rtl433":
                 # devices to limit to
                 devices = col.get("devices", None)
-                self.collector = RTL433Collector(devices)
+                self.collector = RTL433Collector(
+                    devices,
+                    col.get("json"),
+                    config["names"],
+                    col.get("prefilter", True),
+                )
             elif ctype == "rfxcom":
                 device = col["device"]
                 self.collector = RFXCOMCollector(device)
@@ -354,56 +1021,55 @@ class Dispatcher(object):
             self.collector = RFXCOMCollector(device)
 
     def loopforever(self):
-
         for packet in self.collector:
             if packet is None:
                 continue
-            now = int(time.time())
-
-            logger.debug("%s", packet)
-
-            # we send barometer sensors twice
-            if packet.is_baro:
-                self.mqtt.send("barometer", packet.as_json(units="mbar", timestamp=now))
-
-            if packet.is_moist:
-                # The reading of the moisture packets goes flakey a bit, apply
-                # some basic boundary conditions to it.
-                if packet.data["moisture"] > 10 or packet.data["temp"] > 150:
-                    logger.warn(
-                        "Packet moisture data makes no sense: %s => %s"
-                        % (packet, packet.as_json())
-                    )
-                    continue
+            self.dispatch(packet)
 
-                with self._names_lock:
-                    name = self.names.get(packet.sensor_id)
-                if name:
-                    topic = "moisture/%s" % name
-                    self.mqtt.send(topic, packet.as_json(units=".", timestamp=now))
+    def dispatch(self, packet):
+        """Publish a single packet to all the topics it belongs on"""
+        if self.burst_filter and self.burst_filter.is_duplicate(packet):
+            logger.debug("Dropping repeat from %s", packet.sensor_id)
+            return
 
-            if packet.is_temp:
-                if packet.data["temp"] > MAX_TEMP or packet.data["temp"] < MIN_TEMP:
+        now = int(time.time())
+        route = self.routes.get(packet.sensor_id) or unknown_route(packet.sensor_id)
 
-                    logger.warn(
-                        "Packet temp data makes no sense: %s => %s"
-                        % (packet, packet.as_json())
-                    )
-                    continue
+        logger.debug("%s", packet)
 
-                with self._names_lock:
-                    name = self.names.get(packet.sensor_id)
-                if name:
-                    topic = "temperature/%s" % name
-                else:
-                    topic = "unknown/%s" % packet.sensor_id
-                self.mqtt.send(topic, packet.as_json(timestamp=now))
+        # we send barometer sensors twice
+        if packet.is_baro:
+            self.mqtt.send("barometer", packet, units="mbar", timestamp=now)
+
+        if packet.is_moist:
+            # The reading of the moisture packets goes flakey a bit, apply
+            # some basic boundary conditions to it.
+            if packet.moisture > route.max_moist or packet.temp > route.max_temp:
+                logger.warn(
+                    "Packet moisture data makes no sense: %s => %s"
+                    % (packet, packet.as_json())
+                )
+                return
+
+            if route.moisture:
+                self.mqtt.send(route.moisture, packet, units=".", timestamp=now)
 
-            if packet.is_wind:
-                self.mqtt.send("wind", packet.as_json(timestamp=now))
+        if packet.is_temp:
+            if packet.temp > route.max_temp or packet.temp < route.min_temp:
 
-            if packet.is_rain:
-                self.mqtt.send("rain", packet.as_json(timestamp=now))
+                logger.warn(
+                    "Packet temp data makes no sense: %s => %s"
+                    % (packet, packet.as_json())
+                )
+                return
+
+            self.mqtt.send(route.temperature, packet, timestamp=now)
+
+        if packet.is_wind:
+            self.mqtt.send("wind", packet, timestamp=now)
+
+        if packet.is_rain:
+            self.mqtt.send("rain", packet, timestamp=now)
 
 
 class ConfigWatcher:
@@ -424,6 +1090,16 @@ class ConfigWatcher:
         self._observer.join()
 
 
+def reload_config(config_path, dispatcher):
+    """Re-read config_path and hand it to the dispatcher"""
+    try:
+        with open(config_path, "r") as f:
+            config = yaml.safe_load(f)
+        dispatcher.reload(config)
+    except Exception:
+        logger.exception("Failed to reload config from %s", config_path)
+
+
 class _ConfigFileHandler(FileSystemEventHandler):
     def __init__(self, config_path, dispatcher):
         self._config_path = config_path
@@ -432,19 +1108,9 @@ class _ConfigFileHandler(FileSystemEventHandler):
     def on_modified(self, event):
         if event.src_path != self._config_path:
             return
-        try:
-            with open(self._config_path, "r") as f:
-                config = yaml.safe_load(f)
-            self._dispatcher.reload(config)
-        except Exception:
-            logger.exception("Failed to reload config from %s", self._config_path)
+        reload_config(self._config_path, self._dispatcher)
 
     def on_moved(self, event):
         if event.dest_path != self._config_path:
             return
-        try:
-            with open(self._config_path, "r") as f:
-                config = yaml.safe_load(f)
-            self._dispatcher.reload(config)
-        except Exception:
-            logger.exception("Failed to reload config from %s", self._config_path)
+        reload_config(self._config_path, self._dispatcher)
@@ -0,0 +1,96 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Publishing to more than one broker.
+
+`mqtt: brokers:` lists extra brokers that get everything the main one
+does, each through an MQTT client of its own.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def broker_configs(config):
+    """The (server, port, config) of each broker to publish to
+
+    The first is the mqtt section itself, followed by one for each entry
+    of mqtt: brokers:. Those inherit the rest of the mqtt section, apart
+    from the spool, which needs a path of its own, and don't subscribe.
+    """
+    mqtt = dict(config["mqtt"])
+    extras = mqtt.pop("brokers", None) or []
+    brokers = [(mqtt["server"], mqtt.get("port", 1883), dict(config, mqtt=mqtt))]
+    for extra in extras:
+        options = {k: v for k, v in mqtt.items() if k != "spool"}
+        options.update(extra)
+        options["subscribe"] = False
+        brokers.append(
+            (options["server"], options.get("port", 1883), dict(config, mqtt=options))
+        )
+    return brokers
+
+
+class Fanout(object):
+    """Publishes everything to several brokers
+
+    Each broker has its own MQTT client, with its own connection, paho
+    queue, coalescer, spool and stats, so a slow or unreachable broker
+    only holds up itself. The first broker is the primary one, it's the
+    only one subscribed, and the messages its handlers send go to every
+    broker.
+    """
+
+    def __init__(self, brokers):
+        self.brokers = brokers
+        self.primary = brokers[0]
+        self.root = self.primary.root
+        self.config = self.primary.config
+        self.primary.handler_client = self
+
+    @property
+    def client(self):
+        return self.primary.client
+
+    @property
+    def stats(self):
+        return self.primary.stats
+
+    def send(self, topic, payload, retain=False, **extra):
+        for broker in self.brokers:
+            try:
+                broker.send(topic, payload, retain, **extra)
+            except Exception:
+                logger.exception("Failed to publish %s to %s", topic, broker.server)
+
+    def flush(self, everything=False):
+        for broker in self.brokers:
+            if broker.coalescer:
+                broker.flush(everything)
+
+    def reconnect(self):
+        for broker in self.brokers:
+            broker.reconnect()
+
+    def stop(self):
+        for broker in self.brokers:
+            broker.stop()
+
+    def health(self):
+        """The health of each broker, keyed by server:port"""
+        return {
+            "%s:%s" % (broker.server, broker.port): broker.health()
+            for broker in self.brokers
+        }
@@ -12,13 +12,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import datetime
+import collections
 import logging
-import re
-import urllib.parse as urllib
-import urllib.request as request
+import threading
+import time
 
-import arwn
+from arwn import wunderground
+from arwn.days import DayTracker
+from arwn.state import StateStore
+from arwn.stats import Latencies
+from arwn.topics import TopicRouter
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +29,18 @@ LAST_RAIN_TOTAL = None
 LAST_RAIN = None
 PREV_RAIN = None
 HANDLERS = []
+ROUTER = None
+# where the rain state is kept across restarts, if anywhere
+STATE = None
+# The rain readings change with every packet, they're saved at most
+# this often, and on shutdown, to spare the SD card. A new total is
+# saved straight away.
+SAVE_INTERVAL = 600.0
+# when the state was last saved, and if it has changed since
+SAVED_AT = None
+UNSAVED = False
+
+HPA_TO_INHG = 0.0295301
 
 """Handlers are a way to put statefullness and logic into the MQTT bus
 itself. ARWN monitors the root topic, and can react to messages to do
@@ -43,39 +58,126 @@ underground, or to do the rain totals calculations."""
 # 3. Set LAST_RAIN to new rain.
 
 
+def load_state():
+    global LAST_RAIN_TOTAL, LAST_RAIN, PREV_RAIN
+    state = STATE.load()
+    LAST_RAIN_TOTAL = state.get("last_rain_total")
+    LAST_RAIN = state.get("last_rain")
+    PREV_RAIN = state.get("prev_rain")
+    if state:
+        logger.info("Loaded rain state from %s", STATE.path)
+
+
+def save_state(force=False):
+    """Save the rain state, unless it was saved SAVE_INTERVAL ago or less"""
+    global SAVED_AT, UNSAVED
+    if STATE is None:
+        return
+    now = time.monotonic()
+    if not force and SAVED_AT is not None and now - SAVED_AT < SAVE_INTERVAL:
+        UNSAVED = True
+        return
+    STATE.save(
+        {
+            "last_rain_total": LAST_RAIN_TOTAL,
+            "last_rain": LAST_RAIN,
+            "prev_rain": PREV_RAIN,
+        }
+    )
+    SAVED_AT = now
+    UNSAVED = False
+
+
+def flush_state():
+    """Save whatever save_state held back"""
+    if UNSAVED:
+        save_state(force=True)
+
+
+def is_newer(a, b):
+    """If payload a has a later timestamp than payload b"""
+    if not a or not b:
+        return False
+    if a.get("timestamp") is None or b.get("timestamp") is None:
+        return False
+    return a["timestamp"] > b["timestamp"]
+
+
+def make_router(handlers):
+    """A TopicRouter from each handler's topics, or its regex"""
+    router = TopicRouter()
+    for handler in handlers:
+        for topic_filter in handler.topics:
+            router.add(topic_filter, handler)
+        if handler.regex:
+            router.add_pattern(handler.regex, handler)
+    return router
+
+
 class MQTTAction(object):
+    # MQTT topic filters (with + and # wildcards) to run for, and/or a
+    # regex for anything a filter can't express
+    topics = ()
     regex = None
+    # Handlers in the same lane run one at a time, in the order the
+    # messages came in, see HandlerPool. None is a lane named after the
+    # handler class.
+    lane = None
+    _router = None
 
     def action(self, topic, payload):
         pass
 
+    def stop(self):
+        """Release anything the handler holds on to, see setup"""
+
+    def handle(self, client, topic, payload):
+        try:
+            self.action(client, topic, payload)
+        except Exception as e:
+            logger.error(e)
+
     def run(self, client, topic, payload):
-        if self.regex and re.search(self.regex, topic):
-            try:
-                self.action(client, topic, payload)
-            except Exception as e:
-                logger.error(e)
+        """Handle the message if it's for this handler
+
+        handlers.run routes messages for all the handlers at once,
+        this is for running one on its own.
+        """
+        if self._router is None:
+            self._router = make_router([self])
+        if self._router.route(topic):
+            self.handle(client, topic, payload)
 
 
 class RecordRainTotal(MQTTAction):
-    regex = r"^\w+/totals/rain$"
+    topics = ("+/totals/rain",)
+    lane = "rain"
 
     def action(self, client, topic, payload):
         global LAST_RAIN_TOTAL
+        # The retained total the broker has after a restart can be older
+        # than the saved one, keep the newer one and put the broker right.
+        if is_newer(LAST_RAIN_TOTAL, payload):
+            client.send("totals/rain", LAST_RAIN_TOTAL, retain=True)
+            return
         LAST_RAIN_TOTAL = payload
+        save_state(force=True)
 
 
 class UpdateTodayRain(MQTTAction):
-    regex = r"^\w+/rain$"
+    topics = ("+/rain",)
+    lane = "rain"
 
     def action(self, client, topic, payload):
         global LAST_RAIN, PREV_RAIN
         PREV_RAIN = LAST_RAIN or payload
         LAST_RAIN = payload
+        save_state()
 
 
 class InitializeLastRainIfNotThere(MQTTAction):
-    regex = r"^\w+/rain$"
+    topics = ("+/rain",)
+    lane = "rain"
 
     def action(self, client, topic, payload):
         global LAST_RAIN_TOTAL
@@ -84,25 +186,30 @@ class InitializeLastRainIfNotThere(MQTTAction):
 
 
 class ComputeRainTotal(MQTTAction):
-    regex = r"^\w+/"
+    topics = ("+/#",)
+    lane = "rain"
     ts = None
     topic = None
 
+    def __init__(self, timezone=None):
+        super(ComputeRainTotal, self).__init__()
+        # one for the incoming messages and one for the total, so each
+        # only works a day out again when its own day changes
+        self.days = DayTracker(timezone)
+        self.total_days = DayTracker(timezone)
+
     def is_rollover(self, ts):
         # the last day we're keeping state for
         global LAST_RAIN_TOTAL
-        return not self.is_sameday(ts, LAST_RAIN_TOTAL["timestamp"])
+        return self.days.day(ts) != self.total_days.day(LAST_RAIN_TOTAL["timestamp"])
 
     def is_sameday(self, ts1, ts2):
-        d1 = datetime.datetime.fromtimestamp(ts1).strftime("%j")
-        d2 = datetime.datetime.fromtimestamp(ts2).strftime("%j")
-        delta_days = int(d1) - int(d2)
-        return delta_days == 0
+        return self.days.is_sameday(ts1, ts2)
 
     def should_proceed(self, topic, payload):
         # don't retrigger on our own topic that we know we are sending
         # on.
-        if re.search("rain/today", topic) or re.search("totals/rain", topic):
+        if topic.endswith(("/rain/today", "/totals/rain")):
             return False
 
         # we do want to trigger on any timestamped message
@@ -118,7 +225,8 @@ class ComputeRainTotal(MQTTAction):
 
     def yesterdays_totals(self):
         global PREV_RAIN, LAST_RAIN, LAST_RAIN_TOTAL
-        if self.is_sameday(LAST_RAIN_TOTAL["timestamp"], LAST_RAIN["timestamp"]):
+        total_day = self.total_days.day(LAST_RAIN_TOTAL["timestamp"])
+        if total_day == self.days.day(LAST_RAIN["timestamp"]):
             total = LAST_RAIN
         else:
             total = PREV_RAIN
@@ -148,7 +256,8 @@ class ComputeRainTotal(MQTTAction):
 
 
 class TodaysRain(MQTTAction):
-    regex = r"^\w+/rain$"
+    topics = ("+/rain",)
+    lane = "rain"
 
     def action(self, client, topic, payload):
         global LAST_RAIN_TOTAL
@@ -164,114 +273,229 @@ class TodaysRain(MQTTAction):
 
 
 class WeatherUnderground(MQTTAction):
-    regex = r"^\w+/(wind|temperature/Outside|rain/today|barometer)$"
-    temp = None
-    dewpoint = None
-    rain = 0
-    pressure = None
-    winddir = 0
-    windspeed = 0
-    windgust = 0
-
-    def is_ready(self):
-        return (
-            self.temp is not None
-            and self.dewpoint is not None
-            and self.rain is not None
-            and self.winddir is not None
-            and self.windspeed is not None
-            and self.windgust is not None
-        )  # noqa
+    topics = ("+/wind", "+/temperature/Outside", "+/rain/today", "+/barometer")
+    uploader = None
 
     def action(self, client, topic, payload):
+        if self.uploader is None:
+            config = client.config.get("wunderground")
+            if not config:
+                return
+            self.uploader = wunderground.Uploader.from_config(config)
+        fields = {}
         if "wind" in topic:
-            self.winddir = payload["direction"]
-            self.windspeed = payload["speed"]
-            self.windgust = payload["gust"]
+            fields.update(
+                winddir=payload["direction"],
+                windspeedmph=payload["speed"],
+                windgustmph=payload["gust"],
+            )
         if "temperature" in topic:
-            self.temp = payload["temp"]
-            self.dewpoint = payload["dewpoint"]
-            self.humid = payload["humid"]
-        if "barometer" in topic:
-            self.pressure = payload["pressure"]
+            fields.update(
+                tempf=payload["temp"],
+                dewptf=payload["dewpoint"],
+                humidity=payload["humid"],
+            )
+        if "barometer" in topic and payload["pressure"]:
+            fields["baromin"] = payload["pressure"] * HPA_TO_INHG
         if "rain" in topic:
-            self.rain = payload["since_midnight"]
+            fields["dailyrainin"] = payload["since_midnight"]
 
-        if self.is_ready():
-            self.send_to_wunderground(client)
-        else:
-            logger.info("Wunderground not ready yet: %s" % self)
+        # uploaded from the uploader's thread, once per interval at most
+        self.uploader.submit(**fields)
+        if not self.uploader.observation.ready():
+            logger.info("Wunderground not ready yet: %s", self.uploader.observation)
 
-    def send_to_wunderground(self, client):
-        hpa2inhg = 0.0295301
-        BASEURL = (
-            "http://weatherstation.wunderground.com/"
-            "weatherstation/updateweatherstation.php"
-        )
-        data = {
-            "ID": client.config["wunderground"]["station"],
-            "PASSWORD": client.config["wunderground"]["passwd"],
-            "dateutc": "now",
-            "action": "updateraw",
-            "software": "arwn %s" % (arwn.__version__),
-            "tempf": self.temp,
-            "dewptf": self.dewpoint,
-            "humidity": self.humid,
-            "dailyrainin": self.rain,
-            "winddir": self.winddir,
-            "windspeedmph": self.windspeed,
-            "windgustmph": self.windgust,
-        }
-
-        if self.pressure:
-            data["baromin"] = self.pressure * hpa2inhg
-
-        params = urllib.urlencode(data)
-        resp = request.urlopen("%s?%s" % (BASEURL, params))
-        logger.info(
-            "Reported to WUnderground: %(tempf)sF / %(dewptf)sF - "
-            "%(dailyrainin)sin - "
-            "%(windgustmph)smph / %(windspeedmph)smph %(winddir)s",
-            data,
-        )
-
-        if resp.getcode() != 200:
-            logger.error(
-                "Failed to upload to wunderground: %s - %s" % (params, resp.info())
-            )
+    def stop(self):
+        if self.uploader is not None:
+            self.uploader.stop(timeout=0)
 
     def __repr__(self):
-        return (
-            "Wunderground((temp: %s, dewpoint: %s, rain: %s "
-            "pressure: %s, winddir: %s, windspeed: %s, windgust: %s))"
-            % (
-                self.temp,
-                self.dewpoint,
-                self.rain,
-                self.pressure,
-                self.winddir,
-                self.windspeed,
-                self.windgust,
-            )
-        )
+        return "Wunderground(%s)" % (self.uploader and self.uploader.observation)
 
 
-def setup():
-    global LAST_RAIN_TOTAL, LAST_RAIN, PREV_RAIN, HANDLERS
+def setup(state_path=None, timezone=None):
+    """Set up the handlers, with the rain state saved in state_path
+
+    Rain days run midnight to midnight in timezone, or local time.
+    """
+    global LAST_RAIN_TOTAL, LAST_RAIN, PREV_RAIN, HANDLERS, ROUTER, STATE
+    global SAVED_AT, UNSAVED
+    for h in HANDLERS:
+        h.stop()
+    flush_state()
     LAST_RAIN_TOTAL = None  # noqa
     LAST_RAIN = None  # noqa
     PREV_RAIN = None  # noqa
+    STATE = None
+    SAVED_AT = None
+    UNSAVED = False
+    if state_path:
+        STATE = StateStore(state_path)
+        load_state()
     HANDLERS = [
         RecordRainTotal(),
         UpdateTodayRain(),
         InitializeLastRainIfNotThere(),
-        ComputeRainTotal(),
+        ComputeRainTotal(timezone),
         TodaysRain(),
         WeatherUnderground(),
     ]
+    ROUTER = make_router(HANDLERS)
 
 
 def run(client, topic, payload):
-    global HANDLERS
-    for h in HANDLERS:
-        h.run(client, topic, payload)
+    # only the handlers for this topic, in the order they were set up
+    for h in ROUTER.route(topic):
+        h.handle(client, topic, payload)
+
+
+# What HandlerPool does with a message for a full lane
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+
+class _Lane(object):
+    """A bounded queue of messages worked through by one thread"""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.max_depth = 0
+        self.dropped = 0
+        self.thread = threading.Thread(
+            target=self._work, name="handlers-%s" % name, daemon=True
+        )
+        self.thread.start()
+
+    def put(self, item):
+        pool = self.pool
+        with self.cond:
+            if len(self.queue) >= pool.queue_size:
+                if pool.overflow == "drop_newest":
+                    self.dropped += 1
+                    return
+                if pool.overflow == "drop_oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif threading.current_thread() is not self.thread:
+                    while len(self.queue) >= pool.queue_size:
+                        self.cond.wait()
+                # else a handler in this lane sending to it, which would wait
+                # on itself, the queue goes over size instead
+            self.queue.append(item)
+            if len(self.queue) > self.max_depth:
+                self.max_depth = len(self.queue)
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                item = self.queue.popleft()
+                self.cond.notify_all()
+            if item is None:
+                return
+            self.pool._run(*item)
+
+    def stop(self, timeout=None):
+        with self.cond:
+            self.queue.append(None)
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+
+class HandlerPool(object):
+    """Runs the handlers on worker threads, off the MQTT network thread
+
+    Every lane (see MQTTAction.lane) gets a thread and a queue of at
+    most queue_size messages, so a slow handler, like the Weather
+    Underground upload, only holds up its own lane, and the handlers in
+    a lane see messages in the order they came in. When a lane is full
+    the overflow policy either drops its oldest message, drops the new
+    one, or blocks the caller until there's room.
+    """
+
+    def __init__(self, queue_size=1000, overflow="drop_oldest", clock=time.monotonic):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                "Unknown overflow policy %s, expected one of %s"
+                % (overflow, ", ".join(OVERFLOW_POLICIES))
+            )
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.clock = clock
+        self.lanes = {}
+        # route => ((lane, handlers), ...)
+        self._plans = {}
+        self._lock = threading.Lock()
+        self.handled = 0
+        self.latencies = collections.defaultdict(Latencies)
+
+    def _lane(self, handler):
+        name = handler.lane or type(handler).__name__
+        lane = self.lanes.get(name)
+        if lane is None:
+            with self._lock:
+                lane = self.lanes.get(name)
+                if lane is None:
+                    lane = self.lanes[name] = _Lane(self, name)
+        return lane
+
+    def _plan(self, route):
+        plan = self._plans.get(route)
+        if plan is None:
+            by_lane = {}
+            for handler in route:
+                by_lane.setdefault(self._lane(handler), []).append(handler)
+            plan = tuple((lane, tuple(hs)) for lane, hs in by_lane.items())
+            if len(self._plans) >= 1024:
+                self._plans.clear()
+            self._plans[route] = plan
+        return plan
+
+    def submit(self, client, topic, payload):
+        """Queue a message for the handlers of its topic"""
+        now = self.clock()
+        for lane, handlers in self._plan(ROUTER.route(topic)):
+            lane.put((handlers, client, topic, payload, now))
+
+    def _run(self, handlers, client, topic, payload, queued):
+        start = self.clock()
+        with self._lock:
+            self.latencies["queued"].add(start - queued)
+        for h in handlers:
+            h.handle(client, topic, payload)
+            done = self.clock()
+            with self._lock:
+                self.latencies[type(h).__name__].add(done - start)
+            start = done
+        with self._lock:
+            self.handled += 1
+
+    @property
+    def queue_depth(self):
+        return sum(len(lane.queue) for lane in list(self.lanes.values()))
+
+    def snapshot(self):
+        """Queue depths, drops, and queued and per handler time in ms"""
+        lanes = {
+            name: {
+                "queue_depth": len(lane.queue),
+                "max_queue_depth": lane.max_depth,
+                "dropped": lane.dropped,
+            }
+            for name, lane in list(self.lanes.items())
+        }
+        with self._lock:
+            latency = {
+                name: samples.snapshot() for name, samples in self.latencies.items()
+            }
+            handled = self.handled
+        return {"handled": handled, "lanes": lanes, "latency_ms": latency}
+
+    def stop(self, timeout=5.0):
+        """Finish the queued messages and stop the threads"""
+        for lane in list(self.lanes.values()):
+            lane.stop(timeout)
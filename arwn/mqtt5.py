@@ -0,0 +1,89 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""MQTT v5 publish properties.
+
+With `mqtt: version: 5` topics are sent as topic aliases once the
+broker knows them, and publishes carry a message expiry and the
+sensor_id as a user property.
+"""
+
+import functools
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+
+class TopicAliases(object):
+    """The topic aliases of one MQTT v5 connection
+
+    Topics get the next free alias the first time they are sent, until
+    the broker's maximum is reached. Sensors report on a fixed set of
+    topics, so those end up with the aliases.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.aliases = {}
+
+    def get(self, topic):
+        """The (topic, alias) to send, topic is "" once the alias is set"""
+        alias = self.aliases.get(topic)
+        if alias is not None:
+            return "", alias
+        if len(self.aliases) < self.maximum:
+            alias = len(self.aliases) + 1
+            self.aliases[topic] = alias
+        return topic, alias
+
+
+class PublishProperties(Properties):
+    """MQTT v5 PUBLISH properties that are only packed once
+
+    Building and packing paho's Properties costs more than the rest of
+    a publish, these are cached and never changed once built.
+    """
+
+    def __init__(self):
+        super(PublishProperties, self).__init__(PacketTypes.PUBLISH)
+
+    def pack(self):
+        packed = self.__dict__.get("_packed")
+        if packed is None:
+            packed = super(PublishProperties, self).pack()
+            object.__setattr__(self, "_packed", packed)
+        return packed
+
+
+def publish_properties(alias=None, sensor_id=None, expiry=None):
+    """The v5 properties of a publish, or None when there aren't any
+
+    sensor_id is left out unless it's a non empty string, a packet
+    without an id has 0, which a user property can't carry.
+    """
+    if not isinstance(sensor_id, str):
+        sensor_id = None
+    if alias is None and not sensor_id and not expiry:
+        return None
+    props = PublishProperties()
+    if alias is not None:
+        props.TopicAlias = alias
+    if sensor_id:
+        props.UserProperty = ("sensor_id", sensor_id)
+    if expiry:
+        props.MessageExpiryInterval = int(expiry)
+    return props
+
+
+cached_publish_properties = functools.lru_cache(maxsize=1024)(publish_properties)
@@ -0,0 +1,117 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Durable outbound message spool.
+
+While the broker can't be reached, encoded messages are written to a
+SQLite database in WAL mode instead of piling up in paho's memory. They
+survive a restart, and are replayed oldest first once the connection
+comes back. The payloads are stored as they were encoded, so they keep
+the timestamps of when they were read.
+"""
+
+import collections
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    retain INTEGER NOT NULL,
+    created REAL NOT NULL,
+    sensor_id TEXT
+)
+"""
+
+Message = collections.namedtuple(
+    "Message", ["id", "topic", "payload", "retain", "created", "sensor_id"]
+)
+
+
+class Spool(object):
+    """A bounded FIFO of (topic, payload, retain) kept on disk
+
+    When it holds max_messages the oldest messages are dropped to make
+    room, the newest readings are the ones worth keeping.
+    """
+
+    def __init__(self, path, max_messages=100000):
+        self.path = path
+        self.max_messages = max_messages
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL only risks the last transactions on power loss,
+        # never corruption, and doesn't fsync on every message
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+        self._size = self._db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        if self._size:
+            logger.info("Spool %s has %d messages to send", path, self._size)
+
+    def __len__(self):
+        return self._size
+
+    def put(self, topic, payload, retain=False, sensor_id=None):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO spool (topic, payload, retain, created, sensor_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (topic, payload, int(retain), time.time(), sensor_id),
+            )
+            self._size += 1
+            if self._size > self.max_messages:
+                extra = self._size - self.max_messages
+                self._db.execute(
+                    "DELETE FROM spool WHERE id IN "
+                    "(SELECT id FROM spool ORDER BY id LIMIT ?)",
+                    (extra,),
+                )
+                self._size -= extra
+                if not self.dropped:
+                    logger.warning(
+                        "Spool %s is full, dropping the oldest messages", self.path
+                    )
+                self.dropped += extra
+
+    def peek(self, count=100):
+        """The oldest count messages, as Messages"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, topic, payload, retain, created, sensor_id FROM spool "
+                "ORDER BY id LIMIT ?",
+                (count,),
+            ).fetchall()
+        return [
+            Message(i, topic, bytes(payload), bool(retain), created, sensor_id)
+            for i, topic, payload, retain, created, sensor_id in rows
+        ]
+
+    def remove(self, msg_id):
+        with self._lock:
+            cur = self._db.execute("DELETE FROM spool WHERE id = ?", (msg_id,))
+            self._size -= cur.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
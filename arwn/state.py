@@ -0,0 +1,63 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A small on disk store for handler state.
+
+The rain totals are worked out from the last few rain readings, which
+would otherwise be lost on a restart. The state is saved as JSON by
+writing a temporary file next to it and renaming it over the old one,
+so a crash leaves either the old state or the new one, never half of
+each.
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """The saved state, or {} if there isn't any usable"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logger.exception("Can't read the state in %s, starting afresh", self.path)
+            return {}
+        if not isinstance(state, dict):
+            logger.error("Ignoring the state in %s, it's not an object", self.path)
+            return {}
+        return state
+
+    def save(self, state):
+        tmp = "%s.tmp" % self.path
+        try:
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except (OSError, TypeError, ValueError):
+            logger.exception("Failed to save the state to %s", self.path)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
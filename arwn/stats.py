@@ -0,0 +1,135 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Latency percentiles and publish counters for the runtime stats."""
+
+import collections
+import threading
+import time
+
+import paho.mqtt.client as paho
+
+
+class Latencies(object):
+    """The most recent durations, in seconds, for percentiles
+
+    Not thread safe, callers that add from several threads lock around
+    it.
+    """
+
+    def __init__(self, samples=1024):
+        self.samples = collections.deque(maxlen=samples)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def snapshot(self):
+        """p50, p90, p99 and max in ms, empty when there are no samples"""
+        samples = sorted(self.samples)
+        if not samples:
+            return {}
+        last = len(samples) - 1
+        latency = {
+            "p%d" % p: samples[min(last, len(samples) * p // 100)] for p in (50, 90, 99)
+        }
+        latency["max"] = samples[-1]
+        return {k: round(v * 1000, 3) for k, v in latency.items()}
+
+
+class PublishStats(object):
+    """Counters for what's been handed to paho and what's gone out
+
+    A message is queued from publish() until paho's on_publish for it,
+    which for QoS 0 is when it's written to the socket and for QoS 1
+    and 2 when the broker has acknowledged it. The queue depth and the
+    time messages spend queued show when the broker can't keep up.
+
+    A publish paho doesn't accept (no connection, its queue is full) is
+    counted as failed and not queued. Whatever is still queued when the
+    connection drops is counted as dropped and forgotten, paho either
+    throws it away or resends it under a mid it may reuse.
+    """
+
+    # how long an on_publish that beat publish() returning is kept
+    EARLY_WINDOW = 1.0
+
+    def __init__(self, samples=1024, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        # mid => when it was published
+        self.queued = {}
+        # on_publish can beat publish() returning the mid, mid => when
+        self.early = {}
+        self.latencies = Latencies(samples)
+        self.published = 0
+        self.acked = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self):
+        return len(self.queued)
+
+    def sent(self, info):
+        if info.rc != paho.MQTT_ERR_SUCCESS:
+            with self.lock:
+                self.failed += 1
+            return
+        now = self.clock()
+        with self.lock:
+            self.published += 1
+            acked = self.early.pop(info.mid, None)
+            if acked is not None and now - acked < self.EARLY_WINDOW:
+                self.acked += 1
+                self.latencies.add(0.0)
+                return
+            self.queued[info.mid] = now
+            if len(self.queued) > self.max_queue_depth:
+                self.max_queue_depth = len(self.queued)
+
+    def ack(self, mid):
+        now = self.clock()
+        with self.lock:
+            sent = self.queued.pop(mid, None)
+            if sent is None:
+                if len(self.early) > 1024:
+                    self.early.clear()
+                self.early[mid] = now
+                return
+            self.acked += 1
+            self.latencies.add(now - sent)
+
+    def disconnected(self):
+        """Forget what was queued on a connection that has gone"""
+        with self.lock:
+            self.dropped += len(self.queued)
+            self.queued.clear()
+            self.early.clear()
+
+    def snapshot(self):
+        """The counters, and queued time percentiles in ms, as a dict"""
+        with self.lock:
+            return {
+                "published": self.published,
+                "acked": self.acked,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "queue_depth": len(self.queued),
+                "max_queue_depth": self.max_queue_depth,
+                "latency_ms": self.latencies.snapshot(),
+            }
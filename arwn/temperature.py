@@ -15,6 +15,11 @@
 import math
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 regex = r"(-?\d+(\.\d+)?)(F|C|K)"
 
 # The scale factor between C and F
@@ -31,6 +36,96 @@ a = 17.271
 b = 237.7  # degC
 
 
+def c_to_f(temp):
+    return (temp * CScale) + FOffset
+
+
+def f_to_c(temp):
+    return (temp - FOffset) / CScale
+
+
+def c_to_k(temp):
+    return temp + KOffset
+
+
+def k_to_c(temp):
+    return temp - KOffset
+
+
+def f_to_k(temp):
+    return c_to_k(f_to_c(temp))
+
+
+def k_to_f(temp):
+    return c_to_f(k_to_c(temp))
+
+
+def _magnus(temp, humid, log):
+    gamma = (a * temp / (b + temp)) + log(humid / 100.0)
+    return (b * gamma) / (a - gamma)
+
+
+def dewpoint_c(temp, humid):
+    """Dewpoint in C for a temperature in C and relative humidity in %
+
+    Uses the Magnus formula.
+    """
+    return _magnus(temp, humid, math.log)
+
+
+# (from, to) => conversion function
+_CONVERSIONS = {
+    ("C", "F"): c_to_f,
+    ("F", "C"): f_to_c,
+    ("C", "K"): c_to_k,
+    ("K", "C"): k_to_c,
+    ("F", "K"): f_to_k,
+    ("K", "F"): k_to_f,
+}
+
+
+def _identity(temp):
+    return temp
+
+
+def convert_many(temps, from_units, to_units):
+    """Convert a sequence of temperatures between C, F and K
+
+    Returns a numpy array when numpy is installed, a list otherwise.
+    """
+    if from_units == to_units:
+        convert = _identity
+    else:
+        convert = _CONVERSIONS[(from_units, to_units)]
+    if numpy is not None:
+        return convert(numpy.asarray(temps, dtype=float))
+    return [convert(float(t)) for t in temps]
+
+
+def dewpoint_many(temps, humids, units="C"):
+    """Dewpoints for sequences of temperatures and relative humidities
+
+    The temperatures and the dewpoints are both in units. Returns a numpy
+    array when numpy is installed, a list otherwise.
+    """
+    temps = convert_many(temps, units, "C")
+    if numpy is not None:
+        humids = numpy.asarray(humids, dtype=float)
+        # numpy would broadcast a single humidity, or fail obscurely
+        if humids.shape != numpy.shape(temps):
+            raise ValueError(
+                "Got %d temperatures and %s humidities" % (len(temps), humids.size)
+            )
+        return convert_many(_magnus(temps, humids, numpy.log), "C", units)
+    humids = list(humids)
+    if len(temps) != len(humids):
+        raise ValueError(
+            "Got %d temperatures and %d humidities" % (len(temps), len(humids))
+        )
+    dewpoints = [dewpoint_c(t, h) for t, h in zip(temps, humids)]
+    return convert_many(dewpoints, "C", units)
+
+
 class Temperature(object):
     units = "F"
     temp = 0.0
@@ -40,6 +135,26 @@ class Temperature(object):
         self.temp = float(m.group(1))
         self.units = m.group(3)
 
+    @classmethod
+    def from_value(cls, temp, units):
+        """Build a Temperature from a number, without parsing a string"""
+        t = cls.__new__(cls)
+        t.temp = float(temp)
+        t.units = units
+        return t
+
+    @classmethod
+    def from_c(cls, temp):
+        return cls.from_value(temp, "C")
+
+    @classmethod
+    def from_f(cls, temp):
+        return cls.from_value(temp, "F")
+
+    @classmethod
+    def from_k(cls, temp):
+        return cls.from_value(temp, "K")
+
     def __str__(self):
         return "%f%s" % (self.temp, self.units)
 
@@ -55,24 +170,10 @@ class Temperature(object):
     def _convert_to(self, unit):
         if unit == self.units:
             return self.temp
-
-        if unit == "C":
-            if self.is_F():
-                return (self.temp - FOffset) / CScale
-            elif self.is_K():
-                return self.temp + KOffset
-        elif unit == "F":
-            if self.is_C():
-                return (self.temp * CScale) + FOffset
-            elif self.is_K():
-                return ((self.temp + KOffset) * CScale) + FOffset
-        elif unit == "K":
-            if self.is_F():
-                return ((self.temp - FOffset) / CScale) + KOffset
-            elif self.is_C():
-                return self.temp - KOffset
-
-        return self.temp
+        convert = _CONVERSIONS.get((self.units, unit))
+        if convert is None:
+            return self.temp
+        return convert(self.temp)
 
     def to_C(self):
         return self._convert_to("C")
@@ -84,24 +185,14 @@ class Temperature(object):
         return self._convert_to("K")
 
     def as_C(self):
-        temp = self._convert_to("C")
-        return Temperature("%fC" % temp)
+        return Temperature.from_c(self._convert_to("C"))
 
     def as_F(self):
-        temp = self._convert_to("F")
-        return Temperature("%fF" % temp)
+        return Temperature.from_f(self._convert_to("F"))
 
     def as_K(self):
-        temp = self._convert_to("K")
-        return Temperature("%fK" % temp)
+        return Temperature.from_k(self._convert_to("K"))
 
-    # TODO(sdague): unit tests
     def dewpoint(self, humid):
-        def _gamma(t, humid):
-            return (a * t / (b + t)) + math.log(humid / 100.0)
-
-        t = self.as_C()
-        T = t.temp
-        t.temp = (b * _gamma(T, humid)) / (a - _gamma(T, humid))
-
-        return t._convert_to(self.units)
+        dewpoint = Temperature.from_c(dewpoint_c(self.to_C(), humid))
+        return dewpoint._convert_to(self.units)
@@ -0,0 +1,131 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Helpers for per topic settings and routing."""
+
+import re
+
+# Results are cached per topic, this bounds the cache
+CACHE_SIZE = 1024
+
+
+class PrefixMap(object):
+    """Look up a value by the longest topic prefix it was set for
+
+    Prefixes match whole topic levels, so "arwn/temperature" matches
+    "arwn/temperature/Outside" but not "arwn/temperatures". Topics that
+    match no prefix get default.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.prefixes = {}
+        self._cache = {}
+
+    def __setitem__(self, prefix, value):
+        self.prefixes[prefix.rstrip("/")] = value
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def items(self):
+        return self.prefixes.items()
+
+    def get(self, topic):
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        value = self.default
+        level = topic
+        while level:
+            if level in self.prefixes:
+                value = self.prefixes[level]
+                break
+            level = level.rpartition("/")[0]
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[topic] = value
+        return value
+
+
+class _Node(object):
+    __slots__ = ("children", "targets")
+
+    def __init__(self):
+        self.children = {}
+        self.targets = set()
+
+
+class TopicRouter(object):
+    """Find everything subscribed to a topic
+
+    Targets are added with MQTT topic filters, using the + and #
+    wildcards, which are indexed in a trie over the topic levels, or
+    with a regex for anything a filter can't express. route() returns
+    the targets for a topic in the order they were added, and is
+    cached per topic.
+    """
+
+    def __init__(self):
+        self.targets = []
+        self.root = _Node()
+        self.patterns = []
+        self._cache = {}
+
+    def _index(self, target):
+        self._cache.clear()
+        for i, known in enumerate(self.targets):
+            if known is target:
+                return i
+        self.targets.append(target)
+        return len(self.targets) - 1
+
+    def add(self, topic_filter, target):
+        index = self._index(target)
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.targets.add(index)
+
+    def add_pattern(self, regex, target):
+        self.patterns.append((re.compile(regex), self._index(target)))
+
+    def _match(self, node, levels, depth, found):
+        wildcard = node.children.get("#")
+        if wildcard is not None:
+            # "a/#" matches "a" as well as everything under it
+            found.update(wildcard.targets)
+        if depth == len(levels):
+            found.update(node.targets)
+            return
+        for level in (levels[depth], "+"):
+            child = node.children.get(level)
+            if child is not None:
+                self._match(child, levels, depth + 1, found)
+
+    def route(self, topic):
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        found = set()
+        self._match(self.root, topic.split("/"), 0, found)
+        found.update(index for regex, index in self.patterns if regex.search(topic))
+        targets = tuple(self.targets[i] for i in sorted(found))
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[topic] = targets
+        return targets
@@ -0,0 +1,311 @@
+# Copyright 2016 Sean Dague
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Background uploads to Weather Underground.
+
+The WeatherUnderground handler merges every reading into the
+uploader's Observation, which holds the newest value of everything
+that's reported. The Uploader sends it from its own thread, over a
+kept alive HTTP connection, at most once per interval. An unchanged
+observation is only sent again once a minute, often enough for the
+station not to show as offline. A failed upload is retried with
+exponential backoff.
+
+With rapidfire set the observation goes to the RapidFire real time
+server instead, every 2.5 seconds by default.
+"""
+
+import http.client
+import logging
+import threading
+import time
+import urllib.parse
+
+import arwn
+from arwn.stats import Latencies
+
+logger = logging.getLogger(__name__)
+
+URL = "http://weatherstation.wunderground.com/weatherstation/updateweatherstation.php"
+RAPIDFIRE_URL = (
+    "http://rtupdate.wunderground.com/weatherstation/updateweatherstation.php"
+)
+
+# the default seconds between uploads
+INTERVAL = 60.0
+RAPIDFIRE_INTERVAL = 2.5
+# the most seconds between uploads when nothing has changed
+REFRESH = 60.0
+
+
+class UploadError(Exception):
+    pass
+
+
+class Observation(object):
+    """The newest value of each field sent to Weather Underground"""
+
+    FIELDS = (
+        "tempf",
+        "dewptf",
+        "humidity",
+        "dailyrainin",
+        "winddir",
+        "windspeedmph",
+        "windgustmph",
+        "baromin",
+    )
+    __slots__ = FIELDS
+
+    def __init__(self):
+        self.tempf = None
+        self.dewptf = None
+        self.humidity = None
+        self.dailyrainin = 0
+        self.winddir = 0
+        self.windspeedmph = 0
+        self.windgustmph = 0
+        self.baromin = None
+
+    def update(self, **fields):
+        """Merge in new values, True if any of them changed"""
+        changed = False
+        for name, value in fields.items():
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed = True
+        return changed
+
+    def ready(self):
+        return self.tempf is not None and self.dewptf is not None
+
+    def params(self):
+        """The fields that have a value, as upload parameters"""
+        params = {}
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                params[name] = value
+        return params
+
+    def __repr__(self):
+        return "Observation(%s)" % ", ".join(
+            "%s: %s" % (name, getattr(self, name)) for name in self.FIELDS
+        )
+
+
+class Uploader(object):
+    """Sends the observation at most once per interval
+
+    When it hasn't changed it's only sent again after refresh seconds.
+
+    submit() never blocks on the network. The counters and upload
+    latency are in snapshot().
+    """
+
+    def __init__(
+        self,
+        station,
+        passwd,
+        url=URL,
+        interval=INTERVAL,
+        timeout=10.0,
+        backoff=5.0,
+        max_backoff=600.0,
+        rapidfire=False,
+        refresh=REFRESH,
+        clock=time.monotonic,
+    ):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == "https":
+            self._conn_class = http.client.HTTPSConnection
+        else:
+            self._conn_class = http.client.HTTPConnection
+        self.host = parts.netloc
+        self.path = parts.path or "/"
+        self.interval = interval
+        self.refresh = max(interval, refresh)
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.static = {
+            "ID": station,
+            "PASSWORD": passwd,
+            "dateutc": "now",
+            "action": "updateraw",
+            "software": "arwn %s" % arwn.__version__,
+        }
+        # every 2.5s is too often for info
+        self.log_level = logging.INFO
+        if rapidfire:
+            self.static.update(realtime=1, rtfreq=interval)
+            self.log_level = logging.DEBUG
+
+        self.observation = Observation()
+        self.uploads = 0
+        self.unchanged = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.connections = 0
+        self.latencies = Latencies()
+
+        self._conn = None
+        # requests sent on the current connection
+        self._requests = 0
+        # the observation has changed since it was last uploaded
+        self._dirty = False
+        self._next = 0.0
+        # when the last upload was started
+        self._uploaded = 0.0
+        self._running = True
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="wunderground", daemon=True
+        )
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, config):
+        rapidfire = config.get("rapidfire", False)
+        default_url = RAPIDFIRE_URL if rapidfire else URL
+        default_interval = RAPIDFIRE_INTERVAL if rapidfire else INTERVAL
+        return cls(
+            config["station"],
+            config["passwd"],
+            url=config.get("url", default_url),
+            interval=config.get("interval", default_interval),
+            timeout=config.get("timeout", 10.0),
+            rapidfire=rapidfire,
+        )
+
+    def submit(self, **fields):
+        """Merge new readings into the observation"""
+        with self._cond:
+            if self.observation.update(**fields):
+                self._dirty = True
+                self._cond.notify()
+            else:
+                self.unchanged += 1
+
+    def stop(self, timeout=5.0):
+        """Stop the thread, anything not uploaded yet is dropped"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _due(self):
+        if not self.observation.ready():
+            return None
+        due = self._next
+        if not self._dirty:
+            due = max(due, self._uploaded + self.refresh)
+        return due - self.clock()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    delay = self._due()
+                    if delay is not None and delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if not self._running:
+                    self._close()
+                    return
+                params = dict(self.static, **self.observation.params())
+                self._dirty = False
+
+            start = self.clock()
+            try:
+                self._upload(params)
+            except Exception as e:
+                self._failed(e)
+                continue
+            with self._cond:
+                self.latencies.add(self.clock() - start)
+                self.uploads += 1
+                self.consecutive_failures = 0
+                self._next = start + self.interval
+                self._uploaded = start
+            logger.log(
+                self.log_level,
+                "Reported to WUnderground: %sF / %sF - %sin - %smph / %smph %s",
+                params.get("tempf"),
+                params.get("dewptf"),
+                params.get("dailyrainin"),
+                params.get("windgustmph"),
+                params.get("windspeedmph"),
+                params.get("winddir"),
+            )
+
+    def _failed(self, error):
+        with self._cond:
+            self.failures += 1
+            self.consecutive_failures += 1
+            delay = min(
+                self.max_backoff, self.backoff * 2 ** (self.consecutive_failures - 1)
+            )
+            logger.error(
+                "Failed to upload to wunderground, retrying in %.0fs: %s", delay, error
+            )
+            # retried with whatever the observation is by then
+            self._dirty = True
+            self._next = self.clock() + delay
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _upload(self, params):
+        url = "%s?%s" % (self.path, urllib.parse.urlencode(params))
+        # A kept alive connection may have been closed by the server
+        # since the last upload, which only shows once it's used, so
+        # that gets one retry on a new connection.
+        retry = self._conn is not None and self._requests > 0
+        while True:
+            if self._conn is None:
+                self._conn = self._conn_class(self.host, timeout=self.timeout)
+                self._requests = 0
+                self.connections += 1
+            try:
+                self._conn.request("GET", url)
+                resp = self._conn.getresponse()
+                body = resp.read()
+            except (OSError, http.client.HTTPException):
+                self._close()
+                if retry:
+                    retry = False
+                    continue
+                raise
+            self._requests += 1
+            if resp.will_close:
+                self._close()
+            if resp.status != 200:
+                raise UploadError("%s %s: %r" % (resp.status, resp.reason, body))
+            return
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "uploads": self.uploads,
+                "unchanged": self.unchanged,
+                "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures,
+                "connections": self.connections,
+                "pending": self._dirty,
+                "latency_ms": self.latencies.snapshot(),
+            }
@@ -0,0 +1,61 @@
+"""Per-frame cost of the RFXtrx low level parser.
+
+Run from the top of the tree with::
+
+    python -m benchmarks.bench_lowlevel
+
+Reports the mean time spent in ``lowlevel.parse`` and the
+``lowlevel.parse_sensor`` fast path for each of the sensor frame types we
+care about, plus an unknown packet type that falls through the dispatch.
+"""
+
+import argparse
+import timeit
+
+from arwn.vendor.RFXtrx import lowlevel
+
+FRAMES = {
+    "TempHumid": bytearray(
+        [0x0A, 0x52, 0x02, 0x11, 0xEC, 0x01, 0x00, 0xD2, 0x2D, 0x02, 0x69]
+    ),
+    "TempHumidBaro": bytearray(
+        [0x0D, 0x54, 0x02, 0x12, 0xE9, 0x00, 0x00, 0xC8, 0x30, 0x02, 0x03,
+         0xF5, 0x01, 0x69]
+    ),
+    "RainGauge": bytearray(
+        [0x0B, 0x55, 0x02, 0x13, 0x65, 0x00, 0x00, 0x7B, 0x00, 0x10, 0x2C, 0x69]
+    ),
+    "Wind": bytearray(
+        [0x10, 0x56, 0x01, 0x14, 0x33, 0x00, 0x00, 0xB4, 0x00, 0x21, 0x00,
+         0x3A, 0x00, 0x00, 0x00, 0x00, 0x69]
+    ),
+    "Unknown": bytearray([0x07, 0x7F, 0x00, 0x15, 0x00, 0x00, 0x00, 0x00]),
+}  # fmt: skip
+
+
+def _time(func, frame, number):
+    timer = timeit.Timer(lambda: func(frame))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e9
+
+
+def bench(number):
+    results = {}
+    for name, frame in FRAMES.items():
+        results[name] = (
+            _time(lowlevel.parse, frame, number),
+            _time(lowlevel.parse_sensor, frame, number),
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("bench_lowlevel")
+    parser.add_argument("-n", "--number", type=int, default=100000)
+    args = parser.parse_args()
+    print("%-14s %14s %14s" % ("frame", "parse", "parse_sensor"))
+    for name, (full, fast) in bench(args.number).items():
+        print("%-14s %8.0f ns/op %8.0f ns/op" % (name, full, fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""End to end throughput of collector -> Dispatcher -> MQTT.
+
+Run from the top of the tree with::
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --source rfxcom -n 50000
+
+Synthetic traffic for every supported sensor model is fed through the
+real collector and ``Dispatcher.loopforever``, with the MQTT client
+swapped for a sink that throws the publishes away (everything up to and
+including ``MQTT.send`` is the real code).
+
+rtl_433 json lines are piped through ``cat`` into RTL433Collector, the
+same way the rtl_433 process is read. RFXtrx frames are served from
+memory by a fake serial port behind PySerialTransport.
+
+Each source is run twice, once bare for packets/s and once with every
+stage timed for the latency percentiles:
+
+collect
+    producing the next packet from the collector: read, frame or line
+    split, decode, SensorPacket
+dispatch
+    ``Dispatcher.dispatch`` for one packet, including the sends
+send
+    a single ``MQTT.send``, so serialising the payload
+
+Peak RSS is for the whole process, run one ``--source`` at a time when
+sizing memory. ``--output`` saves the results as json so two releases
+can be compared.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from unittest import mock
+
+import paho.mqtt.client as paho
+
+from arwn import engine
+from arwn.vendor.RFXtrx import pyserial
+
+from .bench_lowlevel import FRAMES
+
+RTL433_RECORDS = {
+    "THGR810": {
+        "model": "Oregon-THGR810",
+        "id": 236,
+        "channel": 1,
+        "battery_ok": 1,
+        "temperature_C": 21.3,
+        "humidity": 45,
+    },
+    "WGR800": {
+        "model": "Oregon-WGR800",
+        "id": 51,
+        "battery_ok": 1,
+        "wind_avg_m_s": 1.2,
+        "wind_max_m_s": 3.4,
+        "wind_dir_deg": 270,
+    },
+    "Acurite-Rain899": {
+        "model": "Acurite-Rain899",
+        "id": 101,
+        "channel": 0,
+        "battery_ok": 1,
+        "rain_mm": 12.7,
+    },
+    "BHTR968": {
+        "model": "Oregon-BHTR968",
+        "id": 233,
+        "channel": 0,
+        "battery_ok": 1,
+        "temperature_C": 20.0,
+        "humidity": 48,
+        "pressure_hPa": 1013,
+    },
+    "Springfield": {
+        "model": "Springfield",
+        "sid": 82,
+        "channel": 2,
+        "battery_ok": 1,
+        "temperature_C": 15.5,
+        "moisture": 4,
+    },
+}
+
+# THGR810, BHTR968, PCR800 rain and WGR800 as seen by an RFXtrx
+RFXCOM_FRAMES = {
+    name: bytes(FRAMES[name])
+    for name in ("TempHumid", "TempHumidBaro", "RainGauge", "Wind")
+}
+
+NAMES = {
+    "ec:01": "Outside",
+    "e9:00": "Living Room",
+    "52:02": "Garden",
+    "11:02": "Upstairs",
+}
+
+STAGES = ("collect", "dispatch", "send")
+
+
+MessageInfo = collections.namedtuple("MessageInfo", ["rc", "mid"])
+
+
+class NullClient(object):
+    """Stands in for the paho client, counts what would be published"""
+
+    def __init__(self, on_publish):
+        self.published = 0
+        self.bytes = 0
+        self.on_publish = on_publish
+
+    def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        self.published += 1
+        self.bytes += len(payload)
+        # a real MQTTMessageInfo costs more than the rest of publish
+        info = MessageInfo(paho.MQTT_ERR_SUCCESS, self.published)
+        self.on_publish(self, None, info.mid)
+        return info
+
+
+class NullMQTT(engine.MQTT):
+    def _start(self):
+        self.client = NullClient(self.client.on_publish)
+
+
+class BenchDispatcher(engine.Dispatcher):
+    def __init__(self, config, collector):
+        self._bench_collector = collector
+        super(BenchDispatcher, self).__init__(config)
+
+    def _get_collector(self, config):
+        self.collector = self._bench_collector
+
+    def _get_mqtt(self, config):
+        return NullMQTT(config["mqtt"]["server"], config)
+
+
+class FakeSerial(object):
+    """Serves a byte string in the sized reads a real port would"""
+
+    def __init__(self, data, burst=64):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.burst = burst
+
+    @property
+    def in_waiting(self):
+        return min(self.burst, len(self.data) - self.pos)
+
+    def read(self, size=1):
+        if self.pos >= len(self.data):
+            # ends the collector's iteration, and so loopforever
+            raise StopIteration
+        chunk = bytes(self.data[self.pos : self.pos + size])
+        self.pos += size
+        return chunk
+
+
+def rtl433_collector(path):
+    def spawn(self):
+        return subprocess.Popen(["cat", path], stdout=subprocess.PIPE, bufsize=0)
+
+    with mock.patch.object(engine.RTL433Collector, "_spawn", spawn):
+        return engine.RTL433Collector()
+
+
+def rfxcom_collector(data):
+    with mock.patch.object(pyserial, "Serial", lambda *a, **kw: FakeSerial(data)):
+        with mock.patch.object(pyserial.PySerialTransport, "reset"):
+            return engine.RFXCOMCollector("/dev/null")
+
+
+class TimedIterator(object):
+    def __init__(self, inner, samples):
+        self.inner = inner
+        self.samples = samples
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter_ns()
+        try:
+            return next(self.inner)
+        finally:
+            self.samples.append(time.perf_counter_ns() - start)
+
+
+def timed_call(func, samples):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter_ns() - start)
+
+    return wrapper
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    if not samples:
+        return {p: 0 for p in points}
+    last = len(samples) - 1
+    return {p: samples[min(last, int(len(samples) * p / 100))] for p in points}
+
+
+def run(make_collector, timed=False):
+    # the synthetic readings never change, so keep the burst filter from
+    # throwing nearly all of them away
+    config = {
+        "names": NAMES,
+        # just the path to the broker, not the handlers
+        "mqtt": {"server": "null", "local_handlers": False},
+        "dedupe": False,
+    }
+    collector = make_collector()
+    samples = {stage: [] for stage in STAGES}
+    if timed:
+        # the last collect sample is the one that hits the end of input
+        collector = TimedIterator(collector, samples["collect"])
+    dispatcher = BenchDispatcher(config, collector)
+    packets = []
+    dispatch = dispatcher.dispatch
+    if timed:
+        dispatch = timed_call(dispatch, samples["dispatch"])
+        dispatcher.mqtt.send = timed_call(dispatcher.mqtt.send, samples["send"])
+
+    def counting_dispatch(packet):
+        packets.append(None)
+        return dispatch(packet)
+
+    dispatcher.dispatch = counting_dispatch
+    start = time.perf_counter()
+    dispatcher.loopforever()
+    elapsed = time.perf_counter() - start
+    if timed:
+        samples["collect"].pop()
+    return {
+        "packets": len(packets),
+        "published": dispatcher.mqtt.client.published,
+        "seconds": elapsed,
+        "samples": samples,
+    }
+
+
+def bench(source, number, path):
+    if source == "rtl433":
+        records = list(RTL433_RECORDS.values())
+        with open(path, "w") as f:
+            for i in range(number):
+                f.write(json.dumps(records[i % len(records)]) + "\n")
+        make_collector = lambda: rtl433_collector(path)  # noqa: E731
+    else:
+        frames = list(RFXCOM_FRAMES.values())
+        data = b"".join(frames[i % len(frames)] for i in range(number))
+        make_collector = lambda: rfxcom_collector(data)  # noqa: E731
+
+    plain = run(make_collector)
+    timed = run(make_collector, timed=True)
+    return {
+        "packets": plain["packets"],
+        "published": plain["published"],
+        "packets_per_sec": plain["packets"] / plain["seconds"],
+        "latency_ns": {stage: percentiles(timed["samples"][stage]) for stage in STAGES},
+    }
+
+
+def report(source, result):
+    print(
+        "%-8s %8d packets %8d publishes %10.0f packets/s"
+        % (
+            source,
+            result["packets"],
+            result["published"],
+            result["packets_per_sec"],
+        )
+    )
+    for stage, pcts in result["latency_ns"].items():
+        print(
+            "  %-10s %s"
+            % (
+                stage,
+                "  ".join("p%d %7.1fus" % (p, ns / 1000.0) for p, ns in pcts.items()),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser("bench_pipeline")
+    parser.add_argument("-n", "--number", type=int, default=100000)
+    parser.add_argument("--source", choices=("rtl433", "rfxcom", "all"), default="all")
+    parser.add_argument("--output", help="also write the results as json")
+    args = parser.parse_args()
+
+    # keep per packet debug logging out of the timings
+    logging.basicConfig(level=logging.ERROR)
+
+    sources = ("rtl433", "rfxcom") if args.source == "all" else (args.source,)
+    fd, path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    results = {}
+    try:
+        for source in sources:
+            results[source] = bench(source, args.number, path)
+            report(source, results[source])
+    finally:
+        os.unlink(path)
+
+    # kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("peak RSS %.1f MiB" % (peak / 1024.0))
+    if args.output:
+        results["peak_rss_kb"] = peak
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
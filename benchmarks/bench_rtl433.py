@@ -0,0 +1,118 @@
+"""Throughput of the rtl_433 json ingestion in RTL433Collector.
+
+Run from the top of the tree with::
+
+    python -m benchmarks.bench_rtl433
+
+Writes a file of synthetic rtl_433 output and times reading it through
+RTL433Collector (large reads, line splitting, the configured json
+backend), against the previous readline() + json.loads() loop.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from unittest import mock
+
+from arwn import engine
+
+RECORDS = [
+    {
+        "model": "Oregon-THGR810",
+        "id": 236,
+        "channel": 1,
+        "battery_ok": 1,
+        "temperature_C": 21.3,
+        "humidity": 45,
+    },
+    {
+        "model": "Oregon-WGR800",
+        "id": 51,
+        "battery_ok": 1,
+        "wind_avg_m_s": 1.2,
+        "wind_max_m_s": 3.4,
+        "wind_dir_deg": 270,
+    },
+    {
+        "model": "Acurite-Rain899",
+        "id": 101,
+        "channel": 0,
+        "battery_ok": 1,
+        "rain_mm": 12.7,
+    },
+    {
+        "model": "Neighbours-Doorbell",
+        "id": 4242,
+        "channel": 3,
+        "battery_ok": 1,
+    },
+]
+
+
+def write_lines(path, count):
+    with open(path, "w") as f:
+        for i in range(count):
+            f.write(json.dumps(RECORDS[i % len(RECORDS)]) + "\n")
+
+
+def readline_loop(path):
+    """The pre-chunking collector loop, for comparison"""
+    proc = subprocess.Popen(["cat", path], stdout=subprocess.PIPE)
+    count = 0
+    while True:
+        line = proc.stdout.readline()
+        if not line:
+            break
+        data = json.loads(line.decode("utf-8"))
+        engine.RTL433Collector.log_data(data)
+        packet = engine.SensorPacket()
+        packet.from_json(data)
+        count += 1
+    proc.wait()
+    return count
+
+
+def collector_loop(path, backend):
+    def spawn(self):
+        return subprocess.Popen(["cat", path], stdout=subprocess.PIPE, bufsize=0)
+
+    with mock.patch.object(engine.RTL433Collector, "_spawn", spawn):
+        collector = engine.RTL433Collector(json_backend=backend)
+        return sum(1 for _ in collector)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    count = func(*args)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser("bench_rtl433")
+    parser.add_argument("-n", "--number", type=int, default=200000)
+    parser.add_argument("--json", help="json backend for the collector")
+    args = parser.parse_args()
+
+    # keep the per-record debug output and the warnings about
+    # neighbours' unknown sensors out of the timing
+    logging.basicConfig(level=logging.ERROR)
+
+    fd, path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        write_lines(path, args.number)
+        print("readline + json.loads  %10.0f lines/s" % timed(readline_loop, path))
+        print(
+            "RTL433Collector        %10.0f lines/s"
+            % timed(collector_loop, path, args.json)
+        )
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,30 @@ import socket
 import struct
 import threading
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List
 
+# MQTT v5 property identifier => (name, type)
+PROPERTIES = {
+    0x01: ("payload_format_indicator", "byte"),
+    0x02: ("message_expiry_interval", "int4"),
+    0x03: ("content_type", "string"),
+    0x08: ("response_topic", "string"),
+    0x09: ("correlation_data", "binary"),
+    0x0B: ("subscription_identifier", "varint"),
+    0x11: ("session_expiry_interval", "int4"),
+    0x15: ("authentication_method", "string"),
+    0x16: ("authentication_data", "binary"),
+    0x17: ("request_problem_information", "byte"),
+    0x18: ("will_delay_interval", "int4"),
+    0x19: ("request_response_information", "byte"),
+    0x21: ("receive_maximum", "int2"),
+    0x22: ("topic_alias_maximum", "int2"),
+    0x23: ("topic_alias", "int2"),
+    0x26: ("user_property", "pair"),
+    0x27: ("maximum_packet_size", "int4"),
+}
+
 
 @dataclass
 class ReceivedMessage:
@@ -18,6 +39,8 @@ class ReceivedMessage:
     retain: bool
     qos: int
     timestamp: float
+    # MQTT v5 PUBLISH properties, user_property is a list of pairs
+    properties: dict = field(default_factory=dict)
 
 
 @dataclass
@@ -29,9 +52,14 @@ class WillMessage:
 
 
 class SimpleMQTTBroker:
-    """A simple MQTT broker for testing purposes."""
+    """A simple MQTT broker for testing purposes.
+
+    Speaks MQTT 3.1.1 and enough of 5.0 to check PUBLISH properties:
+    they are parsed into ReceivedMessage.properties, and topic aliases
+    are resolved, up to topic_alias_maximum per connection.
+    """
 
-    def __init__(self):
+    def __init__(self, topic_alias_maximum=10):
         """Initialize the broker."""
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -44,6 +72,9 @@ class SimpleMQTTBroker:
         self.messages: List[ReceivedMessage] = []
         self.retained: Dict[str, bytes] = {}
         self.wills: Dict[object, WillMessage] = {}
+        self.topic_alias_maximum = topic_alias_maximum
+        self.protocols: Dict[object, int] = {}  # connection => protocol level
+        self.topic_aliases: Dict[object, Dict[int, str]] = {}
         self._messages_lock = threading.Lock()
         self.running = False
         self.thread = None
@@ -87,12 +118,22 @@ class SimpleMQTTBroker:
                 # Handle CONNECT packet (type 1)
                 if packet_type == 1:
                     remaining = self._read_remaining_length(conn)
-                    connect_data = conn.recv(remaining) if remaining > 0 else b""
+                    connect_data = self._recv_exact(conn, remaining)
+                    proto_len = struct.unpack("!H", connect_data[:2])[0]
+                    self.protocols[conn] = connect_data[2 + proto_len]
                     will = self._parse_will(connect_data)
                     if will:
                         self.wills[conn] = will
-                    connack = struct.pack("!BBBB", 0x20, 0x02, 0x00, 0x00)
-                    conn.send(connack)
+                    if self._is_v5(conn):
+                        self.topic_aliases[conn] = {}
+                        props = b""
+                        if self.topic_alias_maximum:
+                            props = struct.pack("!BH", 0x22, self.topic_alias_maximum)
+                        body = b"\x00\x00" + self._encode_varint(len(props)) + props
+                        conn.send(b"\x20" + self._encode_varint(len(body)) + body)
+                    else:
+                        connack = struct.pack("!BBBB", 0x20, 0x02, 0x00, 0x00)
+                        conn.send(connack)
 
                 # Handle PUBLISH packet (type 3)
                 elif packet_type == 3:
@@ -100,7 +141,7 @@ class SimpleMQTTBroker:
                     qos_val = (data[0] >> 1) & 0x03
                     remaining = self._read_remaining_length(conn)
                     if remaining > 0:
-                        publish_data = conn.recv(remaining)
+                        publish_data = self._recv_exact(conn, remaining)
                         if len(publish_data) >= 2:
                             topic_len = struct.unpack("!H", publish_data[:2])[0]
                             if len(publish_data) >= 2 + topic_len:
@@ -114,9 +155,20 @@ class SimpleMQTTBroker:
                                     offset += 2
                                 else:
                                     packet_id = None
+                                properties = {}
+                                if self._is_v5(conn):
+                                    properties, offset = self._parse_properties(
+                                        publish_data, offset
+                                    )
+                                    topic = self._resolve_alias(conn, topic, properties)
                                 payload = publish_data[offset:]
                                 self._route_message(
-                                    topic, payload, conn, retain_flag, qos_val
+                                    topic,
+                                    payload,
+                                    conn,
+                                    retain_flag,
+                                    qos_val,
+                                    properties,
                                 )
                                 # Send PUBACK for QoS 1, PUBREC for QoS 2
                                 if qos_val == 1 and packet_id is not None:
@@ -136,10 +188,14 @@ class SimpleMQTTBroker:
                 elif packet_type == 8:
                     # Read remaining length
                     remaining = self._read_remaining_length(conn)
-                    payload = conn.recv(remaining) if remaining > 0 else b""
+                    payload = self._recv_exact(conn, remaining)
                     # Extract packet ID from payload
                     if len(payload) >= 2:
                         packet_id = struct.unpack("!H", payload[:2])[0]
+                        if self._is_v5(conn):
+                            # drop the SUBSCRIBE properties
+                            _, offset = self._parse_properties(payload, 2)
+                            payload = payload[:2] + payload[offset:]
                         # Parse topic filter
                         if len(payload) > 4:
                             topic_len = struct.unpack("!H", payload[2:4])[0]
@@ -156,36 +212,24 @@ class SimpleMQTTBroker:
                                     self.retained.items()
                                 ):
                                     if self._topic_matches(topic_filter, ret_topic):
-                                        ret_topic_bytes = ret_topic.encode("utf-8")
-                                        ret_topic_len_bytes = struct.pack(
-                                            "!H", len(ret_topic_bytes)
-                                        )
                                         # Set retain bit in fixed header: 0x31
-                                        rem_len = (
-                                            2 + len(ret_topic_bytes) + len(ret_payload)
-                                        )
-                                        rem_bytes = []
-                                        while True:
-                                            byte = rem_len % 128
-                                            rem_len = rem_len // 128
-                                            if rem_len > 0:
-                                                byte |= 0x80
-                                            rem_bytes.append(byte)
-                                            if rem_len == 0:
-                                                break
-                                        retained_packet = (
-                                            bytes([0x31])
-                                            + bytes(rem_bytes)
-                                            + ret_topic_len_bytes
-                                            + ret_topic_bytes
-                                            + ret_payload
+                                        retained_packet = self._publish_packet(
+                                            ret_topic,
+                                            ret_payload,
+                                            self._is_v5(conn),
+                                            retain=True,
                                         )
                                         try:
                                             conn.send(retained_packet)
                                         except Exception:
                                             pass
                         # Send SUBACK
-                        suback = struct.pack("!BBHB", 0x90, 0x03, packet_id, 0x00)
+                        if self._is_v5(conn):
+                            suback = struct.pack(
+                                "!BBHBB", 0x90, 0x04, packet_id, 0x00, 0x00
+                            )
+                        else:
+                            suback = struct.pack("!BBHB", 0x90, 0x03, packet_id, 0x00)
                         conn.send(suback)
 
                 # Handle PINGREQ packet (type 12)
@@ -197,7 +241,8 @@ class SimpleMQTTBroker:
 
                 # Handle DISCONNECT packet (type 14)
                 elif packet_type == 14:
-                    self._read_remaining_length(conn)  # drain 0x00
+                    # drain the v5 reason code and properties, if any
+                    self._recv_exact(conn, self._read_remaining_length(conn))
                     clean_disconnect = True
                     break
 
@@ -212,11 +257,111 @@ class SimpleMQTTBroker:
                     )
             else:
                 self.wills.pop(conn, None)
+            self.protocols.pop(conn, None)
+            self.topic_aliases.pop(conn, None)
             try:
                 conn.close()
             except Exception:
                 pass
 
+    def _is_v5(self, conn):
+        return self.protocols.get(conn) == 5
+
+    def _recv_exact(self, conn, size):
+        """Read exactly size bytes, or as many as arrive before EOF."""
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    @staticmethod
+    def _encode_varint(value):
+        """Encode an MQTT variable byte integer."""
+        out = []
+        while True:
+            byte = value % 128
+            value = value // 128
+            if value > 0:
+                byte |= 0x80
+            out.append(byte)
+            if value == 0:
+                return bytes(out)
+
+    @staticmethod
+    def _decode_varint(data, offset):
+        """Decode an MQTT variable byte integer. Returns (value, offset)."""
+        multiplier = 1
+        value = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value += (byte & 0x7F) * multiplier
+            if (byte & 0x80) == 0:
+                return value, offset
+            multiplier *= 128
+
+    def _parse_properties(self, data, offset):
+        """Parse an MQTT v5 property block. Returns (dict, offset after it)."""
+        length, offset = self._decode_varint(data, offset)
+        end = offset + length
+        properties = {}
+        while offset < end:
+            name, kind = PROPERTIES[data[offset]]
+            offset += 1
+            if kind == "byte":
+                value = data[offset]
+                offset += 1
+            elif kind == "int2":
+                value = struct.unpack("!H", data[offset : offset + 2])[0]
+                offset += 2
+            elif kind == "int4":
+                value = struct.unpack("!I", data[offset : offset + 4])[0]
+                offset += 4
+            elif kind == "varint":
+                value, offset = self._decode_varint(data, offset)
+            else:
+                strings = []
+                for _ in range(2 if kind == "pair" else 1):
+                    size = struct.unpack("!H", data[offset : offset + 2])[0]
+                    value = data[offset + 2 : offset + 2 + size]
+                    if kind != "binary":
+                        value = value.decode("utf-8")
+                    strings.append(value)
+                    offset += 2 + size
+                value = tuple(strings) if kind == "pair" else strings[0]
+            if name == "user_property":
+                properties.setdefault(name, []).append(value)
+            else:
+                properties[name] = value
+        return properties, end
+
+    def _resolve_alias(self, conn, topic, properties):
+        """Apply the topic alias of a v5 PUBLISH. Returns the full topic."""
+        alias = properties.get("topic_alias")
+        if alias is None:
+            return topic
+        if not 0 < alias <= self.topic_alias_maximum:
+            raise ValueError("Topic alias %d out of range" % alias)
+        aliases = self.topic_aliases[conn]
+        if topic:
+            aliases[alias] = topic
+            return topic
+        # an unknown alias is a protocol error, which drops the connection
+        return aliases[alias]
+
+    def _publish_packet(self, topic, payload, v5, retain=False):
+        """Build a QoS 0 PUBLISH packet, with no properties for v5."""
+        topic_bytes = topic.encode("utf-8")
+        body = struct.pack("!H", len(topic_bytes)) + topic_bytes
+        if v5:
+            body += b"\x00"
+        body += payload
+        header = 0x31 if retain else 0x30
+        return bytes([header]) + self._encode_varint(len(body)) + body
+
     def _read_remaining_length(self, conn):
         """Read MQTT remaining length field."""
         multiplier = 1
@@ -237,10 +382,13 @@ class SimpleMQTTBroker:
         try:
             proto_len = struct.unpack("!H", connect_data[:2])[0]
             offset = 2 + proto_len  # skip protocol name bytes
+            v5 = connect_data[offset] == 5
             offset += 1  # skip protocol level
             connect_flags = connect_data[offset]
             offset += 1  # skip connect flags
             offset += 2  # skip keep-alive
+            if v5:
+                _, offset = self._parse_properties(connect_data, offset)
 
             will_flag = bool(connect_flags & 0x04)
             will_qos = (connect_flags >> 3) & 0x03
@@ -253,6 +401,8 @@ class SimpleMQTTBroker:
             if not will_flag:
                 return None
 
+            if v5:
+                _, offset = self._parse_properties(connect_data, offset)
             will_topic_len = struct.unpack("!H", connect_data[offset : offset + 2])[0]
             offset += 2
             will_topic = connect_data[offset : offset + will_topic_len].decode("utf-8")
@@ -296,7 +446,9 @@ class SimpleMQTTBroker:
         # Both must be exhausted for a match (unless filter ends with #)
         return i == len(filter_parts) and j == len(topic_parts)
 
-    def _route_message(self, topic, payload, sender_conn, retain=False, qos=0):
+    def _route_message(
+        self, topic, payload, sender_conn, retain=False, qos=0, properties=None
+    ):
         """Route a published message to all matching subscribers."""
         # Update retained store
         if retain:
@@ -314,25 +466,12 @@ class SimpleMQTTBroker:
                     retain=retain,
                     qos=qos,
                     timestamp=time.monotonic(),
+                    properties=properties or {},
                 )
             )
 
-        # Build PUBLISH packet (QoS 0 delivery to subscribers)
-        topic_bytes = topic.encode("utf-8")
-        topic_len = struct.pack("!H", len(topic_bytes))
-        remaining_length = 2 + len(topic_bytes) + len(payload)
-        remaining_bytes = []
-        while True:
-            byte = remaining_length % 128
-            remaining_length = remaining_length // 128
-            if remaining_length > 0:
-                byte |= 0x80
-            remaining_bytes.append(byte)
-            if remaining_length == 0:
-                break
-        publish_packet = (
-            bytes([0x30]) + bytes(remaining_bytes) + topic_len + topic_bytes + payload
-        )
+        # Build PUBLISH packets (QoS 0 delivery to subscribers)
+        packets = {v5: self._publish_packet(topic, payload, v5) for v5 in (False, True)}
 
         # Send to all matching subscribers (except sender)
         for conn, filters in list(self.subscriptions.items()):
@@ -341,7 +480,7 @@ class SimpleMQTTBroker:
             for topic_filter in filters:
                 if self._topic_matches(topic_filter, topic):
                     try:
-                        conn.send(publish_packet)
+                        conn.send(packets[self._is_v5(conn)])
                     except Exception:
                         pass
                     break
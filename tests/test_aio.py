@@ -0,0 +1,281 @@
+"""Tests for the asyncio collector / dispatcher mode."""
+
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from arwn import aio, engine, handlers
+
+TEMP_HUMID = bytes([0x0A, 0x52, 0x02, 0x11, 0xEC, 0x01, 0x00, 0xD2, 0x2D, 0x02, 0x69])
+
+
+def make_config(port=1883, ctype="rtl433"):
+    return {
+        "mqtt": {"server": "localhost"},
+        "names": {"ec:01": "Outside"},
+        "collector": {"type": ctype, "device": "/dev/null"},
+    }
+
+
+async def wait_for(broker, topic, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with broker._messages_lock:
+            for msg in broker.messages:
+                if msg.topic == topic:
+                    return msg
+        await asyncio.sleep(0.05)
+    raise TimeoutError(topic)
+
+
+def test_async_mqtt_publishes_without_thread(sim_broker, sim_broker_clean):
+    async def scenario():
+        handlers.setup()
+        mq = aio.AsyncMQTT("localhost", make_config(), port=sim_broker.port)
+        try:
+            await wait_for(sim_broker.broker, "arwn/status")
+            mq.send("rain", {"total": 1.5, "timestamp": 1})
+            msg = await wait_for(sim_broker.broker, "arwn/rain")
+            assert json.loads(msg.payload)["total"] == 1.5
+            assert mq.client._thread is None
+        finally:
+            mq.stop()
+
+    asyncio.run(scenario())
+
+
+def test_async_mqtt_connects_off_the_loop(monkeypatch):
+    attempts = []
+
+    def blackholed(address, timeout=None, source_address=None):
+        # what a dropped SYN looks like, until the connect timeout
+        attempts.append(threading.current_thread())
+        time.sleep(1.0)
+        raise socket.timeout("timed out")
+
+    monkeypatch.setattr(socket, "create_connection", blackholed)
+
+    async def scenario():
+        handlers.setup()
+        mq = aio.AsyncMQTT("10.255.255.1", make_config(), port=1883)
+        try:
+            ticks = []
+            for _ in range(20):
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.05)
+            gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+            assert attempts
+            assert threading.main_thread() not in attempts
+            assert max(gaps) < 0.5
+        finally:
+            mq.stop()
+
+    asyncio.run(scenario())
+
+
+def test_async_mqtt_coalesces_on_the_loop(sim_broker, sim_broker_clean):
+    config = make_config()
+    config["mqtt"]["coalesce"] = {"interval": 0.05, "max_delay": 1}
+
+    async def scenario():
+        handlers.setup()
+        mq = aio.AsyncMQTT("localhost", config, port=sim_broker.port)
+        try:
+            await wait_for(sim_broker.broker, "arwn/status")
+            mq.send("wind", {"speed": 1.0, "timestamp": 1})
+            mq.send("wind", {"speed": 2.0, "timestamp": 1})
+            msg = await wait_for(sim_broker.broker, "arwn/wind")
+            assert json.loads(msg.payload) == {
+                "speed": 2.0,
+                "timestamp": 1,
+                "duplicate": False,
+            }
+            assert mq.coalescer.coalesced == 1
+        finally:
+            mq.stop()
+
+    asyncio.run(scenario())
+
+
+def test_async_mqtt_handlers_send_from_the_loop(sim_broker, sim_broker_clean):
+    async def scenario():
+        handlers.setup()
+        mq = aio.AsyncMQTT("localhost", make_config(), port=sim_broker.port)
+        loop_thread = threading.get_ident()
+        sent_from = []
+        send = mq.send
+
+        def recording_send(*args, **kwargs):
+            sent_from.append(threading.get_ident())
+            return send(*args, **kwargs)
+
+        mq.send = recording_send
+        try:
+            await wait_for(sim_broker.broker, "arwn/status")
+            payload = json.dumps({"total": 1.5, "timestamp": 1}).encode()
+            mq.client.on_message(
+                mq.client, None, SimpleNamespace(topic="arwn/rain", payload=payload)
+            )
+            # no rain total yet, so the handlers publish one
+            msg = await wait_for(sim_broker.broker, "arwn/totals/rain")
+            assert json.loads(msg.payload)["total"] == 1.5
+            assert sent_from == [loop_thread]
+        finally:
+            mq.stop()
+
+    asyncio.run(scenario())
+
+
+def test_async_mqtt_always_runs_handlers_off_the_loop(sim_broker, sim_broker_clean):
+    config = make_config()
+    config["handlers"] = False
+
+    async def scenario():
+        handlers.setup()
+        mq = aio.AsyncMQTT("localhost", config, port=sim_broker.port)
+        try:
+            assert mq.handler_pool is not None
+        finally:
+            mq.stop()
+
+    asyncio.run(scenario())
+
+
+def test_async_rtl433_collector_reads_subprocess():
+    line = json.dumps(
+        {
+            "model": "Oregon-THGR810",
+            "id": 236,
+            "channel": 1,
+            "battery_ok": 1,
+            "temperature_C": 21.0,
+            "humidity": 45,
+        }
+    )
+
+    async def scenario():
+        collector = aio.AsyncRTL433Collector()
+        collector.cmd = [sys.executable, "-c", "print(%r)" % line]
+        await collector.start()
+        packets = [p async for p in collector]
+        collector.stop()
+        return packets
+
+    packets = asyncio.run(scenario())
+    assert len(packets) == 1
+    assert packets[0].sensor_id == "ec:01"
+    assert packets[0].data["temp"] == 69.8
+
+
+class PipeSerial:
+    """Just enough of serial.Serial to drive the async transport"""
+
+    def __init__(self, *args, **kwargs):
+        self.rfd, self.wfd = os.pipe()
+        os.set_blocking(self.rfd, False)
+        self.written = []
+
+    def fileno(self):
+        return self.rfd
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def read(self, size=1):
+        try:
+            return os.read(self.rfd, 4096)
+        except BlockingIOError:
+            return b""
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def flushInput(self):
+        pass
+
+
+@patch("arwn.vendor.RFXtrx.pyserial.Serial", PipeSerial)
+def test_async_rfxcom_collector_uses_add_reader():
+    async def scenario():
+        collector = aio.AsyncRFXCOMCollector("/dev/ttyUSB0")
+        serial = collector.transport.serial
+        collector.transport.start()
+        os.write(serial.wfd, TEMP_HUMID + TEMP_HUMID[:4])
+        first = await asyncio.wait_for(collector.__anext__(), 1)
+        os.write(serial.wfd, TEMP_HUMID[4:])
+        second = await asyncio.wait_for(collector.__anext__(), 1)
+        collector.stop()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert not hasattr(aio.AsyncPySerialTransport, "receive_blocking")
+    assert first.sensor_id == second.sensor_id == "ec:01"
+    assert first.data["temp"] == 69.8
+
+
+def test_async_dispatcher_shares_dispatch():
+    packet = engine.SensorPacket()
+    packet.from_json(
+        {
+            "model": "WGR800",
+            "id": 51,
+            "wind_avg_m_s": 1.0,
+            "wind_max_m_s": 2.0,
+            "wind_dir_deg": 90,
+        }
+    )
+
+    class Collector:
+        async def start(self):
+            pass
+
+        def stop(self):
+            pass
+
+        def __aiter__(self):
+            return self._gen()
+
+        async def _gen(self):
+            yield None
+            yield packet
+
+    async def scenario():
+        with patch.object(aio.AsyncDispatcher, "_get_mqtt", return_value=MagicMock()):
+            d = aio.AsyncDispatcher(make_config())
+        d.collector = Collector()
+        await d.loopforever()
+        return d
+
+    d = asyncio.run(scenario())
+    topic, payload = d.mqtt.send.call_args[0]
+    assert topic == "wind"
+    assert payload.direction == 90
+    assert "timestamp" in d.mqtt.send.call_args.kwargs
+
+
+def test_async_config_watcher_reloads(tmp_path):
+    path = tmp_path / "config.yml"
+    path.write_text("names:\n  aa:01: outdoor\n")
+    dispatcher = MagicMock()
+
+    async def scenario():
+        watcher = aio.AsyncConfigWatcher(str(path), dispatcher, interval=0.01)
+        watcher.start()
+        path.write_text("names:\n  aa:01: garden\n  bb:02: porch\n")
+        for _ in range(100):
+            if dispatcher.reload.called:
+                break
+            await asyncio.sleep(0.01)
+        watcher.stop()
+
+    asyncio.run(scenario())
+    dispatcher.reload.assert_called_once_with(
+        {"names": {"aa:01": "garden", "bb:02": "porch"}}
+    )
@@ -68,3 +68,21 @@ def test_event_loop_starts_config_watcher(mock_dispatcher_cls, mock_watcher_cls)
         mock_watcher.stop.assert_called_once()
     finally:
         os.unlink(config_path)
+
+
+@mock.patch("arwn.cmd.collect.aio.run", new_callable=mock.MagicMock)
+@mock.patch("arwn.cmd.collect.engine.Dispatcher")
+def test_event_loop_asyncio_mode(mock_dispatcher_cls, mock_run):
+    from arwn.cmd.collect import event_loop
+
+    async def fake_run(config, config_path):
+        pass
+
+    mock_run.side_effect = fake_run
+    config = make_minimal_config()
+    config["asyncio"] = True
+
+    event_loop(config, "/tmp/config.yml")
+
+    mock_run.assert_called_once_with(config, "/tmp/config.yml")
+    mock_dispatcher_cls.assert_not_called()
@@ -0,0 +1,84 @@
+"""Tests for the local day tracker."""
+
+import datetime
+import zoneinfo
+from unittest import mock
+
+from arwn.days import DayTracker
+
+NY = zoneinfo.ZoneInfo("America/New_York")
+
+
+def epoch(*args, tz=NY):
+    return datetime.datetime(*args, tzinfo=tz).timestamp()
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_day_from_the_clock():
+    clock = Clock(epoch(2017, 1, 1, 7))
+    days = DayTracker("America/New_York", clock=clock)
+    assert days.day() == datetime.date(2017, 1, 1).toordinal()
+    assert days.next_midnight == epoch(2017, 1, 2)
+    clock.now = epoch(2017, 1, 1, 23, 59, 59)
+    assert days.day() == datetime.date(2017, 1, 1).toordinal()
+    clock.now = epoch(2017, 1, 2)
+    assert days.day() == datetime.date(2017, 1, 2).toordinal()
+    assert days.start == epoch(2017, 1, 2)
+
+
+def test_only_works_the_day_out_when_it_changes():
+    clock = Clock(epoch(2017, 1, 1, 7))
+    days = DayTracker("America/New_York", clock=clock)
+    with mock.patch.object(days, "midnight", wraps=days.midnight) as midnight:
+        for minute in range(0, 24 * 60, 5):
+            clock.now = epoch(2017, 1, 1) + minute * 60
+            days.day()
+        # the start and end of the day, once
+        assert midnight.call_count == 2
+        clock.now = epoch(2017, 1, 2, 0, 0, 1)
+        days.day()
+        assert midnight.call_count == 4
+
+
+def test_new_year():
+    days = DayTracker("America/New_York")
+    assert not days.is_sameday(epoch(2016, 12, 31, 20), epoch(2017, 1, 1, 7))
+    # the same day of the year, but not the same day
+    assert not days.is_sameday(epoch(2016, 1, 1, 7), epoch(2017, 1, 1, 7))
+    assert days.day(epoch(2017, 1, 1, 7)) - days.day(epoch(2016, 12, 31, 20)) == 1
+
+
+def test_dst_days():
+    days = DayTracker("America/New_York")
+    # spring forward, a 23 hour day
+    days.day(epoch(2023, 3, 12, 12))
+    assert days.next_midnight - days.start == 23 * 3600
+    assert days.is_sameday(epoch(2023, 3, 12, 0, 30), epoch(2023, 3, 12, 23, 30))
+    # fall back, a 25 hour day
+    days.day(epoch(2023, 11, 5, 12))
+    assert days.next_midnight - days.start == 25 * 3600
+    assert days.day(epoch(2023, 11, 6) - 1) == datetime.date(2023, 11, 5).toordinal()
+
+
+def test_midnight_that_does_not_happen():
+    # Chile springs forward at midnight, the day starts at 1am
+    tz = zoneinfo.ZoneInfo("America/Santiago")
+    days = DayTracker("America/Santiago")
+    days.day(epoch(2023, 9, 3, 12, tz=tz))
+    assert days.start == epoch(2023, 9, 3, 1, tz=tz)
+    assert days.day(days.start - 1) == datetime.date(2023, 9, 2).toordinal()
+
+
+def test_local_time():
+    days = DayTracker()
+    now = datetime.datetime(2017, 6, 1, 12)
+    assert days.day(now.timestamp()) == now.date().toordinal()
+    assert days.start == datetime.datetime(2017, 6, 1).timestamp()
+    assert days.next_midnight == datetime.datetime(2017, 6, 2).timestamp()
@@ -0,0 +1,123 @@
+"""Tests for the payload encoders."""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from arwn import encoders, engine, handlers
+from tests.conftest import wait_for_message
+
+PACKET = engine.SensorPacket(
+    engine.IS_WIND, 1, "33:00", direction=90, speed=2.2, gust=4.5, units="mph"
+)
+EXPECTED = {
+    "bat": 1,
+    "sensor_id": "33:00",
+    "direction": 90,
+    "speed": 2.2,
+    "gust": 4.5,
+    "units": "mph",
+    "timestamp": 5,
+}
+
+
+@pytest.mark.parametrize(
+    "name,module",
+    [("json", None), ("json-compact", None), ("msgpack", "msgpack"), ("cbor", "cbor2")],
+)
+def test_encoders_roundtrip(name, module):
+    if module:
+        pytest.importorskip(module)
+    encoder = encoders.ENCODERS[name]()
+    data = encoder.encode(PACKET, {"timestamp": 5})
+    assert isinstance(data, bytes)
+    assert encoder.decode(data) == EXPECTED
+    data = encoder.encode({"total": 1.5}, {"timestamp": 5})
+    assert encoder.decode(data) == {"total": 1.5, "timestamp": 5}
+
+
+def test_encoder_must_implement_encode_and_decode():
+    class EncodeOnly(encoders.Encoder):
+        def encode(self, payload, extra):
+            return b""
+
+    with pytest.raises(TypeError):
+        EncodeOnly()
+
+
+def test_compact_json_is_smaller():
+    full = encoders.JSONEncoder().encode(PACKET, {"timestamp": 5})
+    compact = encoders.CompactJSONEncoder().encode(PACKET, {"timestamp": 5})
+    assert b", " not in compact
+    assert len(compact) < len(full)
+
+
+def test_encoder_map_longest_prefix():
+    m = encoders.EncoderMap(
+        "arwn",
+        {
+            "default": "json-compact",
+            "topics": {"temperature": "json", "temperature/Outside": "json-compact"},
+        },
+    )
+    assert m.for_topic("arwn/wind").name == "json-compact"
+    assert m.for_topic("arwn/temperature/Garden").name == "json"
+    assert m.for_topic("arwn/temperature/Outside").name == "json-compact"
+    # readable without the schema
+    assert m.for_topic("arwn/status").name == "json"
+    assert m.for_topic("arwn/schema").name == "json"
+    # prefixes are whole topic levels
+    assert m.for_topic("arwn/temperatures").name == "json-compact"
+
+
+def test_encoder_map_defaults_to_json():
+    m = encoders.EncoderMap("arwn")
+    assert m.for_topic("arwn/rain").name == "json"
+    assert not m.publish_schema
+
+
+def test_encoder_map_unknown_encoding():
+    with pytest.raises(ValueError):
+        encoders.EncoderMap("arwn", {"default": "xml"})
+
+
+def test_mqtt_publishes_schema_and_encodes(sim_broker, sim_broker_clean, monkeypatch):
+    config = {
+        "mqtt": {
+            "server": "localhost",
+            "encoding": {"topics": {"wind": "json-compact"}, "schema": True},
+            # so the copy of our own publish below isn't skipped as an echo
+            "local_handlers": False,
+        },
+        "names": {},
+        # run the handlers inline, to see what they are passed
+        "handlers": False,
+    }
+    handlers.setup()
+    mq = engine.MQTT("localhost", config, port=sim_broker.port)
+    try:
+        wait_for_message(sim_broker.broker, "arwn/schema", timeout=2.0)
+        schema = json.loads(sim_broker.broker.retained["arwn/schema"])
+        assert schema["default"] == "json"
+        assert schema["topics"]["wind"] == "json-compact"
+        assert "sensor_id" in schema["fields"]
+
+        mq.send("wind", PACKET, timestamp=5)
+        msg = wait_for_message(sim_broker.broker, "arwn/wind", timeout=2.0)
+        assert msg.payload == encoders.CompactJSONEncoder().encode(
+            PACKET, {"timestamp": 5}
+        )
+
+        # incoming messages are decoded with the topic's encoder
+        seen = []
+        monkeypatch.setattr(
+            handlers, "run", lambda client, topic, payload: seen.append(payload)
+        )
+        mq.client.on_message(
+            mq.client, None, SimpleNamespace(topic="arwn/wind", payload=msg.payload)
+        )
+        assert seen == [EXPECTED]
+    finally:
+        mq.client.loop_stop()
+        mq.client.disconnect()
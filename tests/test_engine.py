@@ -1,12 +1,27 @@
+import json
 import os
 import tempfile
 import threading
 import time
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+import pytest
 import yaml
 
-from arwn.engine import ConfigWatcher, Dispatcher
+from arwn.coalesce import Coalescer
+from arwn.dedupe import BurstFilter
+from arwn.engine import (
+    IS_MOIST,
+    IS_RAIN,
+    IS_TEMP,
+    IS_WIND,
+    MQTT,
+    ConfigWatcher,
+    Dispatcher,
+    RFXCOMCollector,
+    SensorPacket,
+    unknown_route,
+)
 
 
 def make_config(names=None):
@@ -24,9 +39,16 @@ def test_dispatcher_reload_updates_names(mock_collector, mock_mqtt):
     d = Dispatcher(config)
     assert d.names == {"aa:01": "outdoor"}
 
+    routes = d.routes
     new_config = make_config({"aa:01": "garden", "bb:02": "porch"})
     d.reload(new_config)
     assert d.names == {"aa:01": "garden", "bb:02": "porch"}
+    # swapped, not modified
+    assert routes["aa:01"].temperature == "temperature/outdoor"
+    assert d.routes["aa:01"].temperature == "temperature/garden"
+    assert d.routes["bb:02"].moisture == "moisture/porch"
+    with pytest.raises(TypeError):
+        d.routes["cc:03"] = routes["aa:01"]
 
 
 @patch("arwn.engine.MQTT")
@@ -87,3 +109,269 @@ def test_config_watcher_triggers_reload(mock_collector, mock_mqtt):
         assert dispatcher.names == {"aa:01": "garden"}
     finally:
         os.unlink(config_path)
+
+
+class FakeTransport:
+    def __init__(self, frames):
+        self.frames = list(frames)
+
+    def reset(self):
+        pass
+
+    def receive_frame(self):
+        return self.frames.pop(0)
+
+
+@patch("arwn.engine.PySerialTransport")
+def test_rfxcom_collector_decodes_frames(mock_transport):
+    mock_transport.return_value = FakeTransport(
+        [
+            bytearray(
+                [0x0A, 0x52, 0x02, 0x11, 0xEC, 0x01, 0x00, 0xD2, 0x2D, 0x02, 0x69]
+            ),
+            bytearray([0x07, 0x10, 0x00, 0x01, 0x41, 0x01, 0x01, 0x60]),
+        ]
+    )
+    collector = RFXCOMCollector("/dev/ttyUSB0")
+
+    packet = next(collector)
+    assert packet.sensor_id == "ec:01"
+    assert packet.is_temp
+    assert packet.data["temp"] == 69.8
+    assert packet.data["humid"] == 45
+    assert packet.bat == 9
+
+    # lighting packets aren't sensors, and get dropped
+    assert next(collector) is None
+
+
+def test_sensor_packet_has_no_dict():
+    packet = SensorPacket(IS_TEMP, bat=1, sensor_id="ec:01", temp=69.8, units="F")
+    assert not hasattr(packet, "__dict__")
+    assert packet.bat == 1
+    assert packet.temp == 69.8
+    assert packet.gust is None
+    assert packet.data == {"temp": 69.8, "units": "F"}
+    with pytest.raises(TypeError):
+        SensorPacket(IS_TEMP, temperature=20)
+
+
+@pytest.mark.parametrize(
+    "packet,extra",
+    [
+        (
+            SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8, dewpoint=47.3, humid=45),
+            {"timestamp": 1700000000},
+        ),
+        (
+            SensorPacket(IS_TEMP, 1, "e9:00", temp=68.0, pressure=1013, units="F"),
+            {"units": "mbar", "timestamp": 1700000000},
+        ),
+        (
+            SensorPacket(IS_WIND, 0, "33:00", direction=90, speed=2.2, gust=4.5),
+            {},
+        ),
+        (SensorPacket(IS_TEMP, True, 'odd"id', temp=-0.0), {"note": None}),
+        (SensorPacket(IS_TEMP, None, None, temp=float("nan")), {"100%": [1]}),
+        # overriding fields that aren't last, and ones the packet hasn't set
+        (
+            SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8, humid=45, units="F"),
+            {"timestamp": 5, "temp": 70, "bat": None, "sensor_id": 3},
+        ),
+        (
+            SensorPacket(IS_RAIN, 1, "65:00", total=1.5, units="in"),
+            {"duplicate": False, "rate": 0.5, "timestamp": 5, "total": "1.5"},
+        ),
+        (
+            SensorPacket(IS_RAIN, 1, "65:00", total=1.5, units="in"),
+            {"total": 2.0, "timestamp": 5, "rate": 0.5, "duplicate": False},
+        ),
+    ],
+)
+def test_sensor_packet_payload_matches_json(packet, extra):
+    assert packet.payload(**extra) == json.dumps(packet.as_json(**extra)).encode()
+
+
+def test_mqtt_send_serializes_packets():
+    with patch.object(MQTT, "_start"):
+        mq = MQTT("localhost", {"mqtt": {}})
+    mq.client = MagicMock()
+    packet = SensorPacket(IS_WIND, 1, "33:00", direction=90, speed=2.2, units="mph")
+    mq.send("wind", packet, timestamp=5)
+    mq.send("rain", {"total": 1.5}, retain=True, timestamp=5)
+
+    (topic, data), kwargs = mq.client.publish.call_args_list[0]
+    assert topic == "arwn/wind"
+    assert json.loads(data) == {
+        "bat": 1,
+        "sensor_id": "33:00",
+        "direction": 90,
+        "speed": 2.2,
+        "units": "mph",
+        "timestamp": 5,
+    }
+    (topic, data), kwargs = mq.client.publish.call_args_list[1]
+    assert json.loads(data) == {"total": 1.5, "timestamp": 5}
+    assert kwargs["retain"] is True
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_coalescer_keeps_newest_per_topic():
+    clock = FakeClock()
+    c = Coalescer(interval=1.0, max_delay=5.0, clock=clock)
+    c.add("arwn/wind", {"speed": 1}, False, {"timestamp": 1})
+    c.add("arwn/wind", {"speed": 2}, False, {"timestamp": 1})
+    c.add("arwn/rain", {"total": 3}, True, {})
+    assert c.due() == []
+    assert c.next_deadline() == 1001.0
+
+    clock.now += 1.0
+    assert c.due() == [
+        ("arwn/wind", {"speed": 2}, False, {"timestamp": 1}, False),
+        ("arwn/rain", {"total": 3}, True, {}, False),
+    ]
+    assert c.coalesced == 1
+    assert c.next_deadline() is None
+
+
+def test_coalescer_max_delay():
+    clock = FakeClock()
+    c = Coalescer(interval=1.0, max_delay=2.5, clock=clock)
+    for i in range(2):
+        c.add("arwn/wind", {"speed": i}, False, {})
+        clock.now += 0.9
+        assert c.due() == []
+    # still bursting, but held since 1000
+    c.add("arwn/wind", {"speed": 3}, False, {})
+    assert c.next_deadline() == 1002.5
+    clock.now = 1002.5
+    assert [m[1] for m in c.due()] == [{"speed": 3}]
+
+
+def test_coalescer_flags_duplicates_ignoring_timestamp():
+    clock = FakeClock()
+    c = Coalescer(clock=clock)
+    packet = SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8)
+    c.add("arwn/temperature/Outside", packet, False, {"timestamp": 1})
+    assert c.due(everything=True)[0][4] is False
+    same = SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8)
+    c.add("arwn/temperature/Outside", same, False, {"timestamp": 2})
+    assert c.due(everything=True)[0][4] is True
+    warmer = SensorPacket(IS_TEMP, 1, "ec:01", temp=70.0)
+    c.add("arwn/temperature/Outside", warmer, False, {"timestamp": 3})
+    assert c.due(everything=True)[0][4] is False
+    assert c.duplicates == 1
+
+
+def test_mqtt_coalesces_sends():
+    config = {"mqtt": {"coalesce": {"interval": 0.05, "max_delay": 1}}}
+    with patch.object(MQTT, "_start"):
+        mq = MQTT("localhost", config)
+    mq.client = MagicMock()
+    for _ in range(3):
+        mq.send("wind", {"speed": 2.2}, timestamp=5)
+
+    deadline = time.monotonic() + 5.0
+    while not mq.client.publish.called and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    mq.client.publish.assert_called_once()
+    (topic, data), kwargs = mq.client.publish.call_args
+    assert topic == "arwn/wind"
+    assert json.loads(data) == {"speed": 2.2, "timestamp": 5, "duplicate": False}
+
+
+def test_burst_filter_drops_repeats_in_window():
+    clock = FakeClock()
+    f = BurstFilter(window=2.0, clock=clock)
+    assert not f.is_duplicate(SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8))
+    clock.now += 0.2
+    assert f.is_duplicate(SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8))
+    # another sensor bursting at the same time
+    assert not f.is_duplicate(SensorPacket(IS_TEMP, 1, "e9:00", temp=69.8))
+    assert f.is_duplicate(SensorPacket(IS_TEMP, 1, "e9:00", temp=69.8))
+    # a new reading always goes through
+    assert not f.is_duplicate(SensorPacket(IS_TEMP, 1, "ec:01", temp=70.0))
+    clock.now += 2.0
+    # and the same reading does once the burst is over
+    assert not f.is_duplicate(SensorPacket(IS_TEMP, 1, "ec:01", temp=70.0))
+    assert f.suppressed == 2
+
+
+def test_burst_filter_tells_models_apart():
+    f = BurstFilter(clock=FakeClock())
+    temp = SensorPacket(IS_TEMP, 1, "01:00", model="Oregon-THGR810", temp=69.8)
+    rain = SensorPacket(IS_RAIN, 1, "01:00", model="Acurite-Rain899", total=1.0)
+    for _ in range(2):
+        assert not f.is_duplicate(temp) and not f.is_duplicate(rain)
+        # the repeats of each are still caught
+        assert f.is_duplicate(temp) and f.is_duplicate(rain)
+        temp.temp += 1
+        rain.total += 1
+    assert f.suppressed == 4
+
+
+def test_burst_filter_is_bounded():
+    f = BurstFilter(size=2, clock=FakeClock())
+    for sensor_id in ("01:00", "02:00", "03:00"):
+        f.is_duplicate(SensorPacket(IS_RAIN, 1, sensor_id, total=1.0))
+    assert list(f.recent) == [(None, "02:00"), (None, "03:00")]
+    assert not f.is_duplicate(SensorPacket(IS_RAIN, 1, "01:00", total=1.0))
+
+
+@patch("arwn.engine.MQTT")
+@patch("arwn.engine.RFXCOMCollector")
+def test_dispatcher_publishes_burst_once(mock_collector, mock_mqtt):
+    config = make_config({"ec:01": "Outside"})
+    config["dedupe"] = True
+    d = Dispatcher(config)
+    for _ in range(3):
+        d.dispatch(SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8, units="F"))
+    d.mqtt.send.assert_called_once()
+    assert d.mqtt.send.call_args[0][0] == "temperature/Outside"
+    assert d.burst_filter.suppressed == 2
+
+    # off by default
+    config = make_config({"ec:01": "Outside"})
+    mock_mqtt.return_value.send.reset_mock()
+    d = Dispatcher(config)
+    for _ in range(3):
+        d.dispatch(SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8, units="F"))
+    assert d.mqtt.send.call_count == 3
+
+
+@patch("arwn.engine.MQTT")
+@patch("arwn.engine.RFXCOMCollector")
+def test_dispatcher_routes_by_sensor_id(mock_collector, mock_mqtt):
+    d = Dispatcher(make_config({"ec:01": "Outside", "52:02": "Garden"}))
+    d.dispatch(SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8))
+    d.dispatch(SensorPacket(IS_TEMP, 1, "77:00", temp=50.0))
+    d.dispatch(SensorPacket(IS_TEMP | IS_MOIST, 1, "52:02", temp=60.0, moisture=4))
+    # out of range readings are dropped
+    d.dispatch(SensorPacket(IS_TEMP, 1, "ec:01", temp=151.0))
+    d.dispatch(SensorPacket(IS_TEMP | IS_MOIST, 1, "52:02", temp=60.0, moisture=11))
+    topics = [c[0][0] for c in d.mqtt.send.call_args_list]
+    assert topics == [
+        "temperature/Outside",
+        "unknown/77:00",
+        "moisture/Garden",
+        "temperature/Garden",
+    ]
+    assert unknown_route("77:00") is unknown_route("77:00")
+
+
+@patch("arwn.engine.MQTT")
+@patch("arwn.engine.RFXCOMCollector")
+def test_dispatcher_sensor_without_a_name_is_unknown(mock_collector, mock_mqtt):
+    d = Dispatcher(make_config({"ec:01": None, "52:02": ""}))
+    d.dispatch(SensorPacket(IS_TEMP, 1, "ec:01", temp=69.8))
+    d.dispatch(SensorPacket(IS_TEMP | IS_MOIST, 1, "52:02", temp=60.0, moisture=4))
+    topics = [c[0][0] for c in d.mqtt.send.call_args_list]
+    assert topics == ["unknown/ec:01", "unknown/52:02"]
@@ -0,0 +1,159 @@
+"""Tests for publishing to several brokers."""
+
+import socket
+import time
+from unittest.mock import patch
+
+from arwn import engine, fanout, handlers
+from tests.conftest import wait_for_message
+from tests.mqtt_broker import SimpleMQTTBroker
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def test_broker_configs():
+    config = {
+        "names": {},
+        "mqtt": {
+            "server": "local",
+            "root": "house",
+            "encoding": {"default": "json-compact"},
+            "spool": {"path": "/tmp/spool.db"},
+            "brokers": [
+                {"server": "central", "port": 8883, "username": "me"},
+                {"server": "backup", "spool": {"path": "/tmp/backup.db"}},
+            ],
+        },
+    }
+    brokers = fanout.broker_configs(config)
+    assert [(server, port) for server, port, _ in brokers] == [
+        ("local", 1883),
+        ("central", 8883),
+        ("backup", 1883),
+    ]
+    primary, central, backup = [c["mqtt"] for _, _, c in brokers]
+    assert "brokers" not in primary
+    assert primary.get("subscribe", True)
+    assert central["root"] == "house"
+    assert central["encoding"] == {"default": "json-compact"}
+    assert central["username"] == "me"
+    assert not central["subscribe"]
+    assert "spool" not in central
+    assert backup["spool"] == {"path": "/tmp/backup.db"}
+    # the original config is left alone
+    assert len(config["mqtt"]["brokers"]) == 2
+
+
+def test_make_mqtt_single_broker(sim_broker):
+    config = {"names": {}, "mqtt": {"server": "localhost", "port": sim_broker.port}}
+    mq = engine.make_mqtt(config)
+    try:
+        assert isinstance(mq, engine.MQTT)
+        assert mq.handler_client is mq
+    finally:
+        mq.client.loop_stop()
+        mq.client.disconnect()
+
+
+def test_fanout_publishes_to_every_broker(sim_broker, sim_broker_clean):
+    central = SimpleMQTTBroker()
+    central.start()
+    config = {
+        "names": {},
+        "mqtt": {
+            "server": "localhost",
+            "port": sim_broker.port,
+            "brokers": [{"server": "localhost", "port": central.port}],
+        },
+    }
+    handlers.setup()
+    mq = engine.make_mqtt(config)
+    try:
+        assert isinstance(mq, fanout.Fanout)
+        assert mq.primary.handler_client is mq
+        wait_for_message(sim_broker.broker, "arwn/status")
+        wait_for_message(central, "arwn/status")
+        mq.send("rain", {"total": 1.0})
+        wait_for_message(sim_broker.broker, "arwn/rain")
+        wait_for_message(central, "arwn/rain")
+        # only the primary listens, and so runs the handlers
+        assert not any(central.subscriptions.values())
+    finally:
+        for broker in mq.brokers:
+            broker.client.loop_stop()
+            broker.client.disconnect()
+        central.stop()
+
+
+def test_fanout_isolates_a_dead_broker(sim_broker, sim_broker_clean):
+    config = {
+        "names": {},
+        "mqtt": {
+            "server": "localhost",
+            "port": sim_broker.port,
+            # nothing listening here, the constructor mustn't wait for it
+            "brokers": [{"server": "localhost", "port": free_port()}],
+        },
+    }
+    handlers.setup()
+    start = time.monotonic()
+    mq = engine.make_mqtt(config)
+    try:
+        assert time.monotonic() - start < 1.0
+        wait_for_message(sim_broker.broker, "arwn/status")
+        mq.send("wind", {"speed": 3.0})
+        wait_for_message(sim_broker.broker, "arwn/wind")
+        health = mq.health()
+        assert len(health) == 2
+        primary = health["localhost:%d" % sim_broker.port]
+        assert primary["connected"]
+        assert primary["published"] >= 2
+        dead = health["localhost:%d" % config["mqtt"]["brokers"][0]["port"]]
+        assert not dead["connected"]
+        assert dead["acked"] == 0
+    finally:
+        for broker in mq.brokers:
+            broker.client.loop_stop()
+            broker.client.disconnect()
+
+
+def test_fanout_sets_up_the_handlers_once():
+    config = {
+        "names": {},
+        "state": "/tmp/state.json",
+        "mqtt": {
+            "server": "localhost",
+            "brokers": [{"server": "central"}, {"server": "backup"}],
+        },
+    }
+    with patch.object(engine.MQTT, "_start"), patch.object(handlers, "setup") as setup:
+        mq = engine.make_mqtt(config)
+    setup.assert_called_once_with("/tmp/state.json", None)
+    mq.primary.handler_pool.stop()
+
+
+def test_fanout_stop(sim_broker, sim_broker_clean):
+    central = SimpleMQTTBroker()
+    central.start()
+    config = {
+        "names": {},
+        "mqtt": {
+            "server": "localhost",
+            "port": sim_broker.port,
+            "brokers": [{"server": "localhost", "port": central.port}],
+        },
+    }
+    try:
+        mq = engine.make_mqtt(config)
+        wait_for_message(sim_broker.broker, "arwn/status")
+        wait_for_message(central, "arwn/status")
+        mq.stop()
+        for broker in mq.brokers:
+            assert broker.client._thread is None
+            assert not broker.client.is_connected()
+    finally:
+        central.stop()
@@ -9,6 +9,8 @@ Tests for `arwn` module.
 """
 
 import datetime
+import json
+import threading
 import time
 from unittest import mock
 
@@ -247,6 +249,260 @@ def test_updates_over_new_years():
     ]
 
 
+def test_rollover_a_year_later_on_the_same_day_of_the_year():
+    handlers.setup()
+    client = FakeClient()
+    handlers.run(client, "arwn/rain", {"total": 10.0, "timestamp": DAY1})
+    handlers.run(client, "arwn/rain", {"total": 11.0, "timestamp": DAY1H1})
+    year_later = mktime(2018, 1, 1, 9)
+    handlers.run(client, "arwn/rain", {"total": 12.0, "timestamp": year_later})
+    # day 1 of a new year is still a new day
+    assert client.log[-1] == [
+        "rain/today",
+        dict(since_midnight=1.0, timestamp=year_later),
+    ]
+    assert handlers.LAST_RAIN_TOTAL["timestamp"] == year_later
+
+
+def test_rain_state_survives_restart(tmp_path):
+    path = str(tmp_path / "state.json")
+    handlers.setup(path)
+    client = FakeClient()
+    handlers.run(client, "arwn/rain", {"total": 10.0, "timestamp": DAY1})
+    handlers.run(client, "arwn/rain", {"total": 11.0, "timestamp": DAY1H1})
+    assert client.log[-1] == ["rain/today", dict(since_midnight=1.0, timestamp=DAY1H1)]
+
+    # a restart, before the broker's retained total has come back
+    handlers.setup(path)
+    assert handlers.LAST_RAIN_TOTAL == {"total": 10.0, "timestamp": DAY1}
+    assert handlers.LAST_RAIN == {"total": 11.0, "timestamp": DAY1H1}
+    client = FakeClient()
+    handlers.run(client, "arwn/rain", {"total": 12.0, "timestamp": DAY1H1 + 60})
+    assert client.log == [
+        ["rain/today", dict(since_midnight=2.0, timestamp=DAY1H1 + 60)]
+    ]
+
+
+def test_rain_state_reconciled_with_retained_total(tmp_path):
+    path = str(tmp_path / "state.json")
+    handlers.setup(path)
+    client = FakeClient()
+    handlers.run(client, "arwn/rain", {"total": 10.0, "timestamp": DAY2})
+
+    handlers.setup(path)
+    client = mock.MagicMock()
+    # the broker's retained total is from the day before, ours wins and
+    # the broker is put right
+    handlers.run(client, "arwn/totals/rain", {"total": 5.0, "timestamp": DAY1})
+    assert handlers.LAST_RAIN_TOTAL == {"total": 10.0, "timestamp": DAY2}
+    client.send.assert_called_once_with(
+        "totals/rain", {"total": 10.0, "timestamp": DAY2}, retain=True
+    )
+
+    # a newer retained total is taken, and saved
+    newer = {"total": 12.0, "timestamp": DAY3_1200}
+    handlers.run(client, "arwn/totals/rain", newer)
+    assert handlers.LAST_RAIN_TOTAL == newer
+    handlers.setup(path)
+    assert handlers.LAST_RAIN_TOTAL == newer
+
+
+def test_rain_state_saved_sparingly(tmp_path, monkeypatch):
+    path = tmp_path / "state.json"
+    handlers.setup(str(path))
+    client = FakeClient()
+    handlers.run(client, "arwn/rain", {"total": 10.0, "timestamp": DAY1})
+    saved = path.read_text()
+    # more readings, and nothing written until the interval is up
+    handlers.run(client, "arwn/rain", {"total": 10.5, "timestamp": DAY1 + 60})
+    handlers.run(client, "arwn/rain", {"total": 11.0, "timestamp": DAY1 + 120})
+    assert path.read_text() == saved
+    assert handlers.UNSAVED
+
+    # a new total is saved straight away
+    total = {"total": 11.0, "timestamp": DAY1 + 120}
+    handlers.run(client, "arwn/totals/rain", total)
+    assert json.loads(path.read_text())["last_rain_total"] == total
+    assert not handlers.UNSAVED
+
+    handlers.run(client, "arwn/rain", {"total": 11.5, "timestamp": DAY1 + 180})
+    monkeypatch.setattr(handlers, "SAVE_INTERVAL", 0)
+    handlers.run(client, "arwn/rain", {"total": 12.0, "timestamp": DAY1 + 240})
+    assert json.loads(path.read_text())["last_rain"]["total"] == 12.0
+
+    # and whatever is left on shutdown
+    monkeypatch.setattr(handlers, "SAVE_INTERVAL", 600.0)
+    handlers.run(client, "arwn/rain", {"total": 12.5, "timestamp": DAY1 + 300})
+    assert json.loads(path.read_text())["last_rain"]["total"] == 12.0
+    handlers.flush_state()
+    assert json.loads(path.read_text())["last_rain"]["total"] == 12.5
+
+
+def test_mqtt_stop_flushes_rain_state(tmp_path):
+    path = tmp_path / "state.json"
+    config = {"mqtt": {}, "names": {}, "state": str(path)}
+    with mock.patch.object(engine.MQTT, "_start"):
+        mq = engine.MQTT("localhost", config)
+    mq.client = mock.MagicMock()
+    handlers.run(FakeClient(), "arwn/rain", {"total": 10.0, "timestamp": DAY1})
+    handlers.run(FakeClient(), "arwn/rain", {"total": 11.0, "timestamp": DAY1H1})
+    mq.stop()
+    assert json.loads(path.read_text())["last_rain"]["total"] == 11.0
+
+
+def test_no_state_without_a_path(tmp_path):
+    handlers.setup(str(tmp_path / "state.json"))
+    handlers.setup()
+    handlers.run(FakeClient(), "arwn/rain", {"total": 10.0, "timestamp": DAY1})
+    assert handlers.STATE is None
+
+
 # TODO(sdague): test case for what happens when the data on the
 # rain guage gets reset due to battery replacement. I have one of
 # these events coming up this year.
+
+
+def test_routes_only_matching_handlers():
+    names = {
+        topic: [type(h).__name__ for h in handlers.ROUTER.route(topic)]
+        for topic in (
+            "arwn/rain",
+            "arwn/totals/rain",
+            "arwn/rain/today",
+            "arwn/temperature/Outside",
+            "arwn/temperature/Garden",
+        )
+    }
+    assert names == {
+        "arwn/rain": [
+            "UpdateTodayRain",
+            "InitializeLastRainIfNotThere",
+            "ComputeRainTotal",
+            "TodaysRain",
+        ],
+        "arwn/totals/rain": ["RecordRainTotal", "ComputeRainTotal"],
+        "arwn/rain/today": ["ComputeRainTotal", "WeatherUnderground"],
+        "arwn/temperature/Outside": ["ComputeRainTotal", "WeatherUnderground"],
+        "arwn/temperature/Garden": ["ComputeRainTotal"],
+    }
+
+
+def test_action_run_on_its_own():
+    seen = []
+
+    class Barometer(handlers.MQTTAction):
+        regex = r"/barometer$"
+
+        def action(self, client, topic, payload):
+            seen.append(topic)
+
+    action = Barometer()
+    action.run(None, "arwn/barometer", {})
+    action.run(None, "arwn/wind", {})
+    assert seen == ["arwn/barometer"]
+
+
+class Recorder(handlers.MQTTAction):
+    def __init__(self, name, topics, lane=None, gate=None):
+        self.name = name
+        self.topics = topics
+        self.lane = lane
+        self.gate = gate
+        self.seen = []
+
+    def action(self, client, topic, payload):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.seen.append((self.name, payload))
+
+
+def install(*actions):
+    handlers.HANDLERS = list(actions)
+    handlers.ROUTER = handlers.make_router(handlers.HANDLERS)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_pool_keeps_lane_order_and_isolates_slow_lanes():
+    gate = threading.Event()
+    log = []
+    first = Recorder("first", ("+/rain",), lane="rain")
+    second = Recorder("second", ("+/rain",), lane="rain")
+    first.seen = second.seen = log
+    slow = Recorder("slow", ("+/#",), gate=gate)
+    install(first, second, slow)
+    pool = handlers.HandlerPool()
+    try:
+        for i in range(3):
+            pool.submit(None, "arwn/rain", i)
+        # the slow handler is stuck, the rain lane carries on
+        wait_for(lambda: len(log) == 6)
+        assert log == [(name, i) for i in range(3) for name in ("first", "second")]
+        assert slow.seen == []
+        assert pool.snapshot()["lanes"]["Recorder"]["queue_depth"] >= 2
+        gate.set()
+        wait_for(lambda: len(slow.seen) == 3)
+        assert [payload for _, payload in slow.seen] == [0, 1, 2]
+    finally:
+        gate.set()
+        pool.stop()
+
+    snap = pool.snapshot()
+    assert snap["handled"] == 6
+    assert set(snap["lanes"]) == {"rain", "Recorder"}
+    assert snap["lanes"]["rain"]["dropped"] == 0
+    assert "p99" in snap["latency_ms"]["Recorder"]
+    assert "max" in snap["latency_ms"]["queued"]
+
+
+@pytest.mark.parametrize(
+    "overflow, handled", [("drop_oldest", [0, 3, 4]), ("drop_newest", [0, 1, 2])]
+)
+def test_pool_overflow(overflow, handled):
+    gate = threading.Event()
+    action = Recorder("action", ("+/wind",), gate=gate)
+    install(action)
+    pool = handlers.HandlerPool(queue_size=2, overflow=overflow)
+    try:
+        pool.submit(None, "arwn/wind", 0)
+        # wait for the first to be taken off the queue, and block
+        wait_for(lambda: pool.queue_depth == 0)
+        for i in range(1, 5):
+            pool.submit(None, "arwn/wind", i)
+        assert pool.snapshot()["lanes"]["Recorder"]["dropped"] == 2
+        gate.set()
+    finally:
+        gate.set()
+        pool.stop()
+    assert [payload for _, payload in action.seen] == handled
+
+
+def test_pool_unknown_overflow():
+    with pytest.raises(ValueError):
+        handlers.HandlerPool(overflow="explode")
+
+
+def test_pool_lane_sending_to_itself_does_not_block():
+    pool = handlers.HandlerPool(queue_size=1, overflow="block")
+
+    class Resender(Recorder):
+        def action(self, client, topic, payload):
+            super(Resender, self).action(client, topic, payload)
+            if payload < 3:
+                # as a handler's send is, with local delivery
+                pool.submit(client, topic, payload + 1)
+                pool.submit(client, topic, payload + 10)
+
+    action = Resender("action", ("+/rain",))
+    install(action)
+    try:
+        pool.submit(None, "arwn/rain", 0)
+        wait_for(lambda: len(action.seen) == 7)
+    finally:
+        pool.stop()
+    assert [payload for _, payload in action.seen] == [0, 1, 10, 2, 11, 3, 12]
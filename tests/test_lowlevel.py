@@ -0,0 +1,114 @@
+"""Tests for the vendored RFXtrx low level packet parser."""
+
+import pytest
+
+from arwn.vendor.RFXtrx import lowlevel
+
+TEMP_HUMID = bytearray(
+    [0x0A, 0x52, 0x02, 0x11, 0xEC, 0x01, 0x80, 0x2D, 0x2D, 0x02, 0x69]
+)
+RAIN = bytearray(
+    [0x0B, 0x55, 0x02, 0x13, 0x65, 0x00, 0x00, 0x7B, 0x00, 0x10, 0x2C, 0x69]
+)
+WIND = bytearray(
+    [0x10, 0x56, 0x01, 0x14, 0x33, 0x00, 0x00, 0xB4, 0x00, 0x21, 0x00,
+     0x3A, 0x00, 0x00, 0x00, 0x00, 0x69]
+)  # fmt: skip
+
+
+def test_parse_temp_humid():
+    pkt = lowlevel.parse(TEMP_HUMID)
+    assert isinstance(pkt, lowlevel.TempHumid)
+    assert pkt.id_string == "ec:01"
+    assert pkt.temp == -4.5
+    assert pkt.humidity == 0x2D
+    assert pkt.battery == 9
+    assert pkt.rssi == 6
+    assert pkt.type_string == "THGR810, THGN800"
+
+
+def test_parse_rain():
+    pkt = lowlevel.parse(RAIN)
+    assert isinstance(pkt, lowlevel.RainGauge)
+    assert pkt.id_string == "65:00"
+    assert pkt.rainrate == 0.123
+    assert pkt.raintotal == 414.0
+
+
+def test_parse_wind():
+    pkt = lowlevel.parse(WIND)
+    assert isinstance(pkt, lowlevel.Wind)
+    assert pkt.id_string == "33:00"
+    assert pkt.direction == 180
+    assert pkt.average_speed == 3.3
+    assert pkt.gust == 5.8
+
+
+def test_parse_unknown_type():
+    assert lowlevel.parse(bytearray([0x07, 0x7F, 0x00, 0x00, 0, 0, 0, 0])) is None
+
+
+def test_packets_have_no_dict():
+    pkt = lowlevel.parse(TEMP_HUMID)
+    assert not hasattr(pkt, "__dict__")
+    with pytest.raises(AttributeError):
+        pkt.not_a_field = 1
+
+
+@pytest.mark.parametrize("ptype", sorted(lowlevel.PACKET_TYPES))
+@pytest.mark.parametrize("subtype", [0x01, 0x02, 0x03])
+def test_load_receive_populates_all_slots(ptype, subtype):
+    """parse() skips __init__, so load_receive must set every slot."""
+    data = bytearray([0x14, ptype, subtype, 0x01] + [0x41] * 20)
+    pkt = lowlevel.parse(data)
+    cls = lowlevel.PACKET_TYPES[ptype]
+    slots = [s for k in cls.__mro__ for s in getattr(k, "__slots__", ())]
+    missing = [s for s in slots if not hasattr(pkt, s)]
+    assert missing == []
+
+
+TEMP_HUMID_BARO = bytearray(
+    [0x0D, 0x54, 0x02, 0x12, 0xE9, 0x00, 0x00, 0xC8, 0x30, 0x02, 0x03,
+     0xF5, 0x01, 0x69]
+)  # fmt: skip
+
+SENSOR_FIELDS = {
+    lowlevel.TempHumid: ("temp", "humidity"),
+    lowlevel.TempHumidBaro: ("temp", "humidity", "baro"),
+    lowlevel.RainGauge: ("rainrate", "raintotal"),
+    lowlevel.Wind: ("direction", "average_speed", "gust"),
+}
+
+
+@pytest.mark.parametrize("frame", [TEMP_HUMID, TEMP_HUMID_BARO, RAIN, WIND])
+def test_parse_sensor_matches_parse(frame):
+    full = lowlevel.parse(frame)
+    fast = lowlevel.parse_sensor(frame)
+    assert type(fast) is type(full)
+    for field in ("id_string", "battery") + SENSOR_FIELDS[type(full)]:
+        assert getattr(fast, field) == getattr(full, field), field
+
+
+def test_parse_sensor_accepts_memoryview():
+    buf = bytearray(b"\xff\xff") + TEMP_HUMID
+    pkt = lowlevel.parse_sensor(memoryview(buf)[2:])
+    assert pkt.id_string == "ec:01"
+    assert pkt.temp == -4.5
+
+
+def test_parse_sensor_skips_strings():
+    pkt = lowlevel.parse_sensor(TEMP_HUMID)
+    assert not hasattr(pkt, "type_string")
+
+
+def test_parse_sensor_unknown_type():
+    assert (
+        lowlevel.parse_sensor(bytearray([0x08, 0x50, 0x01, 0, 0, 0, 0, 0, 0])) is None
+    )
+
+
+def test_temp_humid_baro_decodes_pressure():
+    pkt = lowlevel.parse(TEMP_HUMID_BARO)
+    assert pkt.temp == 20.0
+    assert pkt.baro == 0x3F5
+    assert pkt.forecast == 0x01
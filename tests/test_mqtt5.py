@@ -0,0 +1,158 @@
+"""Tests for the MQTT v5 publishing options."""
+
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from arwn import engine, handlers, mqtt5
+from tests.conftest import wait_for_message
+
+
+def stop(mq):
+    mq.client.loop_stop()
+    mq.client.disconnect()
+
+
+def test_topic_aliases():
+    aliases = mqtt5.TopicAliases(2)
+    assert aliases.get("arwn/rain") == ("arwn/rain", 1)
+    assert aliases.get("arwn/rain") == ("", 1)
+    assert aliases.get("arwn/wind") == ("arwn/wind", 2)
+    # out of aliases, the rest go out in full
+    assert aliases.get("arwn/temperature/Outside") == ("arwn/temperature/Outside", None)
+    assert aliases.get("arwn/temperature/Outside") == ("arwn/temperature/Outside", None)
+    assert aliases.get("arwn/wind") == ("", 2)
+
+
+def test_publish_properties():
+    assert mqtt5.publish_properties() is None
+    props = mqtt5.publish_properties(3, "ec:01", 600)
+    expected = Properties(PacketTypes.PUBLISH)
+    expected.TopicAlias = 3
+    expected.UserProperty = ("sensor_id", "ec:01")
+    expected.MessageExpiryInterval = 600
+    assert props.pack() == expected.pack()
+    assert props.pack() is props.pack()
+    cached = mqtt5.cached_publish_properties
+    assert cached(None, "ec:01", None) is cached(None, "ec:01", None)
+
+
+def test_publish_properties_without_a_sensor_id():
+    # what an rtl_433 record without an id gets
+    assert mqtt5.publish_properties(None, 0, None) is None
+    assert mqtt5.publish_properties(None, "", None) is None
+    props = mqtt5.publish_properties(None, 0, 600)
+    expected = Properties(PacketTypes.PUBLISH)
+    expected.MessageExpiryInterval = 600
+    assert props.pack() == expected.pack()
+
+
+def test_v5_publish_without_a_sensor_id():
+    config = {"mqtt": {"version": 5}, "names": {}, "handlers": False}
+    with patch.object(engine.MQTT, "_start"):
+        mq = engine.MQTT("localhost", config)
+    mq.client = MagicMock()
+    mq.client.publish.return_value = SimpleNamespace(mid=1, rc=0)
+    mq.send("rain", engine.SensorPacket(engine.IS_RAIN, 1, total=1.0))
+    assert mq.client.publish.call_args.kwargs["properties"] is None
+
+
+def test_unknown_version():
+    with pytest.raises(ValueError):
+        engine.MQTT("localhost", {"mqtt": {"version": 4}})
+
+
+def test_v5_publish(sim_broker, sim_broker_clean):
+    config = {
+        # keep the handlers' own publishes from taking aliases
+        "mqtt": {"version": 5, "message_expiry": 600, "local_handlers": False},
+        "names": {},
+        "handlers": False,
+    }
+    handlers.setup()
+    mq = engine.MQTT("localhost", config, port=sim_broker.port)
+    try:
+        wait_for_message(sim_broker.broker, "arwn/status")
+        packet = engine.SensorPacket("rain", 1, "65:00", total=1.0, rate=0.0)
+        for i in range(3):
+            mq.send("rain", packet, timestamp=1000 + i)
+        mq.send("totals/rain", {"total": 1.0})
+        deadline = time.monotonic() + 2.0
+        while len(sim_broker.broker.messages) < 5 and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+        rain = [m for m in sim_broker.broker.messages if m.topic == "arwn/rain"]
+        assert len(rain) == 3
+        for msg in rain:
+            assert msg.properties["topic_alias"] == 1
+            assert msg.properties["user_property"] == [("sensor_id", "65:00")]
+            assert msg.properties["message_expiry_interval"] == 600
+        # sent in full once, then by alias alone
+        assert mq.aliases.aliases == {"arwn/rain": 1, "arwn/totals/rain": 2}
+
+        totals = wait_for_message(sim_broker.broker, "arwn/totals/rain")
+        assert "user_property" not in totals.properties
+    finally:
+        stop(mq)
+
+
+def test_v5_no_aliases_without_broker_support(sim_broker, sim_broker_clean):
+    sim_broker.broker.topic_alias_maximum = 0
+    config = {"mqtt": {"version": 5}, "names": {}}
+    handlers.setup()
+    mq = engine.MQTT("localhost", config, port=sim_broker.port)
+    try:
+        wait_for_message(sim_broker.broker, "arwn/status")
+        assert mq.aliases is None
+        mq.send("wind", {"speed": 1.0})
+        msg = wait_for_message(sim_broker.broker, "arwn/wind")
+        assert msg.properties == {}
+    finally:
+        stop(mq)
+        sim_broker.broker.topic_alias_maximum = 10
+
+
+@pytest.mark.parametrize("version", [3, 5])
+def test_spooled_messages_expire(sim_broker, sim_broker_clean, tmp_path, version):
+    config = {
+        "mqtt": {
+            "version": version,
+            "message_expiry": 600,
+            "spool": {"path": str(tmp_path / "spool.db"), "rate": 1000},
+        },
+        "names": {},
+    }
+    handlers.setup()
+    # as if the broker were down
+    mq = engine.MQTT("localhost", config, port=1)
+    try:
+        packet = engine.SensorPacket("rain", 1, "65:00", total=1.0, rate=0.0)
+        mq.send("rain", packet, timestamp=1000)
+        mq.send("rain", packet, timestamp=2000)
+        # the first one was spooled an hour ago
+        mq.spool._db.execute(
+            "UPDATE spool SET created = created - 3600 WHERE id = "
+            "(SELECT MIN(id) FROM spool)"
+        )
+
+        mq.client.connect_async("localhost", sim_broker.port)
+        msg = wait_for_message(sim_broker.broker, "arwn/rain", timeout=5.0)
+        deadline = time.monotonic() + 5.0
+        while len(mq.spool) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert len(mq.spool) == 0
+        assert mq.expired == 1
+        rain = [m for m in sim_broker.broker.messages if m.topic == "arwn/rain"]
+        assert len(rain) == 1
+        assert b"2000" in msg.payload
+        if version == 5:
+            assert 0 < msg.properties["message_expiry_interval"] <= 600
+            assert msg.properties["user_property"] == [("sensor_id", "65:00")]
+        else:
+            assert msg.properties == {}
+    finally:
+        stop(mq)
@@ -0,0 +1,277 @@
+"""Tests for MQTT publish options and statistics."""
+
+import json
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import paho.mqtt.client as paho
+
+from arwn import engine, handlers
+from arwn.echoes import EchoFilter
+from arwn.stats import PublishStats
+from tests.conftest import wait_for_message
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def info(mid, rc=paho.MQTT_ERR_SUCCESS):
+    return SimpleNamespace(mid=mid, rc=rc)
+
+
+def test_publish_stats_latency_and_depth():
+    clock = FakeClock()
+    stats = PublishStats(clock=clock)
+    stats.sent(info(1))
+    stats.sent(info(2))
+    assert stats.queue_depth == 2
+    clock.now += 0.010
+    stats.ack(1)
+    clock.now += 0.020
+    stats.ack(2)
+    # paho ran on_publish before publish() returned
+    stats.ack(3)
+    stats.sent(info(3))
+    stats.sent(info(4, rc=paho.MQTT_ERR_QUEUE_SIZE))
+
+    snap = stats.snapshot()
+    assert snap["published"] == 3
+    assert snap["acked"] == 3
+    assert snap["failed"] == 1
+    assert snap["queue_depth"] == 0
+    assert snap["max_queue_depth"] == 2
+    assert snap["latency_ms"]["max"] == 30.0
+    assert snap["latency_ms"]["p50"] == 10.0
+
+
+def test_publish_stats_failures_and_disconnects():
+    clock = FakeClock()
+    stats = PublishStats(clock=clock)
+    # not connected, paho hands back a mid but never calls on_publish
+    stats.sent(info(1, rc=paho.MQTT_ERR_NO_CONN))
+    stats.sent(info(2))
+    stats.sent(info(3))
+    assert stats.queue_depth == 2
+    # the connection drops before either went out
+    stats.disconnected()
+    assert stats.queue_depth == 0
+    # a resend after reconnecting, the mid reused later on
+    stats.ack(2)
+    clock.now += 5.0
+    stats.sent(info(2))
+    assert stats.queue_depth == 1
+    clock.now += 0.5
+    stats.ack(2)
+
+    snap = stats.snapshot()
+    assert snap["published"] == 3
+    assert snap["failed"] == 1
+    assert snap["dropped"] == 2
+    assert snap["acked"] == 1
+    assert snap["latency_ms"]["max"] == 500.0
+
+
+def test_publish_stats_empty_snapshot():
+    snap = PublishStats().snapshot()
+    assert snap["published"] == 0
+    assert snap["latency_ms"] == {}
+
+
+def test_mqtt_topic_options():
+    config = {
+        "mqtt": {
+            "max_inflight": 5,
+            "max_queued": 50,
+            "topics": {
+                "totals": {"qos": 1, "retain": True},
+                "temperature": {"qos": 1},
+                "temperature/Outside": {"retain": False},
+            },
+        }
+    }
+    with patch.object(engine.MQTT, "_start"):
+        mq = engine.MQTT("localhost", config)
+    assert mq.client._max_inflight_messages == 5
+    assert mq.client._max_queued_messages == 50
+
+    mq.client = MagicMock()
+    mq.client.publish.return_value = info(1)
+    mq.send("totals/rain", {"total": 1})
+    mq.send("temperature/Outside", {"temp": 50}, retain=True)
+    mq.send("wind", {"speed": 1}, retain=True)
+    calls = [
+        (c.args[0], c.kwargs["qos"], c.kwargs["retain"])
+        for c in mq.client.publish.call_args_list
+    ]
+    assert calls == [
+        ("arwn/totals/rain", 1, True),
+        ("arwn/temperature/Outside", 1, False),
+        ("arwn/wind", 0, True),
+    ]
+
+
+def test_mqtt_counts_acks(sim_broker, sim_broker_clean):
+    config = {
+        # only count our own publishes, not the rain handlers'
+        "mqtt": {"topics": {"rain": {"qos": 1}}, "local_handlers": False},
+        "names": {},
+    }
+    handlers.setup()
+    mq = engine.MQTT("localhost", config, port=sim_broker.port)
+    try:
+        wait_for_message(sim_broker.broker, "arwn/status", timeout=2.0)
+        # the sim broker never completes the QoS 2 flow of the status
+        # message, so only count what happens from here on
+        published, acked = mq.stats.published, mq.stats.acked
+        for i in range(5):
+            mq.send("rain", {"total": i})
+        deadline = time.monotonic() + 5.0
+        while mq.stats.acked < acked + 5 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        snap = mq.stats.snapshot()
+        assert snap["published"] == published + 5
+        assert snap["acked"] == acked + 5
+        assert "p99" in snap["latency_ms"]
+    finally:
+        mq.client.loop_stop()
+        mq.client.disconnect()
+
+
+def test_echo_filter():
+    clock = FakeClock()
+    echoes = EchoFilter(window=60.0, clock=clock)
+    echoes.add("arwn/rain", b"1")
+    echoes.add("arwn/rain", b"1")
+    assert echoes.is_echo("arwn/rain", b"1")
+    assert echoes.is_echo("arwn/rain", b"1")
+    # someone else's, or a second copy of ours
+    assert not echoes.is_echo("arwn/rain", b"1")
+    assert echoes.skipped == 2
+    echoes.add("arwn/wind", b"1")
+    echoes.discard("arwn/wind", b"1")
+    assert not echoes.is_echo("arwn/wind", b"1")
+
+
+def test_echo_filter_keeps_a_burst():
+    echoes = EchoFilter(clock=FakeClock())
+    # far more than the 1024 a size bound used to keep
+    for i in range(5000):
+        echoes.add("arwn/rain", b"%d" % i)
+    assert all(echoes.is_echo("arwn/rain", b"%d" % i) for i in range(5000))
+    assert not echoes.sent
+
+
+def test_echo_filter_forgets_after_the_window():
+    clock = FakeClock()
+    echoes = EchoFilter(window=60.0, clock=clock)
+    echoes.add("arwn/rain", b"lost")
+    echoes.add("arwn/rain", b"resent")
+    clock.now += 30
+    # the connection drops, and comes back a long while later
+    echoes.reconnected()
+    clock.now += 45
+    echoes.add("arwn/wind", b"1")
+    assert echoes.is_echo("arwn/rain", b"resent")
+    clock.now += 60
+    echoes.add("arwn/wind", b"2")
+    assert list(echoes.sent) == [("arwn/wind", b"2")]
+    assert not echoes.is_echo("arwn/rain", b"lost")
+
+
+def wait_subscribed(mq, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while mq._held is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert mq._held is None
+
+
+def test_mqtt_delivers_to_handlers_locally(sim_broker, sim_broker_clean, monkeypatch):
+    config = {"mqtt": {}, "names": {}}
+    handlers.setup()
+    seen = []
+    monkeypatch.setattr(
+        engine.MQTT,
+        "_run_handlers",
+        lambda self, topic, payload: seen.append((topic, payload)),
+    )
+    mq = engine.MQTT("localhost", config, port=sim_broker.port)
+    try:
+        wait_subscribed(mq)
+        packet = engine.SensorPacket(engine.IS_RAIN, 1, "65:00", total=1.5)
+        mq.send("rain", packet, timestamp=5)
+        # before the broker has it
+        assert seen == [
+            (
+                "arwn/rain",
+                {"bat": 1, "sensor_id": "65:00", "total": 1.5, "timestamp": 5},
+            )
+        ]
+        msg = wait_for_message(sim_broker.broker, "arwn/rain", timeout=2.0)
+
+        # the broker's copy isn't run again
+        echo = SimpleNamespace(topic="arwn/rain", payload=msg.payload)
+        mq.client.on_message(mq.client, None, echo)
+        assert len(seen) == 1
+        assert mq.health()["echoes_skipped"] == 1
+        # but someone else publishing the same is
+        mq.client.on_message(mq.client, None, echo)
+        assert len(seen) == 2
+    finally:
+        mq.client.loop_stop()
+        mq.client.disconnect()
+
+
+def test_mqtt_only_subscriber_delivers_locally():
+    config = {"mqtt": {"subscribe": False}, "names": {}}
+    with patch.object(engine.MQTT, "_start"):
+        mq = engine.MQTT("localhost", config)
+    assert mq.echoes is None
+    config = {"mqtt": {"local_handlers": False}, "names": {}}
+    with patch.object(engine.MQTT, "_start"):
+        mq = engine.MQTT("localhost", config)
+    assert mq.echoes is None
+    mq.handler_pool.stop()
+    # the handlers only ever run on the network thread
+    config = {"mqtt": {}, "names": {}, "handlers": False}
+    with patch.object(engine.MQTT, "_start"):
+        mq = engine.MQTT("localhost", config)
+    assert mq.echoes is None
+
+
+def test_mqtt_holds_local_delivery_until_subscribed(
+    sim_broker, sim_broker_clean, tmp_path
+):
+    config = {
+        "mqtt": {"spool": {"path": str(tmp_path / "spool.db"), "rate": 1000}},
+        "names": {},
+    }
+    now = int(time.time())
+    total = {"bat": 1, "sensor_id": "65:00", "total": 1.0, "timestamp": now - 1}
+    sim_broker.broker.retained["arwn/totals/rain"] = json.dumps(total).encode()
+    handlers.setup()
+    # the broker is unreachable at startup
+    mq = engine.MQTT("localhost", config, port=1)
+    try:
+        packet = engine.SensorPacket(engine.IS_RAIN, 1, "65:00", total=2.5)
+        mq.send("rain", packet, timestamp=now)
+        time.sleep(0.1)
+        assert handlers.LAST_RAIN is None
+
+        mq.client.connect_async("localhost", sim_broker.port)
+        msg = wait_for_message(sim_broker.broker, "arwn/rain/today", timeout=5.0)
+        assert json.loads(msg.payload) == {"timestamp": now, "since_midnight": 1.5}
+        # the day's total wasn't reset to the first reading
+        assert handlers.LAST_RAIN_TOTAL == total
+        assert json.loads(sim_broker.broker.retained["arwn/totals/rain"]) == total
+        assert not [
+            m for m in sim_broker.broker.messages if m.topic == "arwn/totals/rain"
+        ]
+    finally:
+        mq.stop()
+        mq.handler_pool.stop()
@@ -0,0 +1,69 @@
+"""Tests for the RFXtrx serial frame reassembly."""
+
+from unittest.mock import patch
+
+from arwn.vendor.RFXtrx.pyserial import FrameReader, PySerialTransport
+
+TEMP_HUMID = bytes([0x0A, 0x52, 0x02, 0x11, 0xEC, 0x01, 0x00, 0xD2, 0x2D, 0x02, 0x69])
+RAIN = bytes([0x0B, 0x55, 0x02, 0x13, 0x65, 0x00, 0x00, 0x7B, 0x00, 0x10, 0x2C, 0x69])
+
+
+def test_splits_every_frame_in_one_read():
+    reader = FrameReader()
+    reader.feed(TEMP_HUMID + RAIN + TEMP_HUMID)
+    assert reader.frames() == [TEMP_HUMID, RAIN, TEMP_HUMID]
+    assert reader.buffer == b""
+
+
+def test_keeps_partial_frame():
+    reader = FrameReader()
+    reader.feed(TEMP_HUMID + RAIN[:5])
+    assert reader.frames() == [TEMP_HUMID]
+    assert reader.needed() == len(RAIN) - 5
+    reader.feed(RAIN[5:])
+    assert reader.frames() == [RAIN]
+    assert reader.needed() == 1
+
+
+def test_resyncs_after_out_of_range_bytes():
+    reader = FrameReader()
+    reader.feed(b"\xff\x00\x01" + RAIN + TEMP_HUMID)
+    assert reader.frames() == [RAIN, TEMP_HUMID]
+    assert reader.dropped == 3
+
+
+def test_resyncs_after_length_not_matching_type():
+    reader = FrameReader()
+    # the start of a rain packet with a corrupt length, then a good one
+    reader.feed(b"\x0a\x55" + RAIN)
+    assert reader.frames() == [RAIN]
+    assert reader.dropped == 2
+
+
+class FakeSerial:
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.reads = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+    def read(self, size=1):
+        self.reads += 1
+        chunk = bytes(self.data[:size])
+        del self.data[:size]
+        return chunk
+
+
+@patch("arwn.vendor.RFXtrx.pyserial.Serial")
+def test_transport_reads_burst_in_one_call(mock_serial):
+    fake = FakeSerial(TEMP_HUMID + RAIN + TEMP_HUMID)
+    mock_serial.return_value = fake
+    transport = PySerialTransport("/dev/ttyUSB0")
+
+    assert transport.receive_frame() == TEMP_HUMID
+    assert transport.receive_frame() == RAIN
+    assert transport.receive_frame() == TEMP_HUMID
+    assert fake.reads == 1
+    assert mock_serial.call_args.kwargs["timeout"] is None
@@ -0,0 +1,151 @@
+"""Tests for rtl_433 json ingestion."""
+
+import json
+import logging
+import sys
+from unittest.mock import patch
+
+import pytest
+
+from arwn import engine
+
+THGR810 = {
+    "model": "Oregon-THGR810",
+    "id": 236,
+    "channel": 1,
+    "battery_ok": 1,
+    "temperature_C": 21.0,
+    "humidity": 45,
+}
+WGR800 = {
+    "model": "Oregon-WGR800",
+    "id": 51,
+    "battery_ok": 1,
+    "wind_avg_m_s": 1.0,
+    "wind_max_m_s": 2.0,
+    "wind_dir_deg": 90,
+}
+
+
+def test_line_splitter_splits_chunk():
+    splitter = engine.LineSplitter()
+    lines = splitter.feed(b'{"a": 1}\n{"b": 2}\n\n{"c"')
+    assert [bytes(line) for line in lines] == [b'{"a": 1}', b'{"b": 2}']
+    assert all(isinstance(line, memoryview) for line in lines)
+    assert splitter.feed(b": 3}") == []
+    assert [bytes(line) for line in splitter.feed(b"\n")] == [b'{"c": 3}']
+    assert splitter.partial == b""
+
+
+@pytest.mark.parametrize("backend", engine.JSON_BACKENDS)
+def test_json_loader_accepts_memoryview(backend):
+    pytest.importorskip(backend)
+    loads = engine.json_loader(backend)
+    assert loads(memoryview(b'{"id": 5}')) == {"id": 5}
+
+
+def test_json_loader_falls_back_to_stdlib():
+    real_import = engine.importlib.import_module
+
+    def no_fast_json(name):
+        if name != "json":
+            raise ImportError(name)
+        return real_import(name)
+
+    with patch.object(engine.importlib, "import_module", no_fast_json):
+        loads = engine.json_loader()
+    assert loads(b"[1, 2]") == [1, 2]
+
+
+def test_json_loader_missing_named_backend():
+    with pytest.raises(ImportError):
+        engine.json_loader("not_a_json_library")
+
+
+def spawn_printing(*records):
+    script = "import sys; sys.stdout.write(%r)" % "".join(
+        "%s\n" % json.dumps(r) if isinstance(r, dict) else r for r in records
+    )
+    return lambda self: engine.subprocess.Popen(
+        [sys.executable, "-c", script], stdout=engine.subprocess.PIPE, bufsize=0
+    )
+
+
+def test_collector_reads_records():
+    with patch.object(
+        engine.RTL433Collector, "_spawn", spawn_printing(THGR810, "garbage\n", WGR800)
+    ):
+        collector = engine.RTL433Collector()
+        packets = list(collector)
+
+    assert len(packets) == 3
+    assert packets[0].sensor_id == "ec:01"
+    assert packets[0].data["temp"] == 69.8
+    assert packets[1] is None
+    assert packets[2].is_wind
+
+
+def test_collector_skips_log_formatting_without_debug(caplog):
+    caplog.set_level(logging.INFO, logger="arwn.engine")
+    with patch.object(engine.RTL433Collector, "_spawn", spawn_printing(THGR810)):
+        collector = engine.RTL433Collector()
+        with patch.object(engine.RTL433Collector, "log_data") as log_data:
+            list(collector)
+    log_data.assert_not_called()
+
+
+NEIGHBOUR = {"model": "Acurite-Tower", "id": 1234, "channel": "A", "temperature_C": 5}
+DOORBELL = {"model": "Generic-Remote", "id": 17, "cmd": 2}
+
+
+def line(record):
+    return memoryview(json.dumps(record).encode())
+
+
+def test_prefilter_keeps_known_models():
+    with patch.object(engine.RTL433Collector, "_spawn", lambda self: None):
+        collector = engine.RTL433Collector()
+    assert collector.wanted(line(THGR810))
+    assert collector.wanted(line(WGR800))
+    assert not collector.dropped
+
+
+def test_prefilter_drops_unknown_models(caplog):
+    caplog.set_level(logging.INFO, logger="arwn.engine")
+    with patch.object(engine.RTL433Collector, "_spawn", lambda self: None):
+        collector = engine.RTL433Collector()
+    assert collector._packet(line(DOORBELL)) is None
+    assert collector._packet(line(DOORBELL)) is None
+    assert collector.dropped == {"Generic-Remote": 2}
+    assert caplog.text.count("Ignoring rtl_433 model Generic-Remote") == 1
+
+
+def test_prefilter_keeps_named_sensors():
+    with patch.object(engine.RTL433Collector, "_spawn", lambda self: None):
+        collector = engine.RTL433Collector(names={"11:00": "Doorbell"})
+    assert collector.wanted(line(DOORBELL))
+
+
+def test_prefilter_passes_what_it_cannot_parse():
+    with patch.object(engine.RTL433Collector, "_spawn", lambda self: None):
+        collector = engine.RTL433Collector()
+    # non numeric channel, no model, and not json at all
+    assert collector.wanted(line(NEIGHBOUR))
+    assert collector.wanted(line({"id": 1}))
+    assert collector.wanted(memoryview(b"garbage"))
+
+
+def test_prefilter_can_be_disabled():
+    with patch.object(engine.RTL433Collector, "_spawn", lambda self: None):
+        collector = engine.RTL433Collector(prefilter=False)
+    packet = collector._packet(line(DOORBELL))
+    assert packet is not None
+    assert packet.sensor_id == "11:00"
+    assert not collector.dropped
+
+
+def test_model_type_matches_packet_type():
+    for record in (THGR810, WGR800, DOORBELL):
+        packet = engine.SensorPacket()
+        packet.from_json(dict(record))
+        assert engine.model_type(record["model"]) == packet.stype
@@ -6,6 +6,8 @@ import time
 
 import paho.mqtt.client as mqtt
 import pytest
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 from tests.mqtt_broker import SimpleMQTTBroker
 
@@ -136,3 +138,57 @@ def test_will_not_published_on_clean_disconnect(broker):
     time.sleep(0.3)
 
     assert "arwn/status" not in broker.retained
+
+
+def test_v5_properties_and_topic_aliases(broker):
+    """v5 PUBLISH properties are recorded and topic aliases resolved."""
+    c = mqtt.Client(protocol=mqtt.MQTTv5)
+    c.connect("localhost", broker.port)
+    c.loop_start()
+    time.sleep(0.15)
+
+    first = Properties(PacketTypes.PUBLISH)
+    first.TopicAlias = 1
+    first.UserProperty = ("sensor_id", "ec:01")
+    first.MessageExpiryInterval = 60
+    c.publish("arwn/wind", b"1", properties=first)
+    again = Properties(PacketTypes.PUBLISH)
+    again.TopicAlias = 1
+    c.publish("", b"2", properties=again)
+    time.sleep(0.2)
+    c.loop_stop()
+    c.disconnect()
+
+    assert [(m.topic, m.payload) for m in broker.messages] == [
+        ("arwn/wind", b"1"),
+        ("arwn/wind", b"2"),
+    ]
+    assert broker.messages[0].properties == {
+        "topic_alias": 1,
+        "user_property": [("sensor_id", "ec:01")],
+        "message_expiry_interval": 60,
+    }
+
+
+def test_v5_subscriber_receives_messages(broker):
+    """A v5 subscriber gets both retained and live messages."""
+    pub = connect_client(broker.port)
+    pub.publish("arwn/totals/rain", b"retained", retain=True)
+    time.sleep(0.2)
+
+    received = []
+    sub = mqtt.Client(protocol=mqtt.MQTTv5)
+    sub.on_message = lambda client, userdata, msg: received.append(
+        (msg.topic, msg.payload)
+    )
+    sub.connect("localhost", broker.port)
+    sub.subscribe("arwn/#")
+    sub.loop_start()
+    time.sleep(0.2)
+    pub.publish("arwn/rain", b"live")
+    time.sleep(0.2)
+    for c in (pub, sub):
+        c.loop_stop()
+        c.disconnect()
+
+    assert received == [("arwn/totals/rain", b"retained"), ("arwn/rain", b"live")]
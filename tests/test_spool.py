@@ -0,0 +1,124 @@
+"""Tests for the outbound message spool."""
+
+import json
+import time
+from unittest.mock import MagicMock, patch
+
+import paho.mqtt.client as paho
+
+from arwn import engine, handlers
+from arwn.spool import Spool
+from tests.conftest import wait_for_message
+
+
+def test_spool_is_fifo(tmp_path):
+    spool = Spool(str(tmp_path / "spool.db"))
+    before = time.time()
+    spool.put("arwn/rain", b'{"total": 1}', sensor_id="65:00")
+    spool.put("arwn/totals/rain", '{"total": 2}', retain=True)
+    assert len(spool) == 2
+    first, second = spool.peek()
+    assert first[1:4] == ("arwn/rain", b'{"total": 1}', False)
+    assert second[1:4] == ("arwn/totals/rain", b'{"total": 2}', True)
+    assert first.sensor_id == "65:00"
+    assert second.sensor_id is None
+    assert before <= first.created <= second.created <= time.time()
+    spool.remove(first[0])
+    assert [m[1] for m in spool.peek()] == ["arwn/totals/rain"]
+    assert len(spool) == 1
+
+
+def test_spool_survives_restart(tmp_path):
+    path = str(tmp_path / "spool.db")
+    spool = Spool(path)
+    spool.put("arwn/rain", b"1")
+    spool.close()
+    spool = Spool(path)
+    assert len(spool) == 1
+    assert spool.peek()[0][2] == b"1"
+    mode = spool._db.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+
+
+def test_spool_drops_oldest_when_full(tmp_path):
+    spool = Spool(str(tmp_path / "spool.db"), max_messages=3)
+    for i in range(5):
+        spool.put("arwn/rain", str(i))
+    assert len(spool) == 3
+    assert spool.dropped == 2
+    assert [m[2] for m in spool.peek()] == [b"2", b"3", b"4"]
+
+
+def test_mqtt_spools_until_connected(sim_broker, sim_broker_clean, tmp_path):
+    config = {
+        "mqtt": {
+            "spool": {"path": str(tmp_path / "spool.db"), "rate": 1000},
+            # keep the rain handlers' totals out of the spool
+            "local_handlers": False,
+        },
+        "names": {},
+    }
+    handlers.setup()
+    # not connected yet, as if the broker were down
+    mq = engine.MQTT("localhost", config, port=1)
+    try:
+        for i in range(3):
+            mq.send("rain", {"total": i}, timestamp=1000 + i)
+        assert len(mq.spool) == 3
+        assert sim_broker.broker.messages == []
+
+        # the broker comes back
+        mq.client.connect_async("localhost", sim_broker.port)
+        wait_for_message(sim_broker.broker, "arwn/rain", timeout=5.0)
+        deadline = time.monotonic() + 5.0
+        while len(mq.spool) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert len(mq.spool) == 0
+
+        rain = [
+            json.loads(m.payload)
+            for m in sim_broker.broker.messages
+            if m.topic == "arwn/rain"
+        ]
+        assert rain == [{"total": i, "timestamp": 1000 + i} for i in range(3)]
+
+        # back to publishing directly once the spool is empty
+        mq.send("rain", {"total": 3}, timestamp=1003)
+        assert len(mq.spool) == 0
+    finally:
+        mq.client.loop_stop()
+        mq.client.disconnect()
+
+
+def test_mqtt_restarts_replay_when_spooling_while_connected(tmp_path):
+    config = {
+        "mqtt": {
+            "spool": {"path": str(tmp_path / "spool.db"), "rate": 1000},
+            "local_handlers": False,
+        },
+        "names": {},
+    }
+    with patch.object(engine.MQTT, "_start"):
+        mq = engine.MQTT("localhost", config)
+    mq.client = MagicMock()
+    mq.client.publish.return_value.rc = paho.MQTT_ERR_SUCCESS
+    mq.client.publish.return_value.is_published.return_value = True
+    mq.connected = True
+    # left behind by a replayer that has already stopped
+    mq.spool.put("arwn/rain", b'{"total": 0}')
+    mq.send("rain", {"total": 1})
+    # sent by a new replayer, not waiting for a reconnect to start one
+    deadline = time.monotonic() + 2.0
+    while len(mq.spool) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(mq.spool) == 0
+    sent = [c[0][:2] for c in mq.client.publish.call_args_list]
+    assert sent == [("arwn/rain", b'{"total": 0}'), ("arwn/rain", b'{"total": 1}')]
+    # the replayer is done once the spool is empty
+    while mq._replayer is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert mq._replayer is None
+    # and back to publishing directly
+    mq.send("rain", {"total": 2})
+    assert len(mq.spool) == 0
+    assert mq.client.publish.call_count == 3
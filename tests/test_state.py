@@ -0,0 +1,32 @@
+"""Tests for the handler state store."""
+
+import json
+import os
+
+from arwn.state import StateStore
+
+
+def test_round_trip(tmp_path):
+    store = StateStore(str(tmp_path / "state.json"))
+    assert store.load() == {}
+    store.save({"last_rain": {"total": 1.5, "timestamp": 10}})
+    assert store.load() == {"last_rain": {"total": 1.5, "timestamp": 10}}
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_failed_save_keeps_the_old_state(tmp_path):
+    path = tmp_path / "state.json"
+    store = StateStore(str(path))
+    store.save({"last_rain": {"total": 1.5}})
+    # not serializable, fails part way through writing
+    store.save({"last_rain": {"total": 2.0}, "bad": object()})
+    assert json.loads(path.read_text()) == {"last_rain": {"total": 1.5}}
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_unreadable_state_is_ignored(tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text('{"last_rain": ')
+    assert StateStore(str(path)).load() == {}
+    path.write_text("[1, 2]")
+    assert StateStore(str(path)).load() == {}
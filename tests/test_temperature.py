@@ -0,0 +1,102 @@
+"""Tests for arwn.temperature."""
+
+import math
+
+import pytest
+
+from arwn import temperature
+from arwn.temperature import Temperature
+
+
+def legacy_reading(temp_c, humid):
+    """F and dewpoint in F, the way SensorPacket used to get them
+
+    Every step went through a "%f" string and back.
+    """
+    temp_f = float("%f" % (temp_c * 1.8 + 32))
+    t = float("%f" % ((temp_f - 32) / 1.8))
+
+    def gamma(t, humid):
+        return (temperature.a * t / (temperature.b + t)) + math.log(humid / 100.0)
+
+    dewpoint = (temperature.b * gamma(t, humid)) / (temperature.a - gamma(t, humid))
+    return temp_f, (dewpoint * 1.8) + 32
+
+
+@pytest.mark.parametrize(
+    "c,f,k",
+    [(0, 32, 273.15), (100, 212, 373.15), (-40, -40, 233.15), (21.5, 70.7, 294.65)],
+)
+def test_conversions(c, f, k):
+    assert temperature.c_to_f(c) == pytest.approx(f)
+    assert temperature.f_to_c(f) == pytest.approx(c)
+    assert temperature.c_to_k(c) == pytest.approx(k)
+    assert temperature.k_to_c(k) == pytest.approx(c)
+    assert temperature.f_to_k(f) == pytest.approx(k)
+    assert temperature.k_to_f(k) == pytest.approx(f)
+
+
+def test_temperature_objects():
+    t = Temperature.from_c(100)
+    assert t.is_C()
+    assert t.to_F() == pytest.approx(212)
+    assert t.as_K().to_C() == pytest.approx(100)
+    assert Temperature("373.15K").to_C() == pytest.approx(100)
+    assert Temperature.from_f(212).as_C().temp == pytest.approx(100)
+    assert str(Temperature.from_k(0)) == "0.000000K"
+
+
+def test_dewpoint_in_own_units():
+    t = Temperature.from_c(20)
+    dewpoint_c = t.dewpoint(50)
+    assert dewpoint_c == pytest.approx(9.3, abs=0.05)
+    assert t.as_F().dewpoint(50) == pytest.approx(temperature.c_to_f(dewpoint_c))
+    # saturated air is at its dewpoint
+    assert t.dewpoint(100) == pytest.approx(20)
+
+
+def test_matches_legacy_at_published_precision():
+    # sensors report 0.1C, we publish 0.1F
+    for i in range(-400, 650):
+        temp_c = i / 10.0
+        temp_f = temperature.c_to_f(temp_c)
+        for humid in range(1, 101, 3):
+            dewpoint = temperature.c_to_f(temperature.dewpoint_c(temp_c, humid))
+            old_f, old_dewpoint = legacy_reading(temp_c, humid)
+            assert round(temp_f, 1) == round(old_f, 1)
+            assert round(dewpoint, 1) == round(old_dewpoint, 1)
+
+
+@pytest.fixture(params=["numpy", "list"])
+def batch_backend(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(temperature, "numpy", None)
+    return request.param
+
+
+def test_convert_many(batch_backend):
+    temps = [-40, 0, 21.5, 100]
+    for from_units, to_units in (("C", "F"), ("F", "K"), ("K", "C"), ("C", "C")):
+        expected = [
+            Temperature.from_value(t, from_units)._convert_to(to_units) for t in temps
+        ]
+        result = temperature.convert_many(temps, from_units, to_units)
+        assert list(result) == pytest.approx(expected)
+    if batch_backend == "list":
+        assert isinstance(result, list)
+
+
+def test_dewpoint_many(batch_backend):
+    temps = [-10.0, 0.0, 20.0, 35.5]
+    humids = [90, 50, 45, 100]
+    expected = [Temperature.from_f(t).dewpoint(h) for t, h in zip(temps, humids)]
+    result = temperature.dewpoint_many(temps, humids, units="F")
+    assert list(result) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("humids", [[50], [50, 60, 70]])
+def test_dewpoint_many_length_mismatch(batch_backend, humids):
+    with pytest.raises(ValueError):
+        temperature.dewpoint_many([1.0, 2.0], humids)
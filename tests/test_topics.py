@@ -0,0 +1,47 @@
+"""Tests for the topic helpers."""
+
+from arwn.topics import PrefixMap, TopicRouter
+
+
+def test_prefix_map_matches_whole_levels():
+    prefixes = PrefixMap("default")
+    prefixes["arwn/temperature"] = "temp"
+    prefixes["arwn/temperature/Outside/"] = "outside"
+    assert prefixes.get("arwn/temperature/Garden") == "temp"
+    assert prefixes.get("arwn/temperature/Outside") == "outside"
+    assert prefixes.get("arwn/temperatures") == "default"
+    assert len(prefixes) == 2
+
+
+def test_router_filters():
+    router = TopicRouter()
+    router.add("+/rain", "rain")
+    router.add("arwn/temperature/+", "temperature")
+    router.add("+/#", "everything")
+    router.add("arwn/rain/#", "rain tree")
+    assert router.route("arwn/rain") == ("rain", "everything", "rain tree")
+    assert router.route("arwn/rain/today") == ("everything", "rain tree")
+    assert router.route("arwn/temperature/Outside") == ("temperature", "everything")
+    assert router.route("arwn/temperature/Outside/x") == ("everything",)
+    assert router.route("arwn") == ("everything",)
+    assert router.route("house/wind") == ("everything",)
+
+
+def test_router_keeps_the_order_targets_were_added():
+    router = TopicRouter()
+    router.add("+/rain", "first")
+    router.add("arwn/#", "second")
+    router.add("arwn/rain", "first")
+    router.add_pattern(r"rain$", "third")
+    assert router.route("arwn/rain") == ("first", "second", "third")
+    assert router.route("house/rain") == ("first", "third")
+
+
+def test_router_caches_routes():
+    router = TopicRouter()
+    router.add("+/wind", "wind")
+    first = router.route("arwn/wind")
+    assert router.route("arwn/wind") is first
+    # adding more invalidates the cache
+    router.add("arwn/#", "all")
+    assert router.route("arwn/wind") == ("wind", "all")
@@ -0,0 +1,241 @@
+"""Tests for the Weather Underground uploader."""
+
+import http.server
+import threading
+import time
+import urllib.parse
+from unittest import mock
+
+import pytest
+
+from arwn import handlers, wunderground
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    """Answers like updateweatherstation.php, with keep alive"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        server.requests.append(
+            (self.client_address, url.path, dict(urllib.parse.parse_qsl(url.query)))
+        )
+        status = server.statuses.pop(0) if server.statuses else 200
+        body = b"success\n" if status == 200 else b"error\n"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("localhost", 0), StandIn)
+    httpd.daemon_threads = True
+    httpd.requests = []
+    httpd.statuses = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = "http://localhost:%d/weatherstation/update.php" % httpd.server_port
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_observation():
+    obs = wunderground.Observation()
+    assert not obs.ready()
+    assert obs.update(tempf=50.0, dewptf=40.0)
+    assert not obs.update(tempf=50.0)
+    assert obs.ready()
+    assert obs.params() == {
+        "tempf": 50.0,
+        "dewptf": 40.0,
+        "dailyrainin": 0,
+        "winddir": 0,
+        "windspeedmph": 0,
+        "windgustmph": 0,
+    }
+
+
+def make_uploader(server, **kwargs):
+    return wunderground.Uploader("KXX", "secret", server.url, **kwargs)
+
+
+def test_uploads_on_one_connection_when_changed(server):
+    uploader = make_uploader(server, interval=0.3)
+    try:
+        # nothing goes out without a temperature
+        uploader.submit(winddir=90)
+        time.sleep(0.1)
+        assert server.requests == []
+        uploader.submit(tempf=50, dewptf=40)
+        wait_for(lambda: len(server.requests) == 1)
+        # these arrive within the interval, and go out as one
+        uploader.submit(tempf=51)
+        uploader.submit(tempf=52, baromin=29.9)
+        wait_for(lambda: len(server.requests) == 2)
+        # nothing new, nothing sent
+        uploader.submit(tempf=52)
+        time.sleep(0.4)
+        assert len(server.requests) == 2
+    finally:
+        uploader.stop()
+
+    (first_addr, path, first), (second_addr, _, second) = server.requests
+    assert path == "/weatherstation/update.php"
+    assert first["ID"] == "KXX"
+    assert first["PASSWORD"] == "secret"
+    assert first["action"] == "updateraw"
+    assert (first["tempf"], first["winddir"]) == ("50", "90")
+    assert "realtime" not in first
+    assert (second["tempf"], second["baromin"]) == ("52", "29.9")
+    # the same kept alive connection
+    assert first_addr == second_addr
+    snap = uploader.snapshot()
+    assert snap["uploads"] == 2
+    assert snap["unchanged"] == 1
+    assert snap["failures"] == 0
+    assert snap["connections"] == 1
+    assert not snap["pending"]
+    assert "p50" in snap["latency_ms"]
+
+
+def test_rapidfire_cadence(server):
+    config = {
+        "station": "KXX",
+        "passwd": "secret",
+        "rapidfire": True,
+        "url": server.url,
+        "interval": 0.1,
+    }
+    uploader = wunderground.Uploader.from_config(config)
+    try:
+        start = time.monotonic()
+        i = 0
+        while time.monotonic() - start < 0.5:
+            uploader.submit(tempf=50 + i, dewptf=40)
+            i += 1
+            time.sleep(0.005)
+    finally:
+        uploader.stop()
+    # a steady rate, however many readings came in
+    assert i > 20
+    assert 3 <= len(server.requests) <= 7
+    params = server.requests[0][2]
+    assert (params["realtime"], params["rtfreq"]) == ("1", "0.1")
+    assert len({addr for addr, _, _ in server.requests}) == 1
+
+
+def test_unchanged_observation_is_refreshed(server):
+    uploader = make_uploader(server, interval=0.05, refresh=0.3)
+    try:
+        uploader.submit(tempf=50, dewptf=40)
+        wait_for(lambda: len(server.requests) == 1)
+        # a steady reading, sent again so the station doesn't go offline
+        start = time.monotonic()
+        wait_for(lambda: len(server.requests) == 2)
+        assert time.monotonic() - start > 0.2
+    finally:
+        uploader.stop()
+    assert server.requests[0][2] == server.requests[1][2]
+
+
+def test_rapidfire_defaults():
+    uploader = wunderground.Uploader.from_config(
+        {"station": "KXX", "passwd": "secret", "rapidfire": True}
+    )
+    uploader.stop()
+    assert uploader.host == "rtupdate.wunderground.com"
+    assert uploader.interval == 2.5
+
+
+def test_retries_with_backoff(server):
+    server.statuses = [500, 503]
+    uploader = make_uploader(server, interval=0.01, backoff=0.05)
+    try:
+        uploader.submit(tempf=50, dewptf=40)
+        wait_for(lambda: len(server.requests) == 1)
+        # the retry sends the newest observation
+        uploader.submit(winddir=180)
+        wait_for(lambda: uploader.snapshot()["uploads"] == 1)
+    finally:
+        uploader.stop()
+    assert len(server.requests) == 3
+    assert server.requests[-1][2]["winddir"] == "180"
+    snap = uploader.snapshot()
+    assert snap["failures"] == 2
+    assert snap["consecutive_failures"] == 0
+
+
+def test_backoff_doubles_up_to_max():
+    uploader = wunderground.Uploader(
+        "KXX",
+        "secret",
+        "http://localhost:1/",
+        backoff=1.0,
+        max_backoff=5.0,
+        clock=lambda: 100.0,
+    )
+    uploader.stop()
+    delays = []
+    for _ in range(5):
+        uploader._failed(Exception("down"))
+        delays.append(uploader._next - 100.0)
+    assert delays == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+
+def test_unreachable_server_counts_failures():
+    uploader = wunderground.Uploader(
+        "KXX", "secret", "http://localhost:1/", timeout=1, backoff=10
+    )
+    try:
+        uploader.submit(tempf=50, dewptf=40)
+        wait_for(lambda: uploader.snapshot()["failures"] == 1)
+        assert uploader.snapshot()["pending"]
+    finally:
+        uploader.stop()
+
+
+def test_handler_submits_to_the_uploader(server):
+    handlers.setup()
+    client = mock.MagicMock()
+    client.config = {
+        "wunderground": {
+            "station": "KXX",
+            "passwd": "secret",
+            "url": server.url,
+            "interval": 60,
+        }
+    }
+    handlers.run(client, "arwn/rain/today", {"since_midnight": 0.1})
+    handlers.run(client, "arwn/wind", {"direction": 90, "speed": 3, "gust": 5})
+    handlers.run(client, "arwn/barometer", {"pressure": 1013.0})
+    handlers.run(
+        client,
+        "arwn/temperature/Outside",
+        {"temp": 50.0, "dewpoint": 40.0, "humid": 60},
+    )
+    wait_for(lambda: len(server.requests) == 1)
+    params = server.requests[0][2]
+    assert params["ID"] == "KXX"
+    assert params["tempf"] == "50.0"
+    assert params["dailyrainin"] == "0.1"
+    assert params["windgustmph"] == "5"
+    assert float(params["baromin"]) == pytest.approx(29.91, abs=0.01)
+    # stopped when the handlers are set up again
+    uploader = handlers.HANDLERS[-1].uploader
+    handlers.setup()
+    wait_for(lambda: not uploader._thread.is_alive())